@@ -1,8 +1,20 @@
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
 from app.routers import newsletter, jobs
+from app.services.admission import admission
+from app.services.epub_cache import epub_cache
+from app.services.image_cache import image_cache
+from app.services.image_processor import shutdown_pool
 from app.services.job_manager import job_manager
+from app.services.job_store import job_store
+from app.services.metrics import CountingThreadPool, registry
+from app.services.post_cache import post_cache
+from app.services.rate_limiter import rate_limiter
+from app.services.substack_async import close_http_transport
 
 app = FastAPI(title="Substack to Kindle", version="1.0.0")
 
@@ -12,22 +24,84 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
 
 app.include_router(newsletter.router, prefix="/api")
 app.include_router(jobs.router, prefix="/api")
 
 
+def _cache_lookups():
+    values = {}
+    for name, cache in (("image", image_cache), ("post", post_cache), ("epub", epub_cache)):
+        values[(name, "hit")] = cache.hits
+        values[(name, "miss")] = cache.misses
+    return values
+
+
+def _queue_depth():
+    waiting, running = job_manager.workload()
+    return {("waiting",): len(waiting), ("running",): len(running)}
+
+
+registry.callback(
+    "stk_cache_lookups_total",
+    "Image, post page and EPUB cache lookups by result",
+    "counter",
+    _cache_lookups,
+    ("cache", "result"),
+)
+registry.callback(
+    "stk_jobs_queued",
+    "Unfinished jobs waiting for and holding a run slot",
+    "gauge",
+    _queue_depth,
+    ("state",),
+)
+
+
 @app.on_event("startup")
 async def startup():
+    asyncio.get_running_loop().set_default_executor(CountingThreadPool())
+    await job_manager.restore()
     job_manager.start_cleanup_task()
 
 
 @app.on_event("shutdown")
 async def shutdown():
     job_manager.stop_cleanup_task()
+    await close_http_transport()
+    shutdown_pool()
 
 
 @app.get("/api/health")
 async def health():
     return {"status": "ok"}
+
+
+@app.get("/api/upstream/limits")
+async def upstream_limits():
+    """Current per-host request rates, back-off state and wait times."""
+    return rate_limiter.stats()
+
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Counters and histograms in the Prometheus text format."""
+    if job_manager.queued:
+        # Jobs run in the workers, which leave their metrics in the job
+        # store; the jobs gauge reads it too
+        text = await asyncio.to_thread(
+            lambda: registry.render(job_store.worker_metrics())
+        )
+    else:
+        text = registry.render()
+    return PlainTextResponse(
+        text, media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/api/admission")
+async def admission_stats():
+    """Queue depth, estimated wait, free disk and the work estimates behind them."""
+    return admission.stats(*await job_manager.workload_async())
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from pydantic import BaseModel
 from enum import Enum
-from typing import Optional, List
+from typing import Dict, Literal, Optional, List, Union
 
 
 class PostMetadata(BaseModel):
@@ -31,6 +31,13 @@ class JobCreateRequest(BaseModel):
     subdomain: str
     slugs: List[str]
     session_cookie: Optional[str] = None
+    # Build one anthology EPUB (one per year with split_by_year) instead of
+    # one EPUB per post
+    omnibus: bool = False
+    split_by_year: bool = False
+    # Run under the profiler and keep its reports next to the ZIP;
+    # "allocations" also traces memory, which slows the whole server
+    profile: Union[bool, Literal["allocations"]] = False
 
 
 class JobCreateResponse(BaseModel):
@@ -44,6 +51,13 @@ class JobStatusResponse(BaseModel):
     total: int
     current_post: Optional[str] = None
     error: Optional[str] = None
+    image_bytes_saved: int = 0
+    failed: int = 0
+    queue_position: Optional[int] = None
+    # Seconds per stage, once the job has finished
+    stage_seconds: Optional[Dict[str, float]] = None
+    # Profile files of a profiled job, for /jobs/{job_id}/profile/{name}
+    artifacts: List[str] = []
 
 
 class SSEEvent(BaseModel):
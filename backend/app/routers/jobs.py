@@ -1,8 +1,9 @@
 import asyncio
 import json
+import os
 
-from fastapi import APIRouter, BackgroundTasks, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, StreamingResponse
 from sse_starlette.sse import EventSourceResponse
 
 from app.models.schemas import (
@@ -12,25 +13,58 @@ from app.models.schemas import (
     SendToKindleRequest,
     SendToKindleResponse,
 )
+from app.services.admission import AdmissionRejected, admission, client_address
+from app.services.event_log import SSE_PING_INTERVAL, SSE_SEND_TIMEOUT
 from app.services.job_manager import job_manager
+from app.services.job_profiler import ARTIFACTS, JOB_PROFILING
+from app.services.zip_stream import iter_zip
 from app.services.email_sender import is_configured as email_is_configured, send_to_kindle
 
 router = APIRouter()
 
 
+def _client_id(request: Request) -> str:
+    peer = request.client.host if request.client else ""
+    return client_address(peer, ", ".join(request.headers.getlist("x-forwarded-for")))
+
+
 @router.post("/jobs", response_model=JobCreateResponse)
-async def create_job(req: JobCreateRequest, background_tasks: BackgroundTasks):
+async def create_job(req: JobCreateRequest, request: Request):
     if not req.slugs:
         raise HTTPException(status_code=400, detail="No posts selected")
+    if req.profile and not JOB_PROFILING:
+        raise HTTPException(status_code=403, detail="Job profiling is disabled on this server")
 
-    job = job_manager.create_job(req.subdomain, req.slugs, req.session_cookie)
-    background_tasks.add_task(job_manager.run_job, job)
+    client_id = _client_id(request)
+    # Before create_job, so a rejected request leaves nothing behind
+    workload = await job_manager.workload_async()
+    try:
+        admission.admit(req.subdomain, len(req.slugs), client_id, *workload)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+
+    job = await job_manager.create_job_async(
+        req.subdomain,
+        req.slugs,
+        req.session_cookie,
+        omnibus=req.omnibus,
+        split_by_year=req.split_by_year,
+        client_id=client_id,
+        profile=req.profile,
+    )
+    job_manager.submit(job)
     return JobCreateResponse(job_id=job.id)
 
 
+@router.get("/jobs/quota")
+async def job_quota(request: Request):
+    """The calling client's job quotas and current usage."""
+    return admission.quota(_client_id(request), *await job_manager.workload_async())
+
+
 @router.get("/jobs/{job_id}", response_model=JobStatusResponse)
 async def get_job_status(job_id: str):
-    job = job_manager.get_job(job_id)
+    job = await job_manager.get_job_async(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     d = job.status_dict()
@@ -38,38 +72,49 @@ async def get_job_status(job_id: str):
 
 
 @router.get("/jobs/{job_id}/stream")
-async def job_stream(job_id: str):
-    job = job_manager.get_job(job_id)
+async def job_stream(job_id: str, request: Request):
+    """SSE job events. Each carries an id; a reconnecting EventSource sends
+    the last one as Last-Event-ID and gets the events it missed."""
+    job = await job_manager.get_job_async(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
 
-    queue: asyncio.Queue = asyncio.Queue()
-    job.sse_queues.append(queue)
+    last_event_id = request.headers.get("last-event-id", "")
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else None
 
     async def event_generator():
-        try:
-            # Send current status immediately
-            yield {"event": "status", "data": json.dumps(job.status_dict())}
-
-            while True:
-                msg = await asyncio.wait_for(queue.get(), timeout=60)
-                yield {"event": msg["event"], "data": json.dumps(msg["data"])}
-                if msg["event"] == "done":
-                    break
-        except asyncio.TimeoutError:
-            yield {"event": "ping", "data": "{}"}
-        finally:
-            if queue in job.sse_queues:
-                job.sse_queues.remove(queue)
+        async for seq, event, data in job_manager.stream(job, last_event_id):
+            yield {"id": str(seq), "event": event, "data": json.dumps(data)}
 
-    return EventSourceResponse(event_generator())
+    # A client too slow to take an event for SSE_SEND_TIMEOUT is dropped and
+    # resumes from its Last-Event-ID when it reconnects
+    return EventSourceResponse(
+        event_generator(), ping=SSE_PING_INTERVAL, send_timeout=SSE_SEND_TIMEOUT
+    )
 
 
 @router.get("/jobs/{job_id}/download")
-async def download_job(job_id: str):
-    job = job_manager.get_job(job_id)
+async def download_job(job_id: str, stream: bool = False):
+    """Download the job's ZIP.
+
+    With ?stream=true the ZIP is generated on the fly from the EPUBs
+    finished so far, so it is also available while the job is running.
+    """
+    job = await job_manager.get_job_async(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
+
+    if stream:
+        if not job.epub_paths:
+            raise HTTPException(status_code=400, detail="No download available")
+        return StreamingResponse(
+            iter_zip(list(job.epub_paths)),
+            media_type="application/zip",
+            headers={
+                "Content-Disposition": f'attachment; filename="{job.subdomain}_epubs.zip"'
+            },
+        )
+
     if not job.zip_path:
         raise HTTPException(status_code=400, detail="No download available")
 
@@ -80,6 +125,21 @@ async def download_job(job_id: str):
     )
 
 
+@router.get("/jobs/{job_id}/profile/{name}")
+async def download_profile(job_id: str, name: str):
+    """One of a profiled job's profile files, once the job has finished."""
+    job = await job_manager.get_job_async(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if name not in ARTIFACTS or name not in job.artifacts:
+        raise HTTPException(status_code=404, detail="No such profile file")
+    return FileResponse(
+        os.path.join(job.output_dir, name),
+        media_type="text/plain",
+        filename=f"{job.subdomain}_{job.id}_{name}",
+    )
+
+
 @router.get("/email/status")
 async def email_status():
     return {"configured": email_is_configured()}
@@ -90,7 +150,7 @@ async def send_job_to_kindle(job_id: str, req: SendToKindleRequest):
     if not email_is_configured():
         raise HTTPException(status_code=503, detail="Email service not configured")
 
-    job = job_manager.get_job(job_id)
+    job = await job_manager.get_job_async(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     if not job.epub_paths:
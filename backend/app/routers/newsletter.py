@@ -1,31 +1,28 @@
 import asyncio
 import json
 
-import requests
-from fastapi import APIRouter, HTTPException
+import httpx
+from fastapi import APIRouter, HTTPException, Request
 from sse_starlette.sse import EventSourceResponse
 
 from app.models.schemas import PostMetadata, PostListResponse
+from app.services.archive_store import get_archive, stream_archive
 from app.services.substack import SubstackClient
+from app.services.substack_async import AsyncSubstackClient
 
 router = APIRouter()
 
+# Batches fetched ahead of a slow SSE client before the archive walk pauses
+STREAM_BUFFER_BATCHES = 4
+
 
 @router.get("/newsletter/{subdomain}/check")
 async def check_subdomain(subdomain: str):
     """Quick check that a Substack subdomain exists (fetches first batch only)."""
-    def _check():
-        resp = requests.get(
-            f"https://{subdomain}.substack.com/api/v1/archive?sort=new&offset=0&limit=1",
-            headers=SubstackClient._headers(),
-            timeout=10,
-        )
-        resp.raise_for_status()
-        return resp.json()
-
     try:
-        posts = await asyncio.to_thread(_check)
-    except requests.exceptions.HTTPError:
+        async with AsyncSubstackClient(subdomain) as client:
+            posts = await client.fetch_archive_page(offset=0, limit=1)
+    except httpx.HTTPStatusError:
         raise HTTPException(status_code=404, detail=f"Newsletter '{subdomain}' not found")
     except Exception:
         raise HTTPException(status_code=502, detail=f"Could not reach {subdomain}.substack.com")
@@ -34,15 +31,43 @@ async def check_subdomain(subdomain: str):
 
 
 @router.get("/newsletter/{subdomain}/posts/stream")
-async def stream_posts(subdomain: str):
-    """Stream post metadata as it's fetched batch-by-batch via SSE."""
-    client = SubstackClient(subdomain)
+async def stream_posts(subdomain: str, request: Request):
+    """Stream post metadata batch-by-batch via SSE.
+
+    Newsletters already in the archive store are sent from it at once; posts
+    published since then follow in a batch flagged "prepend". The archive is
+    read by a producer task into a bounded queue, which a disconnected
+    client cancels. A first walk of the archive runs on regardless and is
+    stored, so a slow or departed client holds up no one else.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_BUFFER_BATCHES)
+
+    async def produce():
+        try:
+            async for batch, prepend in stream_archive(subdomain):
+                await queue.put(("batch", batch, prepend))
+            await queue.put(("done", None, False))
+        except Exception as e:
+            await queue.put(("error", str(e), False))
 
     async def event_generator():
+        producer = asyncio.create_task(produce())
         total = 0
         batch_num = 0
         try:
-            for batch in client.fetch_post_metadata_batches():
+            while True:
+                kind, batch, prepend = await queue.get()
+                if kind == "error":
+                    yield {
+                        "event": "error",
+                        "data": json.dumps({"message": batch}),
+                    }
+                    return
+                if kind == "done":
+                    break
+                if await request.is_disconnected():
+                    return
+
                 batch_num += 1
                 posts = []
                 for p in batch:
@@ -62,30 +87,25 @@ async def stream_posts(subdomain: str):
                         "batch": batch_num,
                         "batch_size": len(posts),
                         "total_so_far": total,
+                        "prepend": prepend,
                         "posts": posts,
                     }),
                 }
-                # Yield control to event loop between batches
-                await asyncio.sleep(0)
 
             yield {
                 "event": "done",
                 "data": json.dumps({"total": total}),
             }
-        except Exception as e:
-            yield {
-                "event": "error",
-                "data": json.dumps({"message": str(e)}),
-            }
+        finally:
+            producer.cancel()
 
     return EventSourceResponse(event_generator())
 
 
 @router.get("/newsletter/{subdomain}/posts", response_model=PostListResponse)
 async def get_posts(subdomain: str):
-    client = SubstackClient(subdomain)
     try:
-        raw_posts = await asyncio.to_thread(client.fetch_all_post_metadata)
+        raw_posts = await get_archive(subdomain)
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Failed to fetch from Substack: {e}")
 
@@ -0,0 +1,292 @@
+"""
+Admission control for new jobs.
+
+A job is checked before anything is created for it, and rejected while the
+server cannot finish it in reasonable time:
+
+- 503 when the deployment is saturated: too many jobs waiting, more queued
+  work than JOB_MAX_RUNNING slots clear within ADMISSION_MAX_WAIT, or too
+  little free disk under JOB_DATA_DIR for the job's estimated output.
+- 429 when one client is over its quota: jobs outstanding, posts
+  outstanding, or jobs submitted in the last hour.
+
+Both carry a Retry-After computed from the backlog, so clients back off for
+about as long as the overload lasts instead of timing out.
+
+Clients are told apart by address: the peer's, or behind a proxy listed in
+TRUSTED_PROXIES the one the proxy puts in X-Forwarded-For.
+
+Work is measured in units: one per post plus IMAGE_WORK_WEIGHT per image.
+Images per post are learned per newsletter, and seconds and output bytes per
+unit are learned from finished jobs, so estimates track the real mix of
+newsletters. Until jobs finish in this process (always, with
+WORKER_MODE=queue) the starting values below are used.
+"""
+
+from __future__ import annotations
+
+import ipaddress
+import math
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional
+
+from app.services.job_store import JOB_DATA_DIR
+from app.services.scheduler import JOB_MAX_RUNNING, Candidate
+
+# Waiting jobs beyond which new jobs are turned away
+ADMISSION_MAX_QUEUED = int(os.environ.get("ADMISSION_MAX_QUEUED", "32"))
+# Longest estimated wait plus run time accepted for a new job, in seconds
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "900"))
+# Free space kept under JOB_DATA_DIR after a job's estimated output
+MIN_FREE_DISK_BYTES = int(os.environ.get("MIN_FREE_DISK_MB", "1024")) * 1024 * 1024
+# Unfinished jobs one client may have
+CLIENT_MAX_JOBS = int(os.environ.get("CLIENT_MAX_JOBS", "4"))
+# Unfinished posts one client may have, across its jobs
+CLIENT_MAX_POSTS = int(os.environ.get("CLIENT_MAX_POSTS", "2000"))
+# Jobs one client may submit per hour
+CLIENT_JOBS_PER_HOUR = int(os.environ.get("CLIENT_JOBS_PER_HOUR", "30"))
+# Proxies (addresses or networks, comma-separated) trusted to name the real
+# client in X-Forwarded-For; without them every client behind a proxy is one
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(entry.strip(), strict=False)
+    for entry in os.environ.get("TRUSTED_PROXIES", "").split(",")
+    if entry.strip()
+]
+# Work units an image costs, relative to a post's page fetch and parse
+IMAGE_WORK_WEIGHT = float(os.environ.get("IMAGE_WORK_WEIGHT", "0.25"))
+
+# Starting estimates, replaced as jobs finish
+DEFAULT_IMAGES_PER_POST = 3.0
+DEFAULT_SECONDS_PER_UNIT = 0.5
+DEFAULT_BYTES_PER_UNIT = 150 * 1024
+# Weight of each new observation in the moving averages
+EMA_ALPHA = 0.2
+# Newsletters whose image density is remembered
+MAX_TRACKED_SUBDOMAINS = 1000
+# The cleanup loop frees disk every 5 minutes
+DISK_RETRY_AFTER = 300
+MAX_RETRY_AFTER = 3600
+QUOTA_WINDOW = 3600
+
+
+def _trusted(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+
+def client_address(peer: str, forwarded_for: str = "") -> str:
+    """The client a request is counted against.
+
+    From a trusted proxy, that is the nearest X-Forwarded-For address that is
+    not a trusted proxy itself; addresses further left could be forged by the
+    client.
+    """
+    if not forwarded_for or not _trusted(peer):
+        return peer
+    hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _trusted(hop):
+            return hop
+    return hops[0] if hops else peer
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[float] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> Optional[Dict[str, str]]:
+        if self.retry_after is None:
+            return None
+        seconds = min(MAX_RETRY_AFTER, max(1, math.ceil(self.retry_after)))
+        return {"Retry-After": str(seconds)}
+
+
+def _ema(current: float, sample: float) -> float:
+    return current + EMA_ALPHA * (sample - current)
+
+
+@dataclass
+class Estimate:
+    units: float
+    images: float
+    seconds: float
+    bytes: float
+
+
+class WorkEstimator:
+    def __init__(self):
+        self.images_per_post = DEFAULT_IMAGES_PER_POST
+        self.seconds_per_unit = DEFAULT_SECONDS_PER_UNIT
+        self.bytes_per_unit = DEFAULT_BYTES_PER_UNIT
+        self._per_subdomain: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def images_for(self, subdomain: str) -> float:
+        with self._lock:
+            return self._per_subdomain.get(subdomain.lower(), self.images_per_post)
+
+    def estimate(self, subdomain: str, posts: int) -> Estimate:
+        images = posts * self.images_for(subdomain)
+        units = posts + IMAGE_WORK_WEIGHT * images
+        return Estimate(
+            units, images, units * self.seconds_per_unit, units * self.bytes_per_unit
+        )
+
+    def observe_post(self, subdomain: str, images: int) -> None:
+        key = subdomain.lower()
+        with self._lock:
+            self.images_per_post = _ema(self.images_per_post, images)
+            self._per_subdomain[key] = _ema(
+                self._per_subdomain.get(key, self.images_per_post), images
+            )
+            self._per_subdomain.move_to_end(key)
+            while len(self._per_subdomain) > MAX_TRACKED_SUBDOMAINS:
+                self._per_subdomain.popitem(last=False)
+
+    def observe_job(self, posts: int, images: int, seconds: float, size: int) -> None:
+        units = posts + IMAGE_WORK_WEIGHT * images
+        if units <= 0:
+            return
+        with self._lock:
+            self.seconds_per_unit = _ema(self.seconds_per_unit, seconds / units)
+            self.bytes_per_unit = _ema(self.bytes_per_unit, size / units)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "images_per_post": round(self.images_per_post, 2),
+                "seconds_per_unit": round(self.seconds_per_unit, 3),
+                "bytes_per_unit": int(self.bytes_per_unit),
+                "newsletters_tracked": len(self._per_subdomain),
+            }
+
+
+class AdmissionController:
+    def __init__(self, data_dir: str = JOB_DATA_DIR):
+        self.data_dir = data_dir
+        self.estimator = WorkEstimator()
+        self._submitted: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def _units(self, candidates: List[Candidate]) -> float:
+        return sum(self.estimator.estimate(c.subdomain, c.posts).units for c in candidates)
+
+    def _wait(self, waiting: List[Candidate], running: List[Candidate]) -> float:
+        """Seconds until queued work has cleared the running slots."""
+        backlog = self._units(waiting) + self._units(running)
+        return backlog * self.estimator.seconds_per_unit / max(1, JOB_MAX_RUNNING)
+
+    def _recent(self, client_id: str, now: float) -> Deque[float]:
+        """Submission times of a client within the quota window."""
+        submitted = self._submitted.get(client_id, deque())
+        while submitted and submitted[0] <= now - QUOTA_WINDOW:
+            submitted.popleft()
+        if not submitted:
+            self._submitted.pop(client_id, None)
+        return submitted
+
+    def _free_disk(self) -> int:
+        os.makedirs(self.data_dir, exist_ok=True)
+        return shutil.disk_usage(self.data_dir).free
+
+    def admit(
+        self,
+        subdomain: str,
+        posts: int,
+        client_id: str,
+        waiting: List[Candidate],
+        running: List[Candidate],
+    ) -> Estimate:
+        """Accept a job of `posts` posts, or raise AdmissionRejected."""
+        if posts > CLIENT_MAX_POSTS:
+            raise AdmissionRejected(
+                413, f"A job may have at most {CLIENT_MAX_POSTS} posts; split the selection"
+            )
+        estimate = self.estimator.estimate(subdomain, posts)
+        now = time.time()
+
+        with self._lock:
+            # Per-client quotas first, so one client's burst is reported to
+            # that client rather than as a server-wide overload
+            mine = [c for c in waiting + running if c.client_id == client_id]
+            recent = self._recent(client_id, now)
+            if len(recent) >= CLIENT_JOBS_PER_HOUR:
+                raise AdmissionRejected(
+                    429,
+                    f"At most {CLIENT_JOBS_PER_HOUR} jobs per hour",
+                    recent[0] + QUOTA_WINDOW - now,
+                )
+            if len(mine) >= CLIENT_MAX_JOBS or sum(c.posts for c in mine) + posts > CLIENT_MAX_POSTS:
+                # Until the client's smallest unfinished job could be done
+                soonest = min(
+                    self.estimator.estimate(c.subdomain, c.posts).seconds for c in mine
+                ) if mine else 0
+                raise AdmissionRejected(
+                    429,
+                    f"Too much work outstanding: at most {CLIENT_MAX_JOBS} jobs and "
+                    f"{CLIENT_MAX_POSTS} posts per client",
+                    soonest,
+                )
+
+            if len(waiting) >= ADMISSION_MAX_QUEUED:
+                per_job = self._wait(waiting, running) / max(1, len(waiting))
+                raise AdmissionRejected(
+                    503,
+                    "Server busy: too many jobs waiting",
+                    per_job * (len(waiting) - ADMISSION_MAX_QUEUED + 1),
+                )
+            wait = self._wait(waiting, running)
+            # An idle queue takes any job, so a job bigger than the whole
+            # budget still runs eventually
+            if waiting and wait + estimate.seconds > ADMISSION_MAX_WAIT:
+                raise AdmissionRejected(
+                    503,
+                    f"Server busy: about {int(wait)}s of queued work",
+                    wait + estimate.seconds - ADMISSION_MAX_WAIT,
+                )
+            if self._free_disk() - estimate.bytes < MIN_FREE_DISK_BYTES:
+                raise AdmissionRejected(503, "Server low on disk space", DISK_RETRY_AFTER)
+
+            recent.append(now)
+            self._submitted[client_id] = recent
+        return estimate
+
+    def quota(self, client_id: str, waiting: List[Candidate], running: List[Candidate]) -> dict:
+        """A client's limits and current usage."""
+        mine = [c for c in waiting + running if c.client_id == client_id]
+        with self._lock:
+            submitted = len(self._recent(client_id, time.time()))
+        return {
+            "jobs": len(mine),
+            "max_jobs": CLIENT_MAX_JOBS,
+            "posts": sum(c.posts for c in mine),
+            "max_posts": CLIENT_MAX_POSTS,
+            "submitted_last_hour": submitted,
+            "max_jobs_per_hour": CLIENT_JOBS_PER_HOUR,
+            "estimated_wait_seconds": int(self._wait(waiting, running)),
+        }
+
+    def stats(self, waiting: List[Candidate], running: List[Candidate]) -> dict:
+        return {
+            "waiting": len(waiting),
+            "running": len(running),
+            "estimated_wait_seconds": int(self._wait(waiting, running)),
+            "free_disk_bytes": self._free_disk(),
+            **self.estimator.stats(),
+        }
+
+
+# Singleton
+admission = AdmissionController()
@@ -0,0 +1,304 @@
+"""
+Persistent per-newsletter archive metadata store.
+
+Post lists are served from SQLite and kept current by incremental refreshes
+that walk the archive newest-first only until a known post id shows up. A
+full walk (reconcile) runs on a much longer TTL to pick up edits and
+deletions deeper in the archive.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from app.services.storage import CACHE_ROOT, connect
+from app.services.substack_async import AsyncSubstackClient
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_STORE_PATH = os.path.join(CACHE_ROOT, "archive.sqlite3")
+# A stored archive older than this is refreshed incrementally before use
+ARCHIVE_REFRESH_TTL = float(os.environ.get("ARCHIVE_REFRESH_TTL", "300"))
+# A full walk of the archive runs in the background once this old
+ARCHIVE_RECONCILE_TTL = float(os.environ.get("ARCHIVE_RECONCILE_TTL", "86400"))
+# Posts per SSE batch when serving from the store
+STORED_BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS newsletters (
+    subdomain TEXT PRIMARY KEY,
+    refreshed_at REAL NOT NULL,
+    reconciled_at REAL
+);
+CREATE TABLE IF NOT EXISTS posts (
+    subdomain TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    post_date TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (subdomain, id)
+);
+CREATE INDEX IF NOT EXISTS posts_by_date ON posts (subdomain, post_date DESC);
+"""
+
+
+@dataclass
+class ArchiveState:
+    refreshed_at: float
+    reconciled_at: Optional[float]
+
+    @property
+    def complete(self) -> bool:
+        """True once a full walk of the archive has finished."""
+        return self.reconciled_at is not None
+
+
+class ArchiveStore:
+    def __init__(self, path: str = ARCHIVE_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = connect(self.path)
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def state(self, subdomain: str) -> Optional[ArchiveState]:
+        with self._lock:
+            row = self._db().execute(
+                "SELECT refreshed_at, reconciled_at FROM newsletters WHERE subdomain = ?",
+                (subdomain,),
+            ).fetchone()
+        return ArchiveState(*row) if row else None
+
+    def get_posts(self, subdomain: str) -> List[dict]:
+        """Stored posts, newest first."""
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT data FROM posts WHERE subdomain = ? ORDER BY post_date DESC, id DESC",
+                (subdomain,),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def known_ids(self, subdomain: str) -> Set[int]:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT id FROM posts WHERE subdomain = ?", (subdomain,)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def upsert(self, subdomain: str, posts: List[dict]) -> None:
+        rows = [
+            (subdomain, p["id"], p.get("post_date") or "", json.dumps(p))
+            for p in posts
+            if p.get("id") is not None
+        ]
+        with self._lock:
+            db = self._db()
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO posts (subdomain, id, post_date, data) "
+                    "VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+
+    def mark_refreshed(self, subdomain: str) -> None:
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    "INSERT INTO newsletters (subdomain, refreshed_at) VALUES (?, ?) "
+                    "ON CONFLICT (subdomain) DO UPDATE SET refreshed_at = excluded.refreshed_at",
+                    (subdomain, time.time()),
+                )
+
+    def mark_reconciled(self, subdomain: str, seen_ids: Set[int]) -> None:
+        """Finish a full walk: drop posts that are gone from the archive."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            with db:
+                stored = {
+                    row[0]
+                    for row in db.execute(
+                        "SELECT id FROM posts WHERE subdomain = ?", (subdomain,)
+                    )
+                }
+                db.executemany(
+                    "DELETE FROM posts WHERE subdomain = ? AND id = ?",
+                    [(subdomain, post_id) for post_id in stored - seen_ids],
+                )
+                db.execute(
+                    "INSERT OR REPLACE INTO newsletters (subdomain, refreshed_at, reconciled_at) "
+                    "VALUES (?, ?, ?)",
+                    (subdomain, now, now),
+                )
+
+
+# Singleton
+archive_store = ArchiveStore()
+
+_refresh_locks: Dict[str, asyncio.Lock] = {}
+_reconcile_tasks: Dict[str, asyncio.Task] = {}
+_walks: Dict[str, "_Walk"] = {}
+
+
+def _refresh_lock(subdomain: str) -> asyncio.Lock:
+    lock = _refresh_locks.get(subdomain)
+    if lock is None:
+        lock = asyncio.Lock()
+        _refresh_locks[subdomain] = lock
+    return lock
+
+
+async def walk_archive(subdomain: str) -> AsyncIterator[List[dict]]:
+    """Full archive walk, persisting each batch as it arrives."""
+    seen: Set[int] = set()
+    async with AsyncSubstackClient(subdomain) as client:
+        async for batch in client.fetch_post_metadata_batches():
+            await asyncio.to_thread(archive_store.upsert, subdomain, batch)
+            seen.update(p["id"] for p in batch if p.get("id") is not None)
+            yield batch
+    await asyncio.to_thread(archive_store.mark_reconciled, subdomain, seen)
+
+
+async def refresh_incremental(subdomain: str) -> List[dict]:
+    """Fetch newest-first pages until a known post shows up. Returns new posts."""
+    known = await asyncio.to_thread(archive_store.known_ids, subdomain)
+    new_posts: List[dict] = []
+    offset = 0
+    async with AsyncSubstackClient(subdomain) as client:
+        while True:
+            page = await client.fetch_archive_page(offset)
+            if not page:
+                break
+            await asyncio.to_thread(archive_store.upsert, subdomain, page)
+            fresh = [p for p in page if p.get("id") not in known]
+            new_posts.extend(fresh)
+            if len(fresh) < len(page):
+                break
+            offset += len(page)
+    await asyncio.to_thread(archive_store.mark_refreshed, subdomain)
+    return new_posts
+
+
+async def _reconcile(subdomain: str):
+    try:
+        async with _refresh_lock(subdomain):
+            async for _ in walk_archive(subdomain):
+                pass
+    except Exception:
+        logger.exception("Archive reconcile failed for %s", subdomain)
+    finally:
+        _reconcile_tasks.pop(subdomain, None)
+
+
+def _maybe_schedule_reconcile(subdomain: str, state: ArchiveState):
+    if state.reconciled_at is None or subdomain in _reconcile_tasks:
+        return
+    if time.time() - state.reconciled_at > ARCHIVE_RECONCILE_TTL:
+        _reconcile_tasks[subdomain] = asyncio.create_task(_reconcile(subdomain))
+
+
+async def get_archive(subdomain: str) -> List[dict]:
+    """All posts of a newsletter, newest first, fetching only what's new."""
+    async with _refresh_lock(subdomain):
+        state = await asyncio.to_thread(archive_store.state, subdomain)
+        if state is None or not state.complete:
+            async for _ in walk_archive(subdomain):
+                pass
+        elif time.time() - state.refreshed_at > ARCHIVE_REFRESH_TTL:
+            await refresh_incremental(subdomain)
+            _maybe_schedule_reconcile(subdomain, state)
+    return await asyncio.to_thread(archive_store.get_posts, subdomain)
+
+
+class _Walk:
+    """A first full walk of an archive, shared by the streams that want it.
+
+    It runs as its own task, so the refresh lock it holds is never held up
+    by a slow reader; each stream follows the batches collected so far.
+    """
+
+    def __init__(self, subdomain: str):
+        self.batches: List[List[dict]] = []
+        self.finished = False
+        # The archive was complete by the time the lock was free
+        self.skipped = False
+        self.error: Optional[BaseException] = None
+        # Set, and replaced, whenever a batch arrives or the walk ends
+        self._update = asyncio.Event()
+        _walks[subdomain] = self
+        self.task = asyncio.create_task(self._run(subdomain))
+
+    def _notify(self):
+        self._update.set()
+        self._update = asyncio.Event()
+
+    async def _run(self, subdomain: str):
+        try:
+            async with _refresh_lock(subdomain):
+                # Another walk may have finished while this one waited
+                state = await asyncio.to_thread(archive_store.state, subdomain)
+                if state is not None and state.complete:
+                    self.skipped = True
+                    return
+                async for batch in walk_archive(subdomain):
+                    self.batches.append(batch)
+                    self._notify()
+        except asyncio.CancelledError:
+            self.error = RuntimeError("Archive walk cancelled")
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            _walks.pop(subdomain, None)
+            self.finished = True
+            self._notify()
+
+    async def follow(self) -> AsyncIterator[List[dict]]:
+        sent = 0
+        while True:
+            update = self._update
+            while sent < len(self.batches):
+                sent += 1
+                yield self.batches[sent - 1]
+            if self.finished:
+                break
+            await update.wait()
+        if self.error is not None:
+            raise self.error
+
+
+async def stream_archive(subdomain: str) -> AsyncIterator[Tuple[List[dict], bool]]:
+    """Yield (posts, prepend) batches: stored posts first, then anything newer.
+
+    prepend is True for posts newer than the ones already sent.
+    """
+    state = await asyncio.to_thread(archive_store.state, subdomain)
+    if state is None or not state.complete:
+        walk = _walks.get(subdomain) or _Walk(subdomain)
+        async for batch in walk.follow():
+            yield batch, False
+        if not walk.skipped:
+            return
+        state = await asyncio.to_thread(archive_store.state, subdomain)
+
+    posts = await asyncio.to_thread(archive_store.get_posts, subdomain)
+    for start in range(0, len(posts), STORED_BATCH_SIZE):
+        yield posts[start:start + STORED_BATCH_SIZE], False
+
+    if time.time() - state.refreshed_at > ARCHIVE_REFRESH_TTL:
+        async with _refresh_lock(subdomain):
+            new_posts = await refresh_incremental(subdomain)
+        if new_posts:
+            yield new_posts, True
+        _maybe_schedule_reconcile(subdomain, state)
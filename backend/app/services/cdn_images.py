@@ -0,0 +1,85 @@
+"""
+Substack image CDN variants.
+
+Post images are served through substackcdn.com's fetch proxy, which resizes
+and re-encodes on the fly from transforms in the URL path:
+
+    https://substackcdn.com/image/fetch/w_1456,c_limit,f_webp,q_auto:good/<origin>
+
+Asking it for an image already fitted to the output profile saves most of the
+bytes of a full-resolution original, with no local CPU spent.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+from typing import List, Optional
+from urllib.parse import quote, unquote, urlparse
+
+from app.services.image_processor import KINDLE_MAX_WIDTH
+
+CDN_VARIANTS = os.environ.get("CDN_VARIANTS", "1") == "1"
+
+CDN_FETCH_PREFIX = "https://substackcdn.com/image/fetch/"
+CDN_FETCH_RE = re.compile(
+    r"^https?://substackcdn\.com/image/fetch/(?P<transforms>[^/]+)/(?P<origin>.+)$"
+)
+# Buckets Substack uploads post images to; these URLs can be proxied too
+ORIGIN_HOSTS = (
+    "substack-post-media.s3.amazonaws.com",
+    "bucketeer-e05bbc84-baa3-437e-9518-adb32be77984.s3.amazonaws.com",
+)
+
+# Re-encoding these would lose animation or vector data
+_PASSTHROUGH_EXTENSIONS = (".gif", ".svg")
+
+
+def _origin_extension(origin: str) -> str:
+    path = urlparse(origin).path.lower()
+    return os.path.splitext(path)[1]
+
+
+def _target_width(transforms: str) -> int:
+    """Never ask for more than the author's own variant already has."""
+    match = re.search(r"(?:^|,)w_(\d+)", transforms)
+    if match:
+        return min(int(match.group(1)), KINDLE_MAX_WIDTH)
+    return KINDLE_MAX_WIDTH
+
+
+def variant_url(url: str) -> Optional[str]:
+    """The CDN URL for url fitted to the output profile, or None to use url as is."""
+    match = CDN_FETCH_RE.match(url)
+    if match:
+        transforms, origin = match.group("transforms"), match.group("origin")
+        origin_url = unquote(origin)
+    elif urlparse(url).netloc.lower() in ORIGIN_HOSTS:
+        transforms, origin_url = "", url
+    else:
+        return None
+
+    ext = _origin_extension(origin_url)
+    if ext in _PASSTHROUGH_EXTENSIONS:
+        return None
+    # PNGs are mostly screenshots and diagrams, which JPEG artefacts ruin
+    fmt = "f_png" if ext == ".png" else "f_jpg"
+
+    params = [
+        f"w_{_target_width(transforms)}",
+        "c_limit",
+        fmt,
+        "q_auto:good",
+        "fl_progressive:steep",
+    ]
+    variant = CDN_FETCH_PREFIX + ",".join(params) + "/" + quote(origin_url, safe="")
+    return variant if variant != url else None
+
+
+def image_candidates(url: str) -> List[str]:
+    """URLs to try for an image, best first; the original is always last."""
+    if CDN_VARIANTS:
+        variant = variant_url(url)
+        if variant:
+            return [variant, url]
+    return [url]
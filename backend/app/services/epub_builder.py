@@ -1,17 +1,48 @@
 """
 EPUB builder — extracted from fetch_all.py's create_epub_with_images.
+
+Images are written into the EPUB as each one arrives and is processed, so a
+post's images are never all held in memory at once.
 """
 
 from __future__ import annotations
 
+import asyncio
 import os
 import re
-from typing import Optional, Tuple
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape
 
 from bs4 import BeautifulSoup
-from ebooklib import epub
+from bs4.element import Tag
 
+from app.services.epub_writer import EpubWriter, published_at
+from app.services.image_processor import process_image_async, process_images
+from app.services.metrics import STAGE_SECONDS
 from app.services.substack import SubstackClient
+from app.services.substack_async import AsyncSubstackClient
+
+# Images are fetched concurrently: IMAGE_CONCURRENCY bounds the pool used for a
+# single post, IMAGE_PER_HOST_LIMIT bounds in-flight requests to any one host
+# across every build running in this process.
+IMAGE_CONCURRENCY = int(os.environ.get("IMAGE_CONCURRENCY", "8"))
+IMAGE_PER_HOST_LIMIT = int(os.environ.get("IMAGE_PER_HOST_LIMIT", "4"))
+
+_host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+_host_semaphores_lock = threading.Lock()
+_async_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+ImageDownload = Tuple[Optional[bytes], Optional[str], Optional[str]]
+
+# Bump whenever a change here or in epub_writer alters the EPUBs produced,
+# so cached EPUBs from the old layout are not reused
+EPUB_LAYOUT_VERSION = 3
 
 EPUB_CSS = b"""
 body {
@@ -59,37 +90,69 @@ def slug_from_title(title: str) -> str:
     return s
 
 
-def build_epub(
-    client: SubstackClient,
-    title: str,
-    author: str,
-    date_str: str,
-    content_soup: BeautifulSoup,
-    output_dir: str,
-    subtitle: Optional[str] = None,
-    slug: str = "post",
-) -> Tuple[str, int]:
-    """
-    Build an EPUB file with embedded images. Returns (filepath, image_count).
+@dataclass
+class EpubBuildResult:
+    path: str
+    image_count: int
+    image_fetch_seconds: float = 0.0
+    # Downloaded vs embedded image bytes, i.e. before and after processing
+    image_bytes_original: int = 0
+    image_bytes_embedded: int = 0
+
+    @property
+    def image_bytes_saved(self) -> int:
+        return self.image_bytes_original - self.image_bytes_embedded
+
+
+def _size(download: ImageDownload) -> int:
+    return len(download[0]) if download[0] is not None else 0
+
+
+def _host_semaphore(url: str) -> threading.BoundedSemaphore:
+    host = urlparse(url).netloc.lower()
+    with _host_semaphores_lock:
+        sem = _host_semaphores.get(host)
+        if sem is None:
+            sem = threading.BoundedSemaphore(IMAGE_PER_HOST_LIMIT)
+            _host_semaphores[host] = sem
+        return sem
+
+
+def _download_limited(client: SubstackClient, src: str) -> ImageDownload:
+    with _host_semaphore(src):
+        return client.download_image(src)
+
+
+def _iter_downloads(client: SubstackClient, srcs: List[str]) -> Iterator[ImageDownload]:
+    """Download images concurrently, yielding them in the order of srcs.
+
+    At most IMAGE_CONCURRENCY downloads are in flight or waiting to be taken,
+    so a post's images are never all in memory at once.
     """
-    book = epub.EpubBook()
-
-    identifier = f"substack-{client.subdomain}-{slug}"
-    book.set_identifier(identifier)
-    book.set_title(title)
-    book.set_language("en")
-    book.add_author(author)
-    book.add_metadata("DC", "date", date_str)
-
-    css = epub.EpubItem(
-        uid="style",
-        file_name="style/default.css",
-        media_type="text/css",
-        content=EPUB_CSS,
-    )
-    book.add_item(css)
+    if not srcs:
+        return
+    workers = max(1, min(IMAGE_CONCURRENCY, len(srcs)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending: Deque[Future] = deque()
+        for src in srcs:
+            pending.append(pool.submit(_download_limited, client, src))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
 
-    # Unwrap <picture> elements
+def _async_host_semaphore(url: str) -> asyncio.Semaphore:
+    host = urlparse(url).netloc.lower()
+    sem = _async_host_semaphores.get(host)
+    if sem is None:
+        sem = asyncio.Semaphore(IMAGE_PER_HOST_LIMIT)
+        _async_host_semaphores[host] = sem
+    return sem
+
+
+def collect_images(content_soup: BeautifulSoup) -> List[Tag]:
+    """Unwrap <picture> elements and return the <img> tags worth embedding."""
     for picture in content_soup.find_all("picture"):
         img = picture.find("img")
         if img:
@@ -100,8 +163,8 @@ def build_epub(
     for source in content_soup.find_all("source"):
         source.decompose()
 
-    # Download and embed images
-    img_count = 0
+    # Skip tracking pixels
+    img_tags = []
     for img_tag in content_soup.find_all("img"):
         src = img_tag.get("src", "")
         if not src:
@@ -116,53 +179,245 @@ def build_epub(
             except (ValueError, OverflowError):
                 pass
 
-        img_data, media_type, ext = client.download_image(src)
-        if img_data is None:
-            img_tag.decompose()
-            continue
+        img_tags.append(img_tag)
+    return img_tags
 
-        img_count += 1
-        img_filename = f"images/img_{img_count:03d}{ext}"
 
-        img_item = epub.EpubItem(
-            uid=f"img_{img_count}",
-            file_name=img_filename,
-            media_type=media_type,
-            content=img_data,
-        )
-        book.add_item(img_item)
+def open_epub(
+    subdomain: str,
+    title: str,
+    author: str,
+    date_str: str,
+    output_dir: str,
+    slug: str = "post",
+    filename: Optional[str] = None,
+    modified: Optional[float] = None,
+) -> EpubWriter:
+    """Start a single-post EPUB with the stylesheet, named filename or after its title.
+
+    modified is the book's dcterms:modified (see EpubWriter); it defaults to
+    the post's date.
+    """
+    filepath = os.path.join(output_dir, filename or f"{slug_from_title(title)}.epub")
+    writer = EpubWriter(
+        path=filepath,
+        identifier=f"substack-{subdomain}-{slug}",
+        title=title,
+        author=author,
+        date=date_str,
+        modified=published_at(date_str) if modified is None else modified,
+    )
+    writer.add_item("style/default.css", EPUB_CSS, "text/css")
+    return writer
+
+
+def embed_image(writer: EpubWriter, index: int, download: ImageDownload) -> Optional[str]:
+    """Write the image for img_tags[index]; returns its href, or None if it failed."""
+    img_data, media_type, ext = download
+    if img_data is None:
+        return None
+    href = f"images/img_{index + 1:03d}{ext}"
+    writer.add_item(href, img_data, media_type)
+    return href
+
+
+def post_html(
+    title: str,
+    date_str: str,
+    content_soup: BeautifulSoup,
+    img_tags: List[Tag],
+    hrefs: List[Optional[str]],
+    subtitle: Optional[str] = None,
+) -> str:
+    """Point img_tags at their embedded hrefs and render the chapter body."""
+    for img_tag, href in zip(img_tags, hrefs):
+        if href is None:
+            img_tag.decompose()
+            continue
 
         alt_text = img_tag.get("alt", "")
         for attr in list(img_tag.attrs.keys()):
             del img_tag[attr]
-        img_tag["src"] = img_filename
+        img_tag["src"] = href
         if alt_text:
             img_tag["alt"] = alt_text
 
-    # Build chapter
-    header_html = f"<h1>{title}</h1>\n"
+    header_html = f"<h1>{escape(title)}</h1>\n"
     if subtitle:
-        header_html += f'<p class="subtitle">{subtitle}</p>\n'
-    header_html += f'<p class="date">{date_str}</p>\n'
+        header_html += f'<p class="subtitle">{escape(subtitle)}</p>\n'
+    header_html += f'<p class="date">{escape(date_str)}</p>\n'
     header_html += "<hr/>\n"
+    return header_html + str(content_soup)
 
-    chapter = epub.EpubHtml(
-        title=title,
-        file_name="content.xhtml",
-        lang="en",
-        content=header_html + str(content_soup),
+
+def finish_epub(
+    writer: EpubWriter,
+    title: str,
+    date_str: str,
+    content_soup: BeautifulSoup,
+    img_tags: List[Tag],
+    hrefs: List[Optional[str]],
+    subtitle: Optional[str] = None,
+) -> EpubBuildResult:
+    """Write the chapter and close the book."""
+    body = post_html(title, date_str, content_soup, img_tags, hrefs, subtitle)
+    writer.add_chapter("content.xhtml", title, body, stylesheets=["style/default.css"])
+    writer.close()
+    return EpubBuildResult(
+        path=writer.path,
+        image_count=sum(1 for href in hrefs if href is not None),
+    )
+
+
+def build_epub(
+    client: SubstackClient,
+    title: str,
+    author: str,
+    date_str: str,
+    content_soup: BeautifulSoup,
+    output_dir: str,
+    subtitle: Optional[str] = None,
+    slug: str = "post",
+    modified: Optional[float] = None,
+) -> EpubBuildResult:
+    """
+    Build an EPUB file with embedded images.
+    """
+    img_tags = collect_images(content_soup)
+    srcs = [tag["src"] for tag in img_tags]
+    writer = open_epub(
+        client.subdomain, title, author, date_str, output_dir, slug, modified=modified
     )
-    chapter.add_item(css)
-    book.add_item(chapter)
+    try:
+        hrefs: List[Optional[str]] = []
+        original = embedded = 0
+        fetch_start = time.monotonic()
+        for i, download in enumerate(_iter_downloads(client, srcs)):
+            processed = process_images([download])[0]
+            original += _size(download)
+            embedded += _size(processed)
+            hrefs.append(embed_image(writer, i, processed))
+        image_fetch_seconds = time.monotonic() - fetch_start
 
-    book.toc = [chapter]
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-    book.spine = ["nav", chapter]
+        result = finish_epub(
+            writer, title, date_str, content_soup, img_tags, hrefs, subtitle
+        )
+    except BaseException:
+        writer.abort()
+        raise
 
-    file_slug = slug_from_title(title)
-    filename = f"{file_slug}.epub"
-    filepath = os.path.join(output_dir, filename)
+    result.image_fetch_seconds = image_fetch_seconds
+    result.image_bytes_original = original
+    result.image_bytes_embedded = embedded
+    return result
+
+
+@dataclass
+class EmbeddedImages:
+    hrefs: List[Optional[str]]
+    fetch_seconds: float
+    bytes_original: int
+    bytes_embedded: int
+
+
+async def embed_images_async(
+    client: AsyncSubstackClient,
+    img_tags: List[Tag],
+    write: Callable[[int, ImageDownload], Optional[str]],
+) -> EmbeddedImages:
+    """Download, process and write each image as soon as it arrives.
+
+    write(index, download) stores one image and returns its href; it runs in
+    a thread, one call at a time, because zipfile is not safe for concurrent
+    writers. If any image fails, the others are cancelled and any write
+    under way has finished before the error propagates, so the caller may
+    abort the book at once.
+    """
+    pool = asyncio.Semaphore(IMAGE_CONCURRENCY)
+    write_lock = asyncio.Lock()
+    # Writes run on in their thread even if fetch() is cancelled
+    writes: List[asyncio.Task] = []
+    sizes = {"original": 0, "embedded": 0}
+
+    async def fetch(i: int, src: str) -> Optional[str]:
+        async with pool:
+            async with _async_host_semaphore(src):
+                with STAGE_SECONDS.time(stage="image_download"):
+                    download = await client.download_image(src)
+            with STAGE_SECONDS.time(stage="image_process"):
+                processed = await process_image_async(download)
+            sizes["original"] += _size(download)
+            sizes["embedded"] += _size(processed)
+            async with write_lock:
+                writing = asyncio.create_task(asyncio.to_thread(write, i, processed))
+                writes.append(writing)
+                return await asyncio.shield(writing)
+
+    fetch_start = time.monotonic()
+    tasks = [asyncio.create_task(fetch(i, tag["src"])) for i, tag in enumerate(img_tags)]
+    try:
+        hrefs = list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, *writes, return_exceptions=True)
+        raise
+    return EmbeddedImages(
+        hrefs=hrefs,
+        fetch_seconds=time.monotonic() - fetch_start,
+        bytes_original=sizes["original"],
+        bytes_embedded=sizes["embedded"],
+    )
+
+
+async def build_epub_async(
+    client: AsyncSubstackClient,
+    title: str,
+    author: str,
+    date_str: str,
+    content_soup: BeautifulSoup,
+    output_dir: str,
+    subtitle: Optional[str] = None,
+    slug: str = "post",
+    filename: Optional[str] = None,
+    modified: Optional[float] = None,
+) -> EpubBuildResult:
+    """
+    build_epub for the asyncio client: each image is downloaded on the event
+    loop, processed in the image process pool and written straight into the
+    book; tree work and zip writes run in a thread.
+    """
+    img_tags = await asyncio.to_thread(collect_images, content_soup)
+    writer = await asyncio.to_thread(
+        open_epub,
+        client.subdomain,
+        title,
+        author,
+        date_str,
+        output_dir,
+        slug,
+        filename,
+        modified,
+    )
+    try:
+        images = await embed_images_async(
+            client, img_tags, lambda i, download: embed_image(writer, i, download)
+        )
+        result = await asyncio.to_thread(
+            finish_epub,
+            writer,
+            title,
+            date_str,
+            content_soup,
+            img_tags,
+            images.hrefs,
+            subtitle,
+        )
+    except BaseException:
+        await asyncio.to_thread(writer.abort)
+        raise
 
-    epub.write_epub(filepath, book)
-    return filepath, img_count
+    result.image_fetch_seconds = images.fetch_seconds
+    result.image_bytes_original = images.bytes_original
+    result.image_bytes_embedded = images.bytes_embedded
+    return result
@@ -0,0 +1,205 @@
+"""
+Persistent cache of finished single-post EPUBs shared across jobs.
+
+Entries are keyed by (subdomain, slug, auth tier, post revision, render
+profile). The revision is a digest of the extracted post, so an edited post
+is rebuilt; the render profile covers the stylesheet and every image setting
+that changes the output. Files are hard-linked into job output where the
+filesystem allows, and the least recently used entries are evicted once the
+cache outgrows its size cap.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from app.services import cdn_images, image_processor
+from app.services.epub_builder import EPUB_CSS, EPUB_LAYOUT_VERSION
+from app.services.storage import CACHE_ROOT, connect
+from app.services.substack import ParsedPost
+
+EPUB_CACHE_DIR = os.path.join(CACHE_ROOT, "epubs")
+EPUB_CACHE_MAX_BYTES = int(os.environ.get("EPUB_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS epubs (
+    key TEXT PRIMARY KEY,
+    subdomain TEXT NOT NULL,
+    slug TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    title TEXT NOT NULL,
+    image_count INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS epubs_last_used ON epubs (last_used);
+"""
+
+
+def post_revision(post: ParsedPost) -> str:
+    """Digest of what a post's EPUB is built from.
+
+    Not of the page: Substack pages embed per-request content (tokens,
+    counters, recommendations), so the page changes on every fetch while
+    the post does not.
+    """
+    parts = [post.title or "", post.subtitle or "", post.author, post.date, str(post.body)]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def render_profile() -> str:
+    """Digest of everything besides the post itself that shapes the EPUB."""
+    parts = [
+        str(EPUB_LAYOUT_VERSION),
+        hashlib.sha256(EPUB_CSS).hexdigest(),
+        str(image_processor.is_enabled()),
+        str(image_processor.KINDLE_MAX_WIDTH),
+        str(image_processor.KINDLE_MAX_HEIGHT),
+        str(image_processor.JPEG_QUALITY),
+        str(image_processor.IMAGE_GRAYSCALE),
+        str(cdn_images.CDN_VARIANTS),
+    ]
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()[:16]
+
+
+def cache_key(subdomain: str, slug: str, tier: str, revision: str) -> str:
+    parts = [subdomain.lower(), slug, tier, revision, render_profile()]
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def link_or_copy(src: str, dest: str) -> None:
+    """Hard-link src to dest, copying when the two are on different filesystems."""
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+@dataclass
+class CachedEpub:
+    path: str
+    filename: str
+    title: str
+    image_count: int
+
+
+class EpubCache:
+    def __init__(self, directory: str = EPUB_CACHE_DIR, max_bytes: int = EPUB_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = connect(os.path.join(self.directory, "index.sqlite3"))
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def _file_path(self, key: str) -> str:
+        return os.path.join(self.directory, "files", key[:2], f"{key}.epub")
+
+    def get(self, key: str) -> Optional[CachedEpub]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT filename, title, image_count FROM epubs WHERE key = ?", (key,)
+            ).fetchone()
+            path = self._file_path(key)
+            if row is None or not os.path.exists(path):
+                if row is not None:
+                    with db:
+                        db.execute("DELETE FROM epubs WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            with db:
+                db.execute(
+                    "UPDATE epubs SET last_used = ? WHERE key = ?", (time.time(), key)
+                )
+            self.hits += 1
+            return CachedEpub(path, *row)
+
+    def put(
+        self,
+        key: str,
+        subdomain: str,
+        slug: str,
+        src_path: str,
+        title: str,
+        image_count: int,
+    ) -> None:
+        if not self.enabled:
+            return
+        path = self._file_path(key)
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            link_or_copy(src_path, tmp_path)
+            os.replace(tmp_path, path)
+            db = self._db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO epubs (key, subdomain, slug, filename, title, "
+                    "image_count, size, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        subdomain,
+                        slug,
+                        os.path.basename(src_path),
+                        title,
+                        image_count,
+                        os.path.getsize(path),
+                        time.time(),
+                    ),
+                )
+            self._evict(db)
+
+    def _evict(self, db) -> None:
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM epubs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = db.execute("SELECT key, size FROM epubs ORDER BY last_used").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            with db:
+                db.execute("DELETE FROM epubs WHERE key = ?", (key,))
+            try:
+                os.remove(self._file_path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self) -> dict:
+        entries, size = 0, 0
+        if self.enabled:
+            with self._lock:
+                entries, size = self._db().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM epubs"
+                ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+# Singleton
+epub_cache = EpubCache()
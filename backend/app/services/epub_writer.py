@@ -0,0 +1,273 @@
+"""
+Streaming EPUB 3 writer.
+
+Members go straight into the zip container as they are added, so a book never
+has to be held in memory: peak usage is the largest single member. The package
+document, NCX and nav are rendered from templates when the book is closed.
+
+Output is reproducible: dcterms:modified and the member timestamps come from
+the `modified` time the caller passes, not the clock, so the same content
+always gives the same bytes.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import time
+import zipfile
+from datetime import datetime, timezone
+from dataclasses import dataclass, field
+from typing import List, Optional
+from xml.sax.saxutils import escape, quoteattr
+
+from lxml import etree
+from lxml import html as lxml_html
+
+from app.services.zip_stream import compress_type
+
+ROOT = "EPUB"
+
+CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+OPF_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id" xml:lang={language}>
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="id">{identifier}</dc:identifier>
+    <dc:title>{title}</dc:title>
+    <dc:language>{language_text}</dc:language>
+    <dc:creator id="creator">{author}</dc:creator>
+{date}    <meta property="dcterms:modified">{modified}</meta>
+  </metadata>
+  <manifest>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+{items}  </manifest>
+  <spine toc="ncx">
+    <itemref idref="nav"/>
+{itemrefs}  </spine>
+</package>
+"""
+
+NCX_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head>
+    <meta name="dtb:uid" content={identifier}/>
+    <meta name="dtb:depth" content="1"/>
+    <meta name="dtb:totalPageCount" content="0"/>
+    <meta name="dtb:maxPageNumber" content="0"/>
+  </head>
+  <docTitle>
+    <text>{title}</text>
+  </docTitle>
+  <navMap>
+{nav_points}  </navMap>
+</ncx>
+"""
+
+NAV_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang={language} xml:lang={language}>
+  <head>
+    <title>{title}</title>
+  </head>
+  <body>
+    <nav epub:type="toc" id="toc" role="doc-toc">
+      <h2>{title}</h2>
+      <ol>
+{entries}      </ol>
+    </nav>
+  </body>
+</html>
+"""
+
+CHAPTER_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang={language} xml:lang={language}>
+  <head>
+    <title>{title}</title>
+{links}  </head>
+  {body}
+</html>
+"""
+
+# dc:date must be W3CDTF; Substack dates are trimmed to YYYY-MM-DD
+_DATE_RE = re.compile(r"^\d{4}(-\d{2}(-\d{2})?)?$")
+# Zip timestamps cannot go back further
+_ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+def published_at(date_str: Optional[str]) -> Optional[float]:
+    """Unix time of a W3CDTF date such as a post's (midnight UTC), or None."""
+    if not date_str or not _DATE_RE.match(date_str):
+        return None
+    parts = [int(part) for part in date_str.split("-")] + [1, 1]
+    try:
+        return datetime(*parts[:3], tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def html_to_xhtml_body(fragment: str) -> str:
+    """Serialize an HTML fragment as a well-formed XHTML <body> element."""
+    body = lxml_html.fragment_fromstring(fragment, create_parent="body")
+    return etree.tostring(body, encoding="unicode", method="xml")
+
+
+@dataclass
+class _Item:
+    id: str
+    href: str
+    media_type: str
+
+
+@dataclass
+class _Chapter:
+    id: str
+    href: str
+    title: str
+
+
+@dataclass
+class EpubWriter:
+    """An EPUB being written member by member; call close() to finish it."""
+
+    path: str
+    identifier: str
+    title: str
+    author: str
+    language: str = "en"
+    date: Optional[str] = None
+    # Unix time recorded as dcterms:modified and on every member: when the
+    # content last changed, e.g. the post's date. None means now, which makes
+    # every build of the same content differ
+    modified: Optional[float] = None
+    _items: List[_Item] = field(default_factory=list, init=False)
+    _chapters: List[_Chapter] = field(default_factory=list, init=False)
+    _hrefs: set = field(default_factory=set, init=False)
+    _zf: Optional[zipfile.ZipFile] = field(default=None, init=False)
+    _date_time: tuple = field(default=_ZIP_EPOCH, init=False)
+
+    def __post_init__(self):
+        if self.modified is None:
+            self.modified = time.time()
+        self._date_time = max(_ZIP_EPOCH, time.gmtime(self.modified)[:6])
+        # Never truncate in place: the old file may be hard-linked elsewhere
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._zf = zipfile.ZipFile(self.path, "w")
+        # The mimetype must come first, stored, with no extra field
+        self._zf.writestr(
+            zipfile.ZipInfo("mimetype"), "application/epub+zip", zipfile.ZIP_STORED
+        )
+        self._write("META-INF/container.xml", CONTAINER_XML.encode("utf-8"))
+
+    def _write(self, arcname: str, data: bytes) -> None:
+        info = zipfile.ZipInfo(arcname, date_time=self._date_time)
+        info.compress_type = compress_type(arcname)
+        self._zf.writestr(info, data)
+
+    def has_item(self, href: str) -> bool:
+        return href in self._hrefs
+
+    def add_item(self, href: str, data: bytes, media_type: str) -> str:
+        """Write a resource (stylesheet, image) and return its manifest id."""
+        if href in self._hrefs:
+            raise ValueError(f"duplicate EPUB member: {href}")
+        item = _Item(id=f"item_{len(self._items) + 1}", href=href, media_type=media_type)
+        self._write(f"{ROOT}/{href}", data)
+        self._items.append(item)
+        self._hrefs.add(href)
+        return item.id
+
+    def add_chapter(
+        self, href: str, title: str, body_html: str, stylesheets: List[str] = ()
+    ) -> str:
+        """Write an XHTML chapter and append it to the spine and TOC."""
+        links = "".join(
+            f'    <link href={quoteattr(css)} rel="stylesheet" type="text/css"/>\n'
+            for css in stylesheets
+        )
+        document = CHAPTER_TEMPLATE.format(
+            language=quoteattr(self.language),
+            title=escape(title),
+            links=links,
+            body=html_to_xhtml_body(body_html),
+        )
+        item_id = self.add_item(href, document.encode("utf-8"), "application/xhtml+xml")
+        self._chapters.append(_Chapter(id=item_id, href=href, title=title))
+        return item_id
+
+    def _package_document(self) -> str:
+        date = ""
+        if self.date and _DATE_RE.match(self.date):
+            date = f"    <dc:date>{self.date}</dc:date>\n"
+        items = "".join(
+            f"    <item id={quoteattr(item.id)} href={quoteattr(item.href)} "
+            f"media-type={quoteattr(item.media_type)}/>\n"
+            for item in self._items
+        )
+        itemrefs = "".join(
+            f"    <itemref idref={quoteattr(chapter.id)}/>\n" for chapter in self._chapters
+        )
+        return OPF_TEMPLATE.format(
+            language=quoteattr(self.language),
+            language_text=escape(self.language),
+            identifier=escape(self.identifier),
+            title=escape(self.title),
+            author=escape(self.author),
+            date=date,
+            modified=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.modified)),
+            items=items,
+            itemrefs=itemrefs,
+        )
+
+    def _ncx(self) -> str:
+        nav_points = "".join(
+            f'    <navPoint id="nav_{n}" playOrder="{n}">\n'
+            f"      <navLabel><text>{escape(chapter.title)}</text></navLabel>\n"
+            f"      <content src={quoteattr(chapter.href)}/>\n"
+            f"    </navPoint>\n"
+            for n, chapter in enumerate(self._chapters, start=1)
+        )
+        return NCX_TEMPLATE.format(
+            identifier=quoteattr(self.identifier),
+            title=escape(self.title),
+            nav_points=nav_points,
+        )
+
+    def _nav(self) -> str:
+        entries = "".join(
+            f"        <li><a href={quoteattr(chapter.href)}>{escape(chapter.title)}</a></li>\n"
+            for chapter in self._chapters
+        )
+        return NAV_TEMPLATE.format(
+            language=quoteattr(self.language),
+            title=escape(self.title),
+            entries=entries,
+        )
+
+    def close(self) -> None:
+        if self._zf is None:
+            return
+        try:
+            self._write(f"{ROOT}/toc.ncx", self._ncx().encode("utf-8"))
+            self._write(f"{ROOT}/nav.xhtml", self._nav().encode("utf-8"))
+            self._write(f"{ROOT}/content.opf", self._package_document().encode("utf-8"))
+        finally:
+            self._zf.close()
+            self._zf = None
+
+    def abort(self) -> None:
+        """Close without finishing and remove the partial file."""
+        if self._zf is not None:
+            self._zf.close()
+            self._zf = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,96 @@
+"""
+Bounded, replayable job event logs.
+
+Each job keeps its last EVENT_LOG_SIZE events, numbered by a sequence id
+that is sent as the SSE `id:` field. Subscribers are only a cursor into the
+log, so a watcher costs the same whether it keeps up or has stalled, and a
+reconnecting browser replays everything after its Last-Event-ID. A cursor
+that fell off the start of the log still replays everything the log kept,
+with a status snapshot standing in for the progress events lost.
+
+Progress events are coalesced twice: consecutive ones replace each other in
+the log, and a consumer reading a backlog only gets the last progress
+before each later progress or status event.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+# Events kept per job for replay
+EVENT_LOG_SIZE = int(os.environ.get("EVENT_LOG_SIZE", "512"))
+# Seconds between SSE keep-alive comments on an idle stream
+SSE_PING_INTERVAL = int(os.environ.get("SSE_PING_INTERVAL", "15"))
+# Seconds a client may take to accept one event before it is disconnected
+SSE_SEND_TIMEOUT = float(os.environ.get("SSE_SEND_TIMEOUT", "30"))
+
+# Events superseded by any later event of one of these kinds
+_SUPERSEDED_BY = {"progress": ("progress", "status")}
+
+Event = Tuple[int, str, dict]
+
+
+def coalesce(events: List[Event]) -> List[Event]:
+    """Drop events a later event in the batch makes redundant."""
+    kept: List[Event] = []
+    seen = set()
+    for seq, event, data in reversed(events):
+        if any(kind in seen for kind in _SUPERSEDED_BY.get(event, ())):
+            continue
+        seen.add(event)
+        kept.append((seq, event, data))
+    kept.reverse()
+    return kept
+
+
+def resync(events: List[Event], seq: int, snapshot: dict) -> List[Event]:
+    """Replay for a cursor at seq whose next events were evicted.
+
+    Every retained event is kept but progress, which the status snapshot
+    supersedes; the snapshot comes after them, so an older status replayed
+    never has the last word, and before "done".
+    """
+    done = [e for e in events if e[1] == "done"]
+    rest = [e for e in events if e[1] != "done"]
+    if rest and rest[-1][1] == "status":
+        # Nothing happened since: that status is as current as a snapshot
+        return coalesce(events)
+    status = (rest[-1][0] if rest else seq, "status", snapshot)
+    return coalesce(rest + [status]) + done
+
+
+class EventLog:
+    def __init__(self, size: int = EVENT_LOG_SIZE):
+        self.seq = 0
+        # Highest seq pushed out of the log by newer events
+        self.evicted = 0
+        self._events: Deque[Event] = deque(maxlen=size)
+        self._waiter: Optional[asyncio.Future] = None
+
+    def append(self, event: str, data: dict) -> int:
+        if event == "progress" and self._events and self._events[-1][1] == "progress":
+            self._events.pop()
+        elif len(self._events) == self._events.maxlen:
+            self.evicted = self._events[0][0]
+        self.seq += 1
+        self._events.append((self.seq, event, data))
+        if self._waiter is not None:
+            if not self._waiter.done():
+                self._waiter.set_result(None)
+            self._waiter = None
+        return self.seq
+
+    def after(self, seq: int) -> Tuple[List[Event], bool]:
+        """Events newer than seq, and whether some were already evicted."""
+        events = [e for e in self._events if e[0] > seq]
+        return events, seq < self.evicted
+
+    async def wait(self, seq: int) -> None:
+        """Return once there is an event newer than seq."""
+        while self.seq <= seq:
+            if self._waiter is None:
+                self._waiter = asyncio.get_running_loop().create_future()
+            await asyncio.shield(self._waiter)
@@ -0,0 +1,47 @@
+"""
+HTML parser backend used for post extraction.
+
+HTML_PARSER selects BeautifulSoup's tree builder: "html.parser" (pure Python,
+always available) or "lxml" (C, noticeably cheaper on large pages). If lxml
+is requested but not installed, extraction falls back to html.parser.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+
+from bs4 import BeautifulSoup
+
+logger = logging.getLogger(__name__)
+
+PARSER_BACKENDS = ("html.parser", "lxml")
+PARSER_BACKEND = os.environ.get("HTML_PARSER", "html.parser")
+
+try:
+    import lxml  # noqa: F401
+
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+_warned = False
+
+
+def parser_features() -> str:
+    """The BeautifulSoup features string for the configured backend."""
+    global _warned
+    if PARSER_BACKEND not in PARSER_BACKENDS:
+        raise ValueError(
+            f"Unknown HTML_PARSER {PARSER_BACKEND!r}; expected one of {PARSER_BACKENDS}"
+        )
+    if PARSER_BACKEND == "lxml" and not HAS_LXML:
+        if not _warned:
+            logger.warning("HTML_PARSER=lxml but lxml is not installed; using html.parser")
+            _warned = True
+        return "html.parser"
+    return PARSER_BACKEND
+
+
+def make_soup(html: str) -> BeautifulSoup:
+    return BeautifulSoup(html, parser_features())
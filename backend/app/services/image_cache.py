@@ -0,0 +1,164 @@
+"""
+Persistent, content-addressed image cache shared across jobs.
+
+Image bytes are stored once per SHA-256 digest under ``blobs/``; an SQLite
+index maps normalized image URLs to digests. When the stored bytes exceed
+the size cap, the least recently used blobs are evicted.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from typing import Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from app.services.storage import CACHE_ROOT, connect
+
+IMAGE_CACHE_DIR = os.path.join(CACHE_ROOT, "images")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_MB", "1024")) * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    ext TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used);
+"""
+
+
+def normalize_url(url: str) -> str:
+    """Canonical cache key for an image URL: lowercase host, sorted query, no fragment."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower() or "https"
+    netloc = parts.netloc.lower()
+    if scheme == "https" and netloc.endswith(":443"):
+        netloc = netloc[:-4]
+    elif scheme == "http" and netloc.endswith(":80"):
+        netloc = netloc[:-3]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path, query, ""))
+
+
+class ImageCache:
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = connect(os.path.join(self.directory, "index.sqlite3"))
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.directory, "blobs", digest[:2], digest)
+
+    def get(self, url: str) -> Optional[Tuple[bytes, str, str]]:
+        """Return (content_bytes, media_type, extension) for a cached URL, or None."""
+        if not self.enabled:
+            return None
+        key = normalize_url(url)
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT digest, media_type, ext FROM urls WHERE url = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            digest, media_type, ext = row
+            try:
+                with open(self._blob_path(digest), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                # Evicted by another process; drop the stale mapping
+                with db:
+                    db.execute("DELETE FROM urls WHERE digest = ?", (digest,))
+                    db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                self.misses += 1
+                return None
+            with db:
+                db.execute(
+                    "UPDATE blobs SET last_used = ? WHERE digest = ?",
+                    (time.time(), digest),
+                )
+            self.hits += 1
+            return data, media_type, ext
+
+    def put(self, url: str, data: bytes, media_type: str, ext: str) -> None:
+        if not self.enabled or not data:
+            return
+        key = normalize_url(url)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        with self._lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            db = self._db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO blobs (digest, size, last_used) VALUES (?, ?, ?)",
+                    (digest, len(data), time.time()),
+                )
+                db.execute(
+                    "INSERT OR REPLACE INTO urls (url, digest, media_type, ext) VALUES (?, ?, ?, ?)",
+                    (key, digest, media_type, ext),
+                )
+            self._evict(db)
+
+    def _evict(self, db) -> None:
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = db.execute("SELECT digest, size FROM blobs ORDER BY last_used").fetchall()
+        for digest, size in rows:
+            if total <= self.max_bytes:
+                break
+            with db:
+                db.execute("DELETE FROM urls WHERE digest = ?", (digest,))
+                db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            try:
+                os.remove(self._blob_path(digest))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self) -> dict:
+        entries, size = 0, 0
+        if self.enabled:
+            with self._lock:
+                entries, size = self._db().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs"
+                ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+# Singleton
+image_cache = ImageCache()
@@ -0,0 +1,189 @@
+"""
+Kindle-oriented image processing: downscale, re-encode and strip metadata.
+
+Runs in a process pool so CPU-heavy decoding never competes with the event
+loop. Requires Pillow; without it images are embedded unchanged.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from app.services.metrics import IMAGE_POOL_INFLIGHT
+
+try:
+    from PIL import ExifTags, Image, ImageOps
+
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+IMAGE_PROCESSING = os.environ.get("IMAGE_PROCESSING", "1") == "1"
+KINDLE_MAX_WIDTH = int(os.environ.get("KINDLE_MAX_WIDTH", "1072"))
+KINDLE_MAX_HEIGHT = int(os.environ.get("KINDLE_MAX_HEIGHT", "1448"))
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", "80"))
+IMAGE_GRAYSCALE = os.environ.get("IMAGE_GRAYSCALE", "0") == "1"
+IMAGE_PROCESS_WORKERS = int(os.environ.get("IMAGE_PROCESS_WORKERS", str(os.cpu_count() or 2)))
+
+# Fewer distinct colours than this and a PNG is treated as a graphic, not a photo
+PHOTO_MIN_COLORS = 256
+
+# Image.info keys that carry metadata rather than anything needed to render
+METADATA_KEYS = ("exif", "icc_profile", "xmp", "XML:com.adobe.xmp", "photoshop", "comment")
+
+# JPEG segments dropped when stripping: APP1 (EXIF, XMP), APP2 (ICC), APP13
+# (IPTC) and comments. APP0 and APP14 stay, decoders rely on them
+JPEG_METADATA_MARKERS = frozenset((0xE1, 0xE2, 0xED, 0xFE))
+
+ImageDownload = Tuple[Optional[bytes], Optional[str], Optional[str]]
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def is_enabled() -> bool:
+    return IMAGE_PROCESSING and HAS_PIL
+
+
+def _is_photo(img: "Image.Image") -> bool:
+    return img.getcolors(PHOTO_MIN_COLORS) is None
+
+
+def _flatten(img: "Image.Image") -> "Image.Image":
+    """Composite transparency onto white; Kindles render on a white page anyway."""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img
+
+
+def _has_metadata(img: "Image.Image") -> bool:
+    # PNG text chunks (descriptions, XMP) are only listed in img.text
+    return any(key in img.info for key in METADATA_KEYS) or bool(getattr(img, "text", None))
+
+
+def _strip_jpeg_metadata(data: bytes) -> bytes:
+    """Drop the metadata segments of a JPEG without re-encoding it."""
+    if data[:2] != b"\xff\xd8":
+        return data
+    out = [data[:2]]
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker == 0xDA:
+            # Start of scan: the rest is image data
+            break
+        length = int.from_bytes(data[pos + 2 : pos + 4], "big")
+        if marker not in JPEG_METADATA_MARKERS:
+            out.append(data[pos : pos + 2 + length])
+        pos += 2 + length
+    out.append(data[pos:])
+    return b"".join(out)
+
+
+def _save_png(img: "Image.Image") -> Tuple[bytes, str, str]:
+    if IMAGE_GRAYSCALE:
+        img = _flatten(img).convert("L")
+    elif img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+        img = img.convert("RGBA")
+    out = io.BytesIO()
+    # PNG keeps the source's ICC profile unless told otherwise
+    img.save(out, "PNG", optimize=True, icc_profile=None)
+    return out.getvalue(), "image/png", ".png"
+
+
+def process_image(data: bytes, media_type: str, ext: str) -> Tuple[bytes, str, str]:
+    """Orient, downscale and re-encode one image. Returns the original if nothing helps."""
+    if media_type == "image/svg+xml":
+        return data, media_type, ext
+    try:
+        img = Image.open(io.BytesIO(data))
+        if getattr(img, "is_animated", False):
+            return data, media_type, ext
+        img.load()
+        has_metadata = _has_metadata(img)
+        # Re-encoding drops EXIF, so its orientation is applied to the pixels
+        # first; otherwise phone photos come out sideways
+        rotated = img.getexif().get(ExifTags.Base.Orientation, 1) != 1
+        if rotated:
+            img = ImageOps.exif_transpose(img)
+    except Exception:
+        return data, media_type, ext
+
+    resized = img.width > KINDLE_MAX_WIDTH or img.height > KINDLE_MAX_HEIGHT
+    if resized:
+        img.thumbnail((KINDLE_MAX_WIDTH, KINDLE_MAX_HEIGHT), Image.LANCZOS)
+
+    # Older Kindles cannot render WebP at all; PNG photos are far smaller as JPEG
+    must_convert = media_type == "image/webp"
+    to_jpeg = must_convert or media_type == "image/jpeg" or _is_photo(img)
+
+    if to_jpeg:
+        out = io.BytesIO()
+        jpeg = _flatten(img).convert("L" if IMAGE_GRAYSCALE else "RGB")
+        # Saving without exif/icc_profile strips the metadata
+        jpeg.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+        result = (out.getvalue(), "image/jpeg", ".jpg")
+    else:
+        result = _save_png(img)
+
+    # Re-encoding saved nothing, so the original pixels are kept, but never
+    # its metadata: EXIF can carry the GPS position a photo was taken at.
+    # Not if it relies on EXIF orientation, which Kindles ignore
+    if len(result[0]) >= len(data) and not (
+        must_convert or resized or rotated or IMAGE_GRAYSCALE
+    ):
+        if not has_metadata:
+            return data, media_type, ext
+        if media_type == "image/jpeg":
+            return _strip_jpeg_metadata(data), media_type, ext
+        if to_jpeg:
+            # A lossless copy rather than a JPEG larger than the original
+            return _save_png(img)
+    return result
+
+
+def _pool_executor() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=max(1, IMAGE_PROCESS_WORKERS))
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+def process_images(downloads: List[ImageDownload]) -> List[ImageDownload]:
+    """Process downloaded images in the pool, keeping order and failed slots."""
+    if not is_enabled():
+        return downloads
+    pool = _pool_executor()
+    futures = [
+        pool.submit(process_image, *download) if download[0] is not None else None
+        for download in downloads
+    ]
+    return [
+        future.result() if future is not None else download
+        for future, download in zip(futures, downloads)
+    ]
+
+
+async def process_image_async(download: ImageDownload) -> ImageDownload:
+    """Process one downloaded image in the pool without blocking the event loop."""
+    if not is_enabled() or download[0] is None:
+        return download
+    loop = asyncio.get_running_loop()
+    IMAGE_POOL_INFLIGHT.inc()
+    try:
+        return await loop.run_in_executor(_pool_executor(), process_image, *download)
+    finally:
+        IMAGE_POOL_INFLIGHT.dec()
@@ -1,23 +1,72 @@
 """
 Background job orchestration for EPUB generation with SSE progress events.
+
+Jobs wait in a queue until the scheduler (app.services.scheduler) admits
+them. With WORKER_MODE=inline (the default) they run inside the API process. With
+WORKER_MODE=queue the API only enqueues jobs in the job store; `python -m
+app.worker` processes claim and run them, and the API tails the events they
+record to serve SSE.
 """
 
 from __future__ import annotations
 
 import asyncio
+import functools
+import logging
 import os
 import shutil
-import tempfile
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import Optional, List, Dict
-
-from bs4 import BeautifulSoup
-
-from app.services.substack import SubstackClient
-from app.services.epub_builder import build_epub
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional, List, Dict, Set, Tuple, Union
+
+from app.services.admission import admission
+from app.services.substack import ParsedPost, SubstackClient
+from app.services.substack_async import AsyncSubstackClient
+from app.services.epub_builder import (
+    build_epub_async,
+    collect_images,
+    embed_images_async,
+    post_html,
+    slug_from_title,
+)
+from app.services.epub_cache import cache_key, epub_cache, link_or_copy, post_revision
+from app.services.epub_writer import published_at
+from app.services.event_log import Event, EventLog, coalesce, resync
+from app.services.job_profiler import ARTIFACTS, JobProfiler
+from app.services.job_store import (
+    JOB_DATA_DIR,
+    POST_DONE,
+    POST_FAILED,
+    POST_SKIPPED,
+    JobRecord,
+    JobStore,
+    PostCheckpoint,
+    job_store,
+)
+from app.services.metrics import JOB_SECONDS, JOBS, POSTS, STAGE_SECONDS
+from app.services.omnibus import Omnibus, book_key
+from app.services.post_cache import auth_tier
+from app.services.scheduler import Candidate, pick_next, queue_positions
+from app.services.zip_stream import IncrementalZip
+
+logger = logging.getLogger(__name__)
+
+# Posts processed at once by each pipeline stage (fetch, parse, write) of a job
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", "4"))
+# Post pages fetched at once from one newsletter, across all jobs
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", "4"))
+# Omnibus posts started ahead of the oldest one not yet in the book. Chapters
+# wait in memory for every earlier post, so this bounds what one slow post
+# makes the job hold
+OMNIBUS_WINDOW = int(os.environ.get("OMNIBUS_WINDOW", str(4 * JOB_CONCURRENCY)))
+# "inline": jobs run in the API process; "queue": worker processes run them
+WORKER_MODE = os.environ.get("WORKER_MODE", "inline")
+# How often the API polls the job store for events recorded by workers
+EVENT_POLL_INTERVAL = 0.25
 
 
 class JobStatus(str, Enum):
@@ -33,6 +82,16 @@ class Job:
     subdomain: str
     slugs: List[str]
     session_cookie: Optional[str] = None
+    # Cookies are never persisted: a restored job only knows it had one
+    had_cookie: bool = False
+    # Who asked for the job, for per-client scheduling caps
+    client_id: str = ""
+    # One anthology EPUB (or one per year) instead of one EPUB per post
+    omnibus: bool = False
+    split_by_year: bool = False
+    # Run under the profiler (app.services.job_profiler): True, or
+    # "allocations" to trace memory as well
+    profile: Union[bool, str] = False
     status: JobStatus = JobStatus.PENDING
     progress: int = 0
     total: int = 0
@@ -41,12 +100,30 @@ class Job:
     output_dir: Optional[str] = None
     zip_path: Optional[str] = None
     epub_paths: List[str] = field(default_factory=list)
+    image_bytes_saved: int = 0
+    failed: int = 0
+    # 1-based place in the scheduler's queue while the job waits to start
+    queue_position: Optional[int] = None
+    # Seconds spent per stage, summed over posts (so concurrent posts can
+    # add up to more than the job's wall time, which is "total")
+    stage_seconds: Dict[str, float] = field(default_factory=dict)
+    # Profile files written next to the ZIP, for profiled jobs
+    artifacts: List[str] = field(default_factory=list)
+    # Posts already finished before a restart, by slug position
+    checkpoints: Dict[int, PostCheckpoint] = field(default_factory=dict)
     created_at: float = field(default_factory=time.time)
-    sse_queues: List[asyncio.Queue] = field(default_factory=list)
+    # When the job completed or failed; JOB_TTL counts from here
+    finished_at: Optional[float] = None
+    events: EventLog = field(default_factory=EventLog, repr=False)
+    # Called with every event; workers use it to record events in the store
+    event_sink: Optional[Callable[["Job", str, dict], None]] = field(
+        default=None, repr=False
+    )
 
     def push_event(self, event: str, data: dict):
-        for q in self.sse_queues:
-            q.put_nowait({"event": event, "data": data})
+        self.events.append(event, data)
+        if self.event_sink is not None:
+            self.event_sink(self, event, data)
 
     def status_dict(self) -> dict:
         return {
@@ -56,115 +133,827 @@ class Job:
             "total": self.total,
             "current_post": self.current_post,
             "error": self.error,
+            "image_bytes_saved": self.image_bytes_saved,
+            "failed": self.failed,
+            "queue_position": self.queue_position,
+            "stage_seconds": (
+                {stage: round(s, 3) for stage, s in self.stage_seconds.items()}
+                if self.status in (JobStatus.COMPLETED, JobStatus.FAILED)
+                else None
+            ),
+            "artifacts": self.artifacts,
         }
 
+    def record_stage(self, stage: str, seconds: float):
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+        if stage != "total":
+            STAGE_SECONDS.observe(seconds, stage=stage)
+
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start)
+
+
+def _epub_filenames(slugs: List[str]) -> List[str]:
+    """A distinct EPUB file name for each slug position, made from the slug.
+
+    Not from the title: titles repeat ("Open Thread") and posts are written
+    concurrently, so two posts must never share a path.
+    """
+    names: List[str] = []
+    taken: Set[str] = set()
+    for slug in slugs:
+        base = slug_from_title(slug) or "post"
+        name, n = base, 1
+        while name in taken:
+            n += 1
+            name = f"{base}-{n}"
+        taken.add(name)
+        names.append(f"{name}.epub")
+    return names
+
+
+def _log_failed_write(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Recording a job event failed", exc_info=future.exception())
+
+
+def _dir_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+async def _run_stage(
+    workers: int,
+    handle: Callable[..., Awaitable[Optional[tuple]]],
+    inbox: asyncio.Queue,
+    outbox: Optional[asyncio.Queue],
+):
+    """Run `workers` consumers of inbox until each sees a None sentinel.
+
+    Non-None results are forwarded to outbox, followed by one sentinel per
+    worker once the whole stage has drained.
+    """
+
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is None:
+                return
+            result = await handle(*item)
+            if result is not None and outbox is not None:
+                await outbox.put(result)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    if outbox is not None:
+        for _ in range(workers):
+            await outbox.put(None)
+
 
 class JobManager:
     JOB_TTL = 3600  # 1 hour
 
-    def __init__(self):
+    def __init__(self, store: JobStore = job_store, queued: bool = WORKER_MODE == "queue"):
         self.jobs: Dict[str, Job] = {}
+        self.store = store
+        # Jobs are run by worker processes rather than by this manager
+        self.queued = queued
         self._cleanup_task: Optional[asyncio.Task] = None
+        self._upstream_limits: Dict[str, asyncio.Semaphore] = {}
+        self._waiting: Dict[str, Job] = {}
+        self._running: Dict[str, Job] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        # Job row updates and recorded events, written one at a time in the
+        # order they were made, so a late progress snapshot never lands
+        # after the final status
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+
+    def create_job(self, *args, **kwargs) -> Job:
+        """Create a job (arguments as for _new_job) and record it in the store."""
+        job = self._new_job(*args, **kwargs)
+        self._record(job)
+        if not self.queued:
+            self.jobs[job.id] = job
+        return job
+
+    async def create_job_async(self, *args, **kwargs) -> Job:
+        """create_job() for request handlers; the directory and the store row
+        are written in a thread."""
+        job = self._new_job(*args, **kwargs)
+        await asyncio.to_thread(self._record, job)
+        if not self.queued:
+            self.jobs[job.id] = job
+        return job
 
-    def create_job(
+    def _new_job(
         self,
         subdomain: str,
         slugs: List[str],
         session_cookie: Optional[str] = None,
+        omnibus: bool = False,
+        split_by_year: bool = False,
+        client_id: str = "",
+        profile: Union[bool, str] = False,
     ) -> Job:
         job_id = uuid.uuid4().hex[:12]
-        output_dir = tempfile.mkdtemp(prefix=f"stk_{job_id}_")
-        job = Job(
+        output_dir = os.path.join(JOB_DATA_DIR, job_id)
+        return Job(
             id=job_id,
             subdomain=subdomain,
             slugs=slugs,
             session_cookie=session_cookie,
+            had_cookie=bool(session_cookie),
+            client_id=client_id,
+            omnibus=omnibus,
+            split_by_year=split_by_year,
+            profile=profile,
             total=len(slugs),
             output_dir=output_dir,
         )
-        self.jobs[job_id] = job
-        return job
+
+    def _record(self, job: Job):
+        """Create the job's directory and its row in the store."""
+        os.makedirs(job.output_dir, exist_ok=True)
+        self.store.create(
+            job.id,
+            job.subdomain,
+            job.slugs,
+            {"omnibus": job.omnibus, "split_by_year": job.split_by_year, "profile": job.profile},
+            job.had_cookie,
+            job.status.value,
+            job.output_dir,
+            job.created_at,
+            # A worker needs the cookie; it is cleared from the row on claim
+            job.session_cookie if self.queued else None,
+            job.client_id,
+        )
+
+    def submit(self, job: Job):
+        """Queue a created job here, or leave it in the store for a worker."""
+        if not self.queued:
+            self._waiting[job.id] = job
+            self._dispatch()
+
+    @staticmethod
+    def _candidate(job: Job) -> Candidate:
+        return Candidate(job.id, job.subdomain, job.client_id, job.total, job.created_at)
+
+    def _dispatch(self):
+        """Start every waiting job the caps allow, then refresh queue positions."""
+        while True:
+            running = [self._candidate(job) for job in self._running.values()]
+            chosen = pick_next(
+                [self._candidate(job) for job in self._waiting.values()], running
+            )
+            if chosen is None:
+                break
+            job = self._waiting.pop(chosen.job_id)
+            job.queue_position = None
+            self._running[job.id] = job
+            task = asyncio.create_task(self._run_scheduled(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        positions = queue_positions(
+            [self._candidate(job) for job in self._waiting.values()],
+            [self._candidate(job) for job in self._running.values()],
+        )
+        for job in self._waiting.values():
+            if positions[job.id] != job.queue_position:
+                job.queue_position = positions[job.id]
+                job.push_event("queued", job.status_dict())
+
+    def workload(self) -> Tuple[List[Candidate], List[Candidate]]:
+        """Unfinished jobs as (waiting, running), for admission control.
+
+        Running jobs count only the posts they have left.
+        """
+        if self.queued:
+            return self.store.candidates()
+        waiting = [self._candidate(job) for job in self._waiting.values()]
+        running = []
+        for job in self._running.values():
+            candidate = self._candidate(job)
+            candidate.posts = max(0, job.total - job.progress)
+            running.append(candidate)
+        return waiting, running
+
+    async def workload_async(self) -> Tuple[List[Candidate], List[Candidate]]:
+        """workload() for request handlers; queue mode reads the store in a thread."""
+        if self.queued:
+            return await asyncio.to_thread(self.workload)
+        return self.workload()
+
+    async def _run_scheduled(self, job: Job):
+        try:
+            await self.run_job(job)
+        finally:
+            self._running.pop(job.id, None)
+            self._dispatch()
 
     def get_job(self, job_id: str) -> Optional[Job]:
+        if self.queued:
+            record = self.store.load(job_id)
+            if record is None:
+                return None
+            job = self._job_from_record(record)
+            if job.status == JobStatus.PENDING:
+                job.queue_position = queue_positions(*self.store.candidates()).get(job.id)
+            return job
         return self.jobs.get(job_id)
 
-    async def run_job(self, job: Job):
-        job.status = JobStatus.RUNNING
-        job.push_event("status", job.status_dict())
+    async def get_job_async(self, job_id: str) -> Optional[Job]:
+        """get_job() for request handlers; queue mode reads the store in a thread."""
+        if self.queued:
+            return await asyncio.to_thread(self.get_job, job_id)
+        return self.get_job(job_id)
+
+    async def stream(self, job: Job, last_event_id: Optional[int] = None) -> AsyncIterator[Event]:
+        """The job's events as (id, event, data), up to and including "done".
+
+        Without last_event_id the stream starts with a status snapshot;
+        with it, events after that id are replayed first.
+        """
+        if self.queued:
+            async for item in self._tail(job, last_event_id):
+                yield item
+            return
+        log = job.events
+        seq = last_event_id
+        # An id from before a restart means nothing to this log
+        if seq is None or seq > log.seq:
+            seq = log.seq
+            yield seq, "status", job.status_dict()
+            if job.status in (JobStatus.COMPLETED, JobStatus.FAILED):
+                yield seq, "done", {}
+                return
+        while True:
+            events, missed = log.after(seq)
+            if missed:
+                events = resync(events, seq, job.status_dict())
+            if events:
+                seq = events[-1][0]
+            for item in coalesce(events):
+                yield item
+                if item[1] == "done":
+                    return
+            await log.wait(seq)
+
+    async def _tail(self, job: Job, last_event_id: Optional[int]) -> AsyncIterator[Event]:
+        """stream() for jobs run by workers: poll the events they record.
+
+        Until a worker starts the job, queue position changes are reported
+        as "queued" events, as the in-process scheduler does.
+        """
+        seq = last_event_id
+        if seq is None:
+            seq = await asyncio.to_thread(self.store.last_event_seq, job.id)
+            yield seq, "status", job.status_dict()
+            if job.status in (JobStatus.COMPLETED, JobStatus.FAILED):
+                yield seq, "done", {}
+                return
+        started = job.status != JobStatus.PENDING
+        position = job.queue_position
+        while True:
+            events, missed = await asyncio.to_thread(self.store.events_after, job.id, seq)
+            if missed:
+                current = await asyncio.to_thread(self.get_job, job.id)
+                if current is not None:
+                    events = resync(events, seq, current.status_dict())
+            if events:
+                seq = events[-1][0]
+                started = True
+            for item in coalesce(events):
+                yield item
+                if item[1] == "done":
+                    return
+            if not started:
+                current = await asyncio.to_thread(self.get_job, job.id)
+                if current is None or current.status != JobStatus.PENDING:
+                    started = True
+                elif current.queue_position != position:
+                    position = current.queue_position
+                    yield seq, "queued", current.status_dict()
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+    def persist_event(self, job: Job, event: str, data: dict):
+        """Event sink for workers: record the event and the job's progress.
+
+        The write is queued behind earlier ones rather than awaited; the job
+        is snapshotted now, as it was when the event happened.
+        """
+        fields = None
+        if event in ("progress", "status"):
+            fields = dict(
+                status=job.status.value,
+                progress=job.progress,
+                current_post=job.current_post,
+                failed=job.failed,
+                epub_paths=list(job.epub_paths),
+                image_bytes_saved=job.image_bytes_saved,
+                stage_seconds=dict(job.stage_seconds),
+            )
+        self._write(self._record_event, job.id, event, data, fields).add_done_callback(
+            _log_failed_write
+        )
 
-        client = SubstackClient(job.subdomain, job.session_cookie)
-        epub_files: List[str] = []
+    def _record_event(self, job_id: str, event: str, data: dict, fields: Optional[dict]):
+        self.store.append_event(job_id, event, data)
+        if fields is not None:
+            self.store.update(job_id, **fields)
 
-        try:
-            for i, slug in enumerate(job.slugs):
-                job.current_post = slug
-                job.progress = i
-                job.push_event("progress", job.status_dict())
-
-                # Run blocking I/O in a thread
-                html = await asyncio.to_thread(client.fetch_post_html, slug)
-                content = SubstackClient.extract_article_content(html)
-                subtitle = SubstackClient.extract_subtitle(html)
-
-                if content is None:
-                    job.push_event(
-                        "warning",
-                        {"slug": slug, "message": "Could not extract content"},
-                    )
-                    continue
+    def _write(self, fn: Callable, *args, **kwargs) -> asyncio.Future:
+        """Run a store write on the writer thread, after the ones queued before it."""
+        return asyncio.get_running_loop().run_in_executor(
+            self._writer, functools.partial(fn, *args, **kwargs)
+        )
 
-                # Get metadata from HTML
-                soup_for_title = BeautifulSoup(html, "html.parser")
-                title_tag = soup_for_title.find(
-                    "h1", class_=lambda c: c and "post-title" in c
-                )
-                title = title_tag.get_text(strip=True) if title_tag else slug
+    def _upstream_limit(self, subdomain: str) -> asyncio.Semaphore:
+        """Post fetches in flight against one newsletter, shared by all jobs."""
+        sem = self._upstream_limits.get(subdomain)
+        if sem is None:
+            sem = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+            self._upstream_limits[subdomain] = sem
+        return sem
+
+    async def _save(self, job: Job):
+        await self._write(
+            self.store.update,
+            job.id,
+            status=job.status.value,
+            error=job.error,
+            zip_path=job.zip_path,
+            image_bytes_saved=job.image_bytes_saved,
+            progress=job.progress,
+            current_post=job.current_post,
+            failed=job.failed,
+            epub_paths=list(job.epub_paths),
+            stage_seconds=job.stage_seconds,
+            finished_at=job.finished_at,
+        )
 
-                author_meta = soup_for_title.find("meta", {"name": "author"})
-                author = (
-                    author_meta["content"]
-                    if author_meta and author_meta.get("content")
-                    else "Unknown"
-                )
+    @staticmethod
+    def _job_from_record(record: JobRecord) -> Job:
+        job = Job(
+            id=record.id,
+            subdomain=record.subdomain,
+            slugs=record.slugs,
+            had_cookie=record.had_cookie,
+            client_id=record.client_id,
+            omnibus=record.options.get("omnibus", False),
+            split_by_year=record.options.get("split_by_year", False),
+            profile=record.options.get("profile", False),
+            status=JobStatus(record.status),
+            progress=record.progress,
+            total=len(record.slugs),
+            current_post=record.current_post,
+            error=record.error,
+            output_dir=record.output_dir,
+            zip_path=record.zip_path,
+            epub_paths=record.epub_paths,
+            image_bytes_saved=record.image_bytes_saved,
+            failed=record.failed,
+            stage_seconds=record.stage_seconds,
+            created_at=record.created_at,
+            finished_at=record.finished_at,
+            checkpoints=record.posts,
+        )
+        if job.profile and job.output_dir:
+            job.artifacts = [
+                name for name in ARTIFACTS if os.path.exists(os.path.join(job.output_dir, name))
+            ]
+        if not job.epub_paths:
+            for _, checkpoint in sorted(job.checkpoints.items()):
+                path = checkpoint.epub_path
+                if path and os.path.exists(path) and path not in job.epub_paths:
+                    job.epub_paths.append(path)
+        return job
 
-                time_tag = soup_for_title.find("time")
-                date_str = ""
-                if time_tag and time_tag.get("datetime"):
-                    date_str = time_tag["datetime"][:10]
+    async def run_claimed(self, record: JobRecord, session_cookie: Optional[str]):
+        """Run a job a worker claimed from the queue, recording its events."""
+        job = self._job_from_record(record)
+        job.session_cookie = session_cookie
+        job.event_sink = self.persist_event
+        self.jobs[job.id] = job
+        try:
+            if job.had_cookie and session_cookie is None:
+                # Claimed before by a worker that died; the cookie went with it
+                await self._fail_interrupted(job)
+            else:
+                await self.run_job(job)
+        finally:
+            self.jobs.pop(job.id, None)
+            # The "done" event is queued after the final save; wait for it
+            await self._write(lambda: None)
+
+    async def restore(self):
+        """Reload stored jobs and resume the ones a restart interrupted.
+
+        In queue mode workers resume interrupted jobs, so this does nothing.
+        """
+        if self.queued:
+            return
+        for record in await asyncio.to_thread(self.store.load_all):
+            job = self._job_from_record(record)
+            self.jobs[job.id] = job
+
+            if job.status in (JobStatus.COMPLETED, JobStatus.FAILED):
+                job.progress = job.total
+            elif job.had_cookie:
+                await self._fail_interrupted(job)
+            else:
+                logger.info("Resuming job %s (%d/%d posts done)",
+                            job.id, len(job.checkpoints), job.total)
+                self.submit(job)
+
+    async def _fail_interrupted(self, job: Job):
+        """A job that needed a session cookie cannot resume; keep what it built."""
+        job.progress = len(job.checkpoints)
+        if job.epub_paths:
+            archive = IncrementalZip(
+                os.path.join(job.output_dir, f"{job.subdomain}_epubs.zip")
+            )
+            for path in job.epub_paths:
+                await asyncio.to_thread(archive.add, path)
+            await asyncio.to_thread(archive.close)
+            job.zip_path = archive.path
+        job.status = JobStatus.FAILED
+        job.error = (
+            "Interrupted by a server restart. Session cookies are not stored, "
+            "so the job cannot resume; "
+            f"{len(job.epub_paths)} finished EPUB(s) are available."
+        )
+        job.finished_at = time.time()
+        await self._save(job)
+        job.push_event("status", job.status_dict())
+        job.push_event("done", {})
 
-                filepath, img_count = await asyncio.to_thread(
-                    build_epub,
-                    client,
+    async def run_job(self, job: Job):
+        job.status = JobStatus.RUNNING
+        job.push_event("status", job.status_dict())
+        # Books are only valid once closed, so an omnibus restarts from scratch
+        # (on warm post and image caches)
+        if job.omnibus and job.checkpoints:
+            job.checkpoints = {}
+            await asyncio.to_thread(self.store.reset_posts, job.id)
+        await self._save(job)
+
+        profiler: Optional[JobProfiler] = None
+
+        async def stop_profiler(boundary: str):
+            nonlocal profiler
+            if profiler is not None:
+                job.artifacts = await profiler.stop(boundary)
+                profiler = None
+
+        tier = auth_tier(job.session_cookie)
+        upstream = self._upstream_limit(job.subdomain)
+        # Indexed by slug position so the output order never depends on
+        # which worker finishes first
+        results: List[Optional[str]] = [None] * len(job.slugs)
+        filenames = _epub_filenames(job.slugs)
+        finished = [False] * len(job.slugs)
+        archive = IncrementalZip(
+            os.path.join(job.output_dir, f"{job.subdomain}_epubs.zip")
+        )
+        archive_lock = asyncio.Lock()
+        next_to_archive = 0
+        # Omnibus jobs hold each post's (book, author, title, body, images)
+        # until every earlier post is in the book, so chapters follow slug
+        # order; fetches wait while OMNIBUS_WINDOW posts are ahead of it
+        omnibus = (
+            Omnibus(job.subdomain, job.output_dir, job.split_by_year, job.created_at)
+            if job.omnibus
+            else None
+        )
+        chapters: List[Optional[tuple]] = [None] * len(job.slugs)
+        window = asyncio.Condition()
+        # Work done by this run, to refine admission control's estimates
+        started = time.monotonic()
+        run_start = time.perf_counter()
+        built_posts = 0
+        built_images = 0
+
+        # Resume: posts finished before a restart count as done; failed
+        # posts are tried again
+        job.epub_paths = []
+        job.progress = 0
+        for i, checkpoint in job.checkpoints.items():
+            if checkpoint.state == POST_DONE:
+                if not (checkpoint.epub_path and os.path.exists(checkpoint.epub_path)):
+                    continue
+                results[i] = checkpoint.epub_path
+            elif checkpoint.state != POST_SKIPPED:
+                continue
+            finished[i] = True
+            job.progress += 1
+
+        async def drain_archive():
+            nonlocal next_to_archive
+            # Append finished EPUBs to the ZIP (or chapters to the omnibus)
+            # in slug order, as soon as every earlier post is done
+            async with archive_lock:
+                while next_to_archive < len(job.slugs) and finished[next_to_archive]:
+                    if omnibus is not None:
+                        chapter = chapters[next_to_archive]
+                        chapters[next_to_archive] = None
+                        if chapter:
+                            with job.timed("write"):
+                                await asyncio.to_thread(omnibus.add_chapter, *chapter)
+                        next_to_archive += 1
+                        continue
+                    path = results[next_to_archive]
+                    if path and path not in job.epub_paths:
+                        with job.timed("zip"):
+                            await asyncio.to_thread(archive.add, path)
+                        job.epub_paths.append(path)
+                    next_to_archive += 1
+            if omnibus is not None:
+                async with window:
+                    window.notify_all()
+
+        async def finish_post(i: int, state: str = POST_DONE):
+            finished[i] = True
+            job.progress += 1
+            POSTS.inc(result=state)
+            await asyncio.to_thread(
+                self.store.checkpoint,
+                job.id,
+                i,
+                state,
+                results[i],
+                job.image_bytes_saved,
+            )
+            job.push_event("progress", job.status_dict())
+            if profiler is not None:
+                await profiler.progress(job.progress, job.total)
+            await drain_archive()
+
+        def guarded(handle):
+            """One post failing is reported and checkpointed, not fatal to the job.
+
+            Only the post's own work is guarded: once finish_post has counted
+            it, errors (from the checkpoint or the archive) fail the job.
+            """
+
+            async def run(i: int, slug: str, *args):
+                try:
+                    return await handle(i, slug, *args)
+                except Exception as e:
+                    if finished[i]:
+                        raise
+                    logger.warning("Job %s: post %s failed: %s", job.id, slug, e)
+                    job.failed += 1
+                    await finish_post(i, POST_FAILED)
+                    job.push_event("warning", {"slug": slug, "message": f"Failed: {e}"})
+                    return None
+
+            return run
+
+        async def fetch(i: int, slug: str):
+            if omnibus is not None:
+                with job.timed("window_wait"):
+                    async with window:
+                        await window.wait_for(lambda: i < next_to_archive + OMNIBUS_WINDOW)
+            job.current_post = slug
+            job.push_event("progress", job.status_dict())
+            with job.timed("fetch_wait"):
+                await upstream.acquire()
+            try:
+                with job.timed("fetch"):
+                    html = await client.fetch_post_html(slug)
+            finally:
+                upstream.release()
+            return i, slug, html
+
+        async def reuse_cached(i: int, slug: str, key: str) -> bool:
+            """Link a cached EPUB of this exact post revision into the output."""
+            with job.timed("cache"):
+                cached = await asyncio.to_thread(epub_cache.get, key)
+                if cached is None:
+                    return False
+                path = os.path.join(job.output_dir, filenames[i])
+                await asyncio.to_thread(link_or_copy, cached.path, path)
+            results[i] = path
+            await finish_post(i)
+            job.push_event(
+                "post_complete",
+                {
+                    "slug": slug,
+                    "title": cached.title,
+                    "images": cached.image_count,
+                    "image_fetch_seconds": 0.0,
+                    "image_bytes_saved": 0,
+                    "cached": True,
+                },
+            )
+            return True
+
+        async def parse(i: int, slug: str, html: str):
+            with job.timed("parse"):
+                post = await asyncio.to_thread(SubstackClient.parse_post, html)
+            if post.body is None:
+                await finish_post(i, POST_SKIPPED)
+                job.push_event(
+                    "warning",
+                    {"slug": slug, "message": "Could not extract content"},
+                )
+                return None
+            key = None
+            if omnibus is None:
+                revision = await asyncio.to_thread(post_revision, post)
+                key = cache_key(job.subdomain, slug, tier, revision)
+                if await reuse_cached(i, slug, key):
+                    return None
+            return i, slug, post, key
+
+        def count_built(images: int):
+            nonlocal built_posts, built_images
+            built_posts += 1
+            built_images += images
+            admission.estimator.observe_post(job.subdomain, images)
+
+        async def write_chapter(i: int, slug: str, post: ParsedPost):
+            title = post.title or slug
+            key = book_key(post.date, job.split_by_year)
+            img_tags = await asyncio.to_thread(collect_images, post.body)
+            images = await embed_images_async(
+                client,
+                img_tags,
+                lambda _, download: omnibus.add_image(key, post.author, download),
+            )
+            job.record_stage("images", images.fetch_seconds)
+            with job.timed("write"):
+                body = await asyncio.to_thread(
+                    post_html,
                     title,
-                    author,
-                    date_str,
-                    content,
-                    job.output_dir,
-                    subtitle,
-                    slug,
+                    post.date,
+                    post.body,
+                    img_tags,
+                    images.hrefs,
+                    post.subtitle,
                 )
-                epub_files.append(filepath)
+            chapters[i] = (key, post.author, title, body, [href for href in images.hrefs if href])
+            job.image_bytes_saved += images.bytes_original - images.bytes_embedded
+            count_built(sum(1 for href in images.hrefs if href))
+            await finish_post(i)
+            job.push_event(
+                "post_complete",
+                {
+                    "slug": slug,
+                    "title": title,
+                    "images": sum(1 for href in images.hrefs if href),
+                    "image_fetch_seconds": round(images.fetch_seconds, 3),
+                    "image_bytes_saved": images.bytes_original - images.bytes_embedded,
+                },
+            )
+
+        async def write(i: int, slug: str, post: ParsedPost, key: Optional[str]):
+            if omnibus is not None:
+                return await write_chapter(i, slug, post)
+            title = post.title or slug
+            build_start = time.perf_counter()
+            result = await build_epub_async(
+                client,
+                title,
+                post.author,
+                post.date,
+                post.body,
+                job.output_dir,
+                post.subtitle,
+                slug,
+                filenames[i],
+                # So a post's EPUB is the same whichever job builds it
+                published_at(post.date) or job.created_at,
+            )
+            results[i] = result.path
+            job.record_stage("images", result.image_fetch_seconds)
+            job.record_stage(
+                "write", time.perf_counter() - build_start - result.image_fetch_seconds
+            )
+            job.image_bytes_saved += result.image_bytes_saved
+            count_built(result.image_count)
+            await asyncio.to_thread(
+                epub_cache.put,
+                key,
+                job.subdomain,
+                slug,
+                result.path,
+                title,
+                result.image_count,
+            )
+            await finish_post(i)
+            job.push_event(
+                "post_complete",
+                {
+                    "slug": slug,
+                    "title": title,
+                    "images": result.image_count,
+                    "image_fetch_seconds": round(result.image_fetch_seconds, 3),
+                    "image_bytes_saved": result.image_bytes_saved,
+                },
+            )
+
+        workers = max(1, min(JOB_CONCURRENCY, len(job.slugs)))
+        fetch_q: asyncio.Queue = asyncio.Queue()
+        parse_q: asyncio.Queue = asyncio.Queue(maxsize=workers)
+        write_q: asyncio.Queue = asyncio.Queue(maxsize=workers)
+        for i, slug in enumerate(job.slugs):
+            if not finished[i]:
+                fetch_q.put_nowait((i, slug))
+        for _ in range(workers):
+            fetch_q.put_nowait(None)
+
+        # Started here so that the stage tasks below count as the job's
+        if job.profile:
+            profiler = await JobProfiler.start(
+                job.id, job.output_dir, allocations=job.profile == "allocations"
+            )
+            if profiler is None:
                 job.push_event(
-                    "post_complete",
-                    {"slug": slug, "title": title, "images": img_count},
+                    "warning",
+                    {"message": "Not profiled: another job is being profiled on this server"},
                 )
 
-            # Create ZIP
-            job.progress = job.total
-            job.current_post = None
-            job.epub_paths = epub_files
-            if epub_files:
-                zip_base = os.path.join(job.output_dir, f"{job.subdomain}_epubs")
-                job.zip_path = shutil.make_archive(zip_base, "zip", job.output_dir)
+        # Created just before the try below, so that it is always closed
+        client = AsyncSubstackClient(job.subdomain, job.session_cookie)
+        stages = [
+            asyncio.create_task(_run_stage(workers, guarded(fetch), fetch_q, parse_q)),
+            asyncio.create_task(_run_stage(workers, guarded(parse), parse_q, write_q)),
+            asyncio.create_task(_run_stage(workers, guarded(write), write_q, None)),
+        ]
 
-            job.status = JobStatus.COMPLETED
-            job.push_event("status", job.status_dict())
-
-        except Exception as e:
-            job.status = JobStatus.FAILED
-            job.error = str(e)
-            job.push_event("error", {"message": str(e)})
-            job.push_event("status", job.status_dict())
+        try:
+            try:
+                try:
+                    await drain_archive()
+                    await asyncio.gather(*stages)
+                finally:
+                    for stage in stages:
+                        stage.cancel()
+                if profiler is not None:
+                    await profiler.mark("posts finished")
+
+                # Finish ZIP
+                job.progress = job.total
+                job.current_post = None
+                if omnibus is not None:
+                    with job.timed("write"):
+                        paths = await asyncio.to_thread(omnibus.close)
+                    for path in paths:
+                        with job.timed("zip"):
+                            await asyncio.to_thread(archive.add, path)
+                        job.epub_paths.append(path)
+                with job.timed("zip"):
+                    await asyncio.to_thread(archive.close)
+                if job.epub_paths:
+                    job.zip_path = archive.path
+                await stop_profiler("ZIP written")
+
+                if job.failed and not job.epub_paths:
+                    job.status = JobStatus.FAILED
+                    job.error = f"All {job.failed} posts failed"
+                else:
+                    job.status = JobStatus.COMPLETED
+                    if job.failed:
+                        job.error = f"{job.failed} of {job.total} posts failed"
+                job.record_stage("total", time.perf_counter() - run_start)
+                if built_posts:
+                    admission.estimator.observe_job(
+                        built_posts,
+                        built_images,
+                        time.monotonic() - started,
+                        await asyncio.to_thread(_dir_size, job.output_dir),
+                    )
+                job.push_event("status", job.status_dict())
+
+            except Exception as e:
+                if omnibus is not None:
+                    await asyncio.to_thread(omnibus.abort)
+                # Keep whatever finished before the failure downloadable
+                await asyncio.to_thread(archive.close)
+                if job.epub_paths:
+                    job.zip_path = archive.path
+                job.status = JobStatus.FAILED
+                job.error = str(e)
+                await stop_profiler("failed")
+                job.record_stage("total", time.perf_counter() - run_start)
+                job.push_event("error", {"message": str(e)})
+                job.push_event("status", job.status_dict())
+
+        finally:
+            # Cancelled (e.g. at shutdown) before the profile was written
+            if profiler is not None:
+                profiler.close()
+            await client.aclose()
+
+        JOBS.inc(status=job.status.value)
+        JOB_SECONDS.observe(time.perf_counter() - run_start)
+        job.finished_at = time.time()
+        await self._save(job)
 
         # Signal end of stream
         job.push_event("done", {})
@@ -179,16 +968,17 @@ class JobManager:
     async def _cleanup_loop(self):
         while True:
             await asyncio.sleep(300)  # Check every 5 minutes
-            now = time.time()
-            expired = [
-                jid
-                for jid, job in self.jobs.items()
-                if now - job.created_at > self.JOB_TTL
-            ]
-            for jid in expired:
-                job = self.jobs.pop(jid, None)
-                if job and job.output_dir and os.path.exists(job.output_dir):
-                    shutil.rmtree(job.output_dir, ignore_errors=True)
+            # The store, not self.jobs, so jobs run by workers expire too.
+            # Only finished jobs expire: a job still queued or running keeps
+            # its row and output directory however long it takes
+            expired = await asyncio.to_thread(
+                self.store.expired, time.time() - self.JOB_TTL
+            )
+            for jid, output_dir in expired:
+                self.jobs.pop(jid, None)
+                await asyncio.to_thread(self.store.delete, jid)
+                if output_dir and os.path.exists(output_dir):
+                    shutil.rmtree(output_dir, ignore_errors=True)
 
 
 # Singleton
@@ -0,0 +1,383 @@
+"""
+Opt-in profiling of a single job, for finding out why one newsletter is slow.
+
+A job created with "profile": true runs under the first and last of these,
+and one created with "profile": "allocations" under all three:
+
+- a sampling profiler: a thread that every PROFILE_INTERVAL reads each
+  thread's stack with sys._current_frames(). Event loop samples count while
+  one of the job's tasks is running (or as idle while the loop waits on I/O);
+  samples of the default thread pool (asyncio.to_thread) count while a
+  thread is busy, whichever job it is working for. Image processing happens
+  in the process pool and shows up only as the wait for it.
+- tracemalloc, with a snapshot at each stage
+  boundary: the start, each quarter of the posts, all posts finished and
+  the ZIP written.
+- an event loop lag probe: a task that sleeps PROFILE_LAG_INTERVAL and
+  records how late it wakes up.
+
+The results are written next to the job's ZIP as profile.folded (collapsed
+stacks for flamegraph.pl or speedscope), profile.txt (top functions and
+loop lag) and, when allocations are traced, allocations.txt (memory at each
+boundary and the lines whose allocations grew most since the previous one).
+
+Profiling is off unless the operator sets JOB_PROFILING=1: a profiled job
+slows down everything else in its process. Jobs without the flag never
+reach this module. The job's tasks are told
+apart by a context variable they inherit, read from Task.get_context();
+before Python 3.12 a task factory has to tag them as they are created,
+which costs every task on the loop a call. Only one job per process is
+profiled at a time. tracemalloc is process-wide: while it runs, every
+allocation in the process is traced, and jobs running beside the profiled
+one slow down too, so it only runs for jobs that ask for allocations.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import linecache
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Whether jobs may ask to be profiled at all
+JOB_PROFILING = os.environ.get("JOB_PROFILING", "0") == "1"
+# Seconds between stack samples
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.01"))
+# Seconds the loop lag probe sleeps between measurements
+PROFILE_LAG_INTERVAL = 0.05
+# Frames kept per traced allocation
+TRACE_FRAMES = 1
+# Distinct stacks kept; rarer ones beyond this are counted as "[other]"
+MAX_STACKS = 20000
+# Allocation sites listed per stage boundary
+TOP_ALLOCATIONS = 15
+# Functions listed in profile.txt
+TOP_FUNCTIONS = 40
+
+ARTIFACTS = ("profile.folded", "profile.txt", "allocations.txt")
+
+# Functions an idle pool thread sits in: waiting for work or a lock
+IDLE_FUNCTIONS = {"_worker", "wait", "get"}
+# Name prefix of the event loop's default thread pool
+POOL_THREAD_PREFIX = "asyncio_"
+
+# Set while a profiled job's code runs; tasks created meanwhile are its tasks
+_profiled_job: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "profiled_job", default=None
+)
+# Task.get_context() arrived in Python 3.12; before it, tasks are tagged by a
+# task factory as they are created
+_TASK_CONTEXT = hasattr(asyncio.Task, "get_context")
+_active_lock = threading.Lock()
+_active: Optional["JobProfiler"] = None
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _stack(frame) -> Tuple[str, ...]:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return tuple(labels)
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _mb(size: int) -> str:
+    return f"{size / 2**20:.1f} MB"
+
+
+class JobProfiler:
+    """Profiles one job from start() to stop(); see the module docstring."""
+
+    def __init__(self, job_id: str, output_dir: str, allocations: bool = False):
+        self.job_id = job_id
+        self.output_dir = output_dir
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread = 0
+        self.stacks: Counter = Counter()
+        self.samples = {"job": 0, "idle": 0, "other": 0, "threads": 0}
+        self.lags: List[float] = []
+        self.started = 0.0
+        self.stopped = 0.0
+        # (name, seconds since start, traced bytes, stage peak, and the
+        # lines that grew most: ((file, line), (bytes, blocks)))
+        self.boundaries: List[Tuple[str, float, int, int, list]] = []
+        # Trace allocations with tracemalloc, which slows the whole process
+        self.allocations = allocations
+        # The job's tasks, where a task factory tags them
+        self._tasks: "weakref.WeakSet[asyncio.Task]" = weakref.WeakSet()
+        self._quarters_marked = 0
+        # Allocation sizes at the previous boundary, by (file, line)
+        self._sizes: Optional[Dict[Tuple[str, int], Tuple[int, int]]] = None
+        # Snapshots in progress, and taken so far
+        self._marking = 0
+        self._marks = 0
+        self._owns_tracemalloc = False
+        self._previous_factory = None
+        self._token = None
+        self._sampler: Optional[threading.Thread] = None
+        self._lag_task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    @classmethod
+    async def start(
+        cls, job_id: str, output_dir: str, allocations: bool = False
+    ) -> Optional["JobProfiler"]:
+        """Start profiling the calling task's job; None if another job is
+        being profiled in this process."""
+        global _active
+        profiler = cls(job_id, output_dir, allocations)
+        with _active_lock:
+            if _active is not None:
+                return None
+            _active = profiler
+        await profiler._start()
+        return profiler
+
+    async def _start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self._token = _profiled_job.set(self.job_id)
+        if not _TASK_CONTEXT:
+            self._tasks.add(asyncio.current_task())
+            self._previous_factory = self.loop.get_task_factory()
+            self.loop.set_task_factory(self._task_factory)
+
+        if self.allocations and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            self._owns_tracemalloc = True
+        self.started = time.perf_counter()
+        await self.mark("start")
+
+        self._lag_task = asyncio.create_task(self._probe_lag())
+        self._sampler = threading.Thread(
+            target=self._sample, name=f"profiler-{self.job_id}", daemon=True
+        )
+        self._sampler.start()
+
+    def _task_factory(self, loop, coro, **kwargs):
+        if self._previous_factory is not None:
+            task = self._previous_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        context = kwargs.get("context")
+        creator = context.get(_profiled_job) if context is not None else _profiled_job.get()
+        if creator == self.job_id:
+            self._tasks.add(task)
+        return task
+
+    def _is_job_task(self, task: asyncio.Task) -> bool:
+        if _TASK_CONTEXT:
+            return task.get_context().get(_profiled_job) == self.job_id
+        return task in self._tasks
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(PROFILE_INTERVAL):
+            if self._marking:
+                continue
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                if thread_id == self.loop_thread:
+                    task = asyncio.current_task(self.loop)
+                    if task is None:
+                        self.samples["idle"] += 1
+                        self._count(("[event loop idle]",))
+                        continue
+                    if not self._is_job_task(task):
+                        self.samples["other"] += 1
+                        continue
+                    self.samples["job"] += 1
+                    self._count(("[event loop]",) + _stack(frame))
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                name = names.setdefault(thread_id, "")
+                if name.startswith(POOL_THREAD_PREFIX) and frame.f_code.co_name not in IDLE_FUNCTIONS:
+                    self.samples["threads"] += 1
+                    self._count(("[thread pool]",) + _stack(frame))
+
+    def _count(self, stack: Tuple[str, ...]):
+        if stack in self.stacks or len(self.stacks) < MAX_STACKS:
+            self.stacks[stack] += 1
+        else:
+            self.stacks[("[other]",)] += 1
+
+    async def _probe_lag(self):
+        while True:
+            start, marks, marking = self.loop.time(), self._marks, self._marking
+            await asyncio.sleep(PROFILE_LAG_INTERVAL)
+            if not marking and not self._marking and self._marks == marks:
+                self.lags.append(max(0.0, self.loop.time() - start - PROFILE_LAG_INTERVAL))
+
+    async def mark(self, name: str):
+        """Snapshot allocations at a stage boundary."""
+        if not self.allocations:
+            return
+        # The snapshot holds the GIL for a while; neither the stacks nor the
+        # loop lag measured meanwhile belong to the job
+        self._marking += 1
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            sizes = await asyncio.to_thread(self._allocation_sizes)
+        finally:
+            self._marking -= 1
+            self._marks += 1
+        # The first boundary is only what later ones are compared with
+        first = self._sizes is None
+        growth = {}
+        if not first:
+            for line, (size, count) in sizes.items():
+                old_size, old_count = self._sizes.get(line, (0, 0))
+                if size > old_size:
+                    growth[line] = (size - old_size, count - old_count)
+        top = sorted(growth.items(), key=lambda item: item[1][0], reverse=True)
+        self._sizes = sizes
+        self.boundaries.append(
+            (
+                name,
+                time.perf_counter() - self.started,
+                current,
+                peak,
+                # Source lines are looked up when the report is written, once
+                # tracing has stopped, so the lookups are not traced
+                top[:TOP_ALLOCATIONS],
+            )
+        )
+
+    @staticmethod
+    def _allocation_sizes() -> Dict[Tuple[str, int], Tuple[int, int]]:
+        """(bytes, blocks) allocated and still alive, per source line."""
+        sizes = {}
+        for stat in tracemalloc.take_snapshot().statistics("lineno"):
+            frame = stat.traceback[0]
+            if frame.filename != tracemalloc.__file__:
+                sizes[(frame.filename, frame.lineno)] = (stat.size, stat.count)
+        return sizes
+
+    @staticmethod
+    def _describe(line: Tuple[str, int], size: int, count: int) -> str:
+        filename, lineno = line
+        source = linecache.getline(filename, lineno).strip()
+        return f"+{size / 1024:>10.1f} KiB +{count:>7} blocks  {filename}:{lineno}  {source[:80]}"
+
+    async def progress(self, done: int, total: int):
+        """Mark each quarter of the posts as it is reached."""
+        quarter = done * 4 // max(1, total)
+        while self._quarters_marked < min(quarter, 3):
+            self._quarters_marked += 1
+            await self.mark(f"{self._quarters_marked * 25}% of posts")
+
+    async def stop(self, final: str) -> List[str]:
+        """Take the last snapshot, stop profiling and write the artifacts.
+
+        Returns the names of the artifacts written."""
+        try:
+            await self.mark(final)
+            self.stopped = time.perf_counter()
+            self.close()
+            if self._sampler is not None:
+                await asyncio.to_thread(self._sampler.join)
+            return await asyncio.to_thread(self._write)
+        except Exception:
+            logger.exception("Job %s: could not write its profile", self.job_id)
+            return []
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop profiling without writing anything; safe to call again."""
+        global _active
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if not _TASK_CONTEXT:
+            self.loop.set_task_factory(self._previous_factory)
+        _profiled_job.reset(self._token)
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+        self._sizes = None
+        with _active_lock:
+            if _active is self:
+                _active = None
+
+    def _write(self) -> List[str]:
+        with open(os.path.join(self.output_dir, "profile.folded"), "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{';'.join(stack)} {count}\n")
+        with open(os.path.join(self.output_dir, "profile.txt"), "w") as f:
+            f.write(self._profile_report())
+        if not self.allocations:
+            return ["profile.folded", "profile.txt"]
+        with open(os.path.join(self.output_dir, "allocations.txt"), "w") as f:
+            f.write(self._allocation_report())
+        return list(ARTIFACTS)
+
+    def _profile_report(self) -> str:
+        wall = self.stopped - self.started
+        lags = self.lags
+        lines = [
+            f"Job {self.job_id}: {wall:.2f}s, a sample every {PROFILE_INTERVAL * 1000:g} ms",
+            "",
+            "Event loop samples: "
+            f"{self.samples['job']} in this job, {self.samples['idle']} idle, "
+            f"{self.samples['other']} in other jobs",
+            f"Busy thread pool samples: {self.samples['threads']}",
+            "",
+            f"Event loop lag over {len(lags)} probes: "
+            f"p50 {_percentile(lags, 0.5) * 1000:.1f} ms, "
+            f"p99 {_percentile(lags, 0.99) * 1000:.1f} ms, "
+            f"max {max(lags, default=0) * 1000:.1f} ms, "
+            f"{sum(1 for lag in lags if lag > 0.1)} over 100 ms",
+            "",
+        ]
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                total[label] += count
+        samples = max(1, sum(self.stacks.values()))
+        for title, counts in (("Own samples", own), ("Total samples (including callees)", total)):
+            lines.append(f"{title}:")
+            for label, count in counts.most_common(TOP_FUNCTIONS):
+                lines.append(f"{count:>8} {count / samples:>6.1%}  {label}")
+            lines.append("")
+        return "\n".join(lines)
+
+    def _allocation_report(self) -> str:
+        lines = []
+        for name, seconds, current, peak, growth in self.boundaries:
+            lines.append(
+                f"== {name} at {seconds:.2f}s: {_mb(current)} traced, "
+                f"peak {_mb(peak)} since the previous boundary"
+            )
+            lines.extend(self._describe(line, size, count) for line, (size, count) in growth)
+            lines.append("")
+        return "\n".join(lines)
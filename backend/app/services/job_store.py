@@ -0,0 +1,471 @@
+"""
+Durable job records with per-post checkpoints.
+
+Every job and the state of each of its slugs is kept in SQLite, with a
+checkpoint written as each post finishes, so a restarted server can pick up
+interrupted jobs from the last completed post. Session cookies are not
+persisted with the job; the store only records that a job had one.
+
+The store is also the local job queue for WORKER_MODE=queue: the API inserts
+pending jobs, worker processes claim them, and the events workers append are
+tailed by the API's SSE endpoints. A queued job's cookie is held in its row
+only until a worker claims it. Workers also leave their metrics here for the
+API's /api/metrics.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.services.event_log import EVENT_LOG_SIZE
+from app.services.scheduler import Candidate
+from app.services.storage import CACHE_ROOT, connect
+
+# Job output directories and the job database live here
+JOB_DATA_DIR = os.environ.get("JOB_DATA_DIR", os.path.join(CACHE_ROOT, "jobs"))
+JOB_STORE_PATH = os.path.join(JOB_DATA_DIR, "jobs.sqlite3")
+# A claimed job whose worker has been silent this long is up for grabs again
+JOB_CLAIM_TIMEOUT = float(os.environ.get("JOB_CLAIM_TIMEOUT", "60"))
+# Seconds a stopped worker's metrics keep counting; then they drop out, as
+# if the worker had restarted
+WORKER_METRICS_TTL = 86400
+
+# Per-post states; anything else is still pending
+POST_DONE = "done"
+POST_SKIPPED = "skipped"
+POST_FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    subdomain TEXT NOT NULL,
+    slugs TEXT NOT NULL,
+    options TEXT NOT NULL,
+    had_cookie INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    output_dir TEXT NOT NULL,
+    zip_path TEXT,
+    image_bytes_saved INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_posts (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    epub_path TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE TABLE IF NOT EXISTS job_events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    event TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_events_by_job ON job_events (job_id, seq);
+CREATE TABLE IF NOT EXISTS worker_metrics (
+    worker_id TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+# Columns added after the jobs table first shipped, created on open
+JOB_COLUMNS = {
+    "progress": "INTEGER NOT NULL DEFAULT 0",
+    "current_post": "TEXT",
+    "failed": "INTEGER NOT NULL DEFAULT 0",
+    "epub_paths": "TEXT NOT NULL DEFAULT '[]'",
+    "session_cookie": "TEXT",
+    "claimed_by": "TEXT",
+    "heartbeat": "REAL",
+    "client_id": "TEXT NOT NULL DEFAULT ''",
+    # Newest event trimmed from the job's bounded event log
+    "events_evicted": "INTEGER NOT NULL DEFAULT 0",
+    "stage_seconds": "TEXT NOT NULL DEFAULT '{}'",
+    # When the job completed or failed; expiry counts from here
+    "finished_at": "REAL",
+}
+
+_JOB_FIELDS = (
+    "id, subdomain, slugs, options, had_cookie, status, error, output_dir, "
+    "zip_path, image_bytes_saved, created_at, progress, current_post, failed, "
+    "epub_paths, client_id, stage_seconds, finished_at"
+)
+
+# Job fields update() may write
+_UPDATABLE = {
+    "status",
+    "error",
+    "zip_path",
+    "image_bytes_saved",
+    "progress",
+    "current_post",
+    "failed",
+    "epub_paths",
+    "stage_seconds",
+    "finished_at",
+}
+
+
+@dataclass
+class PostCheckpoint:
+    state: str
+    epub_path: Optional[str] = None
+
+
+@dataclass
+class JobRecord:
+    id: str
+    subdomain: str
+    slugs: List[str]
+    options: dict
+    had_cookie: bool
+    status: str
+    error: Optional[str]
+    output_dir: str
+    zip_path: Optional[str]
+    image_bytes_saved: int
+    created_at: float
+    progress: int = 0
+    current_post: Optional[str] = None
+    failed: int = 0
+    epub_paths: List[str] = field(default_factory=list)
+    client_id: str = ""
+    stage_seconds: Dict[str, float] = field(default_factory=dict)
+    finished_at: Optional[float] = None
+    posts: Dict[int, PostCheckpoint] = field(default_factory=dict)
+
+
+def _record(row: tuple) -> JobRecord:
+    return JobRecord(
+        id=row[0],
+        subdomain=row[1],
+        slugs=json.loads(row[2]),
+        options=json.loads(row[3]),
+        had_cookie=bool(row[4]),
+        status=row[5],
+        error=row[6],
+        output_dir=row[7],
+        zip_path=row[8],
+        image_bytes_saved=row[9],
+        created_at=row[10],
+        progress=row[11],
+        current_post=row[12],
+        failed=row[13],
+        epub_paths=json.loads(row[14]),
+        client_id=row[15],
+        stage_seconds=json.loads(row[16]),
+        finished_at=row[17],
+    )
+
+
+class JobStore:
+    def __init__(self, path: str = JOB_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = connect(self.path)
+            self._conn.executescript(SCHEMA)
+            existing = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            with self._conn:
+                for name, decl in JOB_COLUMNS.items():
+                    if name not in existing:
+                        self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {decl}")
+                if "finished_at" not in existing:
+                    # Jobs finished before the column existed expire as they
+                    # used to, by creation time
+                    self._conn.execute(
+                        "UPDATE jobs SET finished_at = created_at "
+                        "WHERE status IN ('completed', 'failed')"
+                    )
+        return self._conn
+
+    def create(
+        self,
+        job_id: str,
+        subdomain: str,
+        slugs: List[str],
+        options: dict,
+        had_cookie: bool,
+        status: str,
+        output_dir: str,
+        created_at: float,
+        session_cookie: Optional[str] = None,
+        client_id: str = "",
+    ) -> None:
+        """Insert a job. Pass session_cookie only for jobs a worker will claim."""
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    "INSERT INTO jobs (id, subdomain, slugs, options, had_cookie, status, "
+                    "output_dir, created_at, progress, session_cookie, client_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)",
+                    (
+                        job_id,
+                        subdomain,
+                        json.dumps(slugs),
+                        json.dumps(options),
+                        int(had_cookie),
+                        status,
+                        output_dir,
+                        created_at,
+                        session_cookie,
+                        client_id,
+                    ),
+                )
+
+    def update(self, job_id: str, **fields) -> None:
+        """Write job fields, e.g. update(job_id, status="running", progress=3)."""
+        unknown = set(fields) - _UPDATABLE
+        if unknown:
+            raise ValueError(f"not updatable: {', '.join(sorted(unknown))}")
+        for name in ("epub_paths", "stage_seconds"):
+            if name in fields:
+                fields[name] = json.dumps(fields[name])
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    f"UPDATE jobs SET {assignments} WHERE id = ?",
+                    (*fields.values(), job_id),
+                )
+
+    def checkpoint(
+        self,
+        job_id: str,
+        idx: int,
+        state: str,
+        epub_path: Optional[str] = None,
+        image_bytes_saved: Optional[int] = None,
+    ) -> None:
+        """Record that post idx of a job has finished."""
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO job_posts (job_id, idx, state, epub_path) "
+                    "VALUES (?, ?, ?, ?)",
+                    (job_id, idx, state, epub_path),
+                )
+                if image_bytes_saved is not None:
+                    db.execute(
+                        "UPDATE jobs SET image_bytes_saved = ? WHERE id = ?",
+                        (image_bytes_saved, job_id),
+                    )
+
+    def reset_posts(self, job_id: str) -> None:
+        """Forget a job's checkpoints, for jobs that must restart from scratch."""
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("DELETE FROM job_posts WHERE job_id = ?", (job_id,))
+
+    def _posts(self, db, job_id: Optional[str] = None) -> List[tuple]:
+        if job_id is None:
+            return db.execute("SELECT job_id, idx, state, epub_path FROM job_posts").fetchall()
+        return db.execute(
+            "SELECT job_id, idx, state, epub_path FROM job_posts WHERE job_id = ?",
+            (job_id,),
+        ).fetchall()
+
+    def load(self, job_id: str) -> Optional[JobRecord]:
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                f"SELECT {_JOB_FIELDS} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            posts = self._posts(db, job_id)
+        record = _record(row)
+        for _, idx, state, epub_path in posts:
+            record.posts[idx] = PostCheckpoint(state, epub_path)
+        return record
+
+    def load_all(self) -> List[JobRecord]:
+        with self._lock:
+            db = self._db()
+            jobs = db.execute(f"SELECT {_JOB_FIELDS} FROM jobs").fetchall()
+            posts = self._posts(db)
+
+        records = {row[0]: _record(row) for row in jobs}
+        for job_id, idx, state, epub_path in posts:
+            record = records.get(job_id)
+            if record is not None:
+                record.posts[idx] = PostCheckpoint(state, epub_path)
+        return list(records.values())
+
+    def _candidates(self, db, stale_after: float) -> Tuple[List[Candidate], List[Candidate]]:
+        rows = db.execute(
+            "SELECT id, subdomain, client_id, slugs, created_at, "
+            "claimed_by IS NOT NULL AND heartbeat >= ? FROM jobs "
+            "WHERE status IN ('pending', 'running')",
+            (time.time() - stale_after,),
+        ).fetchall()
+        waiting, running = [], []
+        for job_id, subdomain, client_id, slugs, created_at, claimed in rows:
+            candidate = Candidate(job_id, subdomain, client_id, len(json.loads(slugs)), created_at)
+            (running if claimed else waiting).append(candidate)
+        return waiting, running
+
+    def candidates(
+        self, stale_after: float = JOB_CLAIM_TIMEOUT
+    ) -> Tuple[List[Candidate], List[Candidate]]:
+        """Unfinished jobs as (waiting for a worker, held by a live worker)."""
+        with self._lock:
+            return self._candidates(self._db(), stale_after)
+
+    def claim(
+        self,
+        worker_id: str,
+        choose: Callable[[List[Candidate], List[Candidate]], Optional[Candidate]],
+        stale_after: float = JOB_CLAIM_TIMEOUT,
+    ) -> Optional[Tuple[JobRecord, Optional[str]]]:
+        """Claim the unclaimed (or abandoned) job choose(waiting, running) picks.
+
+        Returns the job and its session cookie, which is cleared from the row
+        as it is handed over.
+        """
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            with db:
+                # IMMEDIATE takes the write lock up front, so two workers can
+                # never claim the same row
+                db.execute("BEGIN IMMEDIATE")
+                chosen = choose(*self._candidates(db, stale_after))
+                if chosen is None:
+                    return None
+                job_id = chosen.job_id
+                cookie = db.execute(
+                    "SELECT session_cookie FROM jobs WHERE id = ?", (job_id,)
+                ).fetchone()[0]
+                db.execute(
+                    "UPDATE jobs SET claimed_by = ?, heartbeat = ?, session_cookie = NULL "
+                    "WHERE id = ?",
+                    (worker_id, now, job_id),
+                )
+        return self.load(job_id), cookie
+
+    def heartbeat(self, worker_id: str) -> None:
+        """Keep every job this worker holds claimed."""
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    "UPDATE jobs SET heartbeat = ? WHERE claimed_by = ? "
+                    "AND status IN ('pending', 'running')",
+                    (time.time(), worker_id),
+                )
+
+    def put_worker_metrics(self, worker_id: str, data: Dict[str, list]) -> None:
+        """Replace a worker's exported metrics (metrics.Registry.export())."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO worker_metrics (worker_id, updated_at, data) "
+                    "VALUES (?, ?, ?)",
+                    (worker_id, now, json.dumps(data)),
+                )
+                db.execute(
+                    "DELETE FROM worker_metrics WHERE updated_at < ?",
+                    (now - WORKER_METRICS_TTL,),
+                )
+
+    def worker_metrics(self) -> List[Dict[str, list]]:
+        """Every worker's latest metrics export, for Registry.render()."""
+        with self._lock:
+            rows = self._db().execute("SELECT data FROM worker_metrics").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def append_event(self, job_id: str, event: str, data: dict) -> None:
+        """Record an event, keeping the job's log as bounded as EventLog's."""
+        with self._lock:
+            db = self._db()
+            with db:
+                last = db.execute(
+                    "SELECT seq, event FROM job_events WHERE job_id = ? "
+                    "ORDER BY seq DESC LIMIT 1",
+                    (job_id,),
+                ).fetchone()
+                if event == "progress" and last is not None and last[1] == "progress":
+                    db.execute("DELETE FROM job_events WHERE seq = ?", (last[0],))
+                db.execute(
+                    "INSERT INTO job_events (job_id, event, data) VALUES (?, ?, ?)",
+                    (job_id, event, json.dumps(data)),
+                )
+                # Newest event beyond the last EVENT_LOG_SIZE
+                evicted = db.execute(
+                    "SELECT seq FROM job_events WHERE job_id = ? "
+                    "ORDER BY seq DESC LIMIT 1 OFFSET ?",
+                    (job_id, EVENT_LOG_SIZE),
+                ).fetchone()
+                if evicted is not None:
+                    db.execute(
+                        "DELETE FROM job_events WHERE job_id = ? AND seq <= ?",
+                        (job_id, evicted[0]),
+                    )
+                    db.execute(
+                        "UPDATE jobs SET events_evicted = ? WHERE id = ?",
+                        (evicted[0], job_id),
+                    )
+
+    def last_event_seq(self, job_id: str) -> int:
+        with self._lock:
+            row = self._db().execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM job_events WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        return row[0]
+
+    def events_after(self, job_id: str, seq: int) -> Tuple[List[Tuple[int, str, dict]], bool]:
+        """Events newer than seq, and whether some were already evicted."""
+        with self._lock:
+            db = self._db()
+            rows = db.execute(
+                "SELECT seq, event, data FROM job_events WHERE job_id = ? AND seq > ? "
+                "ORDER BY seq",
+                (job_id, seq),
+            ).fetchall()
+            evicted = db.execute(
+                "SELECT events_evicted FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        missed = evicted is not None and seq < evicted[0]
+        return [(row[0], row[1], json.loads(row[2])) for row in rows], missed
+
+    def expired(self, finished_before: float) -> List[Tuple[str, str]]:
+        """(id, output_dir) of jobs that completed or failed before the given time.
+
+        Pending and running jobs never expire, however old.
+        """
+        with self._lock:
+            return self._db().execute(
+                "SELECT id, output_dir FROM jobs "
+                "WHERE status IN ('completed', 'failed') AND finished_at < ?",
+                (finished_before,),
+            ).fetchall()
+
+    def delete(self, job_id: str) -> None:
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("DELETE FROM job_events WHERE job_id = ?", (job_id,))
+                db.execute("DELETE FROM job_posts WHERE job_id = ?", (job_id,))
+                db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+
+# Singleton
+job_store = JobStore()
@@ -0,0 +1,377 @@
+"""
+Process-wide metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are module-level objects that services
+update as they work; values owned by other objects (cache hit counts, queue
+depth) are read through callbacks when /api/metrics is scraped. Labels must
+come from small fixed sets, e.g. a host kind rather than a hostname, so the
+number of series stays bounded.
+
+With WORKER_MODE=queue the jobs run in worker processes. Each worker exports
+its counters and histograms to the job store with every heartbeat, and the
+API adds them to its own when scraped. Gauges describe the process serving
+/api/metrics and are not exported.
+"""
+
+from __future__ import annotations
+
+import bisect
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+from urllib.parse import urlparse
+
+Labels = Tuple[str, ...]
+
+# Seconds, from a cache hit to a slow upstream page
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Labels:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    @abstractmethod
+    def samples(self, remote: Sequence[list] = ()) -> Iterator[str]:
+        """Lines of the text exposition format, without HELP and TYPE, with
+        values exported by other processes (see export()) added in."""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def export(self) -> list:
+        """[labels, value] pairs, for another process's samples() to add in."""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def samples(self, remote: Sequence[list] = ()) -> Iterator[str]:
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in remote:
+            key = tuple(labels)
+            values[key] = values.get(key, 0) + value
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: count per bucket (last is +Inf), sum
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def export(self) -> list:
+        """[labels, bucket counts, sum] triples, for another process's samples()."""
+        with self._lock:
+            return [[list(key), list(c), t[0]] for key, (c, t) in self._values.items()]
+
+    def samples(self, remote: Sequence[list] = ()) -> Iterator[str]:
+        with self._lock:
+            values = {key: (list(c), t[0]) for key, (c, t) in self._values.items()}
+        for labels, counts, total in remote:
+            key = tuple(labels)
+            if key in values:
+                mine, my_total = values[key]
+                counts = [a + b for a, b in zip(mine, counts)]
+                total += my_total
+            values[key] = (list(counts), total)
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="%s"' % _format_value(bound)
+                yield (
+                    f"{self.name}_bucket{_format_labels(self.label_names, key, le)} "
+                    f"{cumulative}"
+                )
+            yield f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}"
+
+
+class Callback(_Metric):
+    """A counter or gauge whose values are read from elsewhere at scrape time."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        kind: str,
+        read: Callable[[], Dict[Labels, float]],
+        labels: Sequence[str] = (),
+    ):
+        super().__init__(name, help, labels)
+        self.kind = kind
+        self.read = read
+
+    def samples(self, remote: Sequence[list] = ()) -> Iterator[str]:
+        # Read in this process only; callbacks are not exported
+        for key, value in sorted(self.read().items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(
+        self,
+        name: str,
+        help: str,
+        kind: str,
+        read: Callable[[], Dict[Labels, float]],
+        labels: Sequence[str] = (),
+    ) -> Callback:
+        return self.register(Callback(name, help, kind, read, labels))
+
+    def export(self) -> Dict[str, list]:
+        """This process's counters and histograms, JSON-ready, for render()
+        in another process."""
+        return {
+            metric.name: metric.export()
+            for metric in self._metrics.values()
+            if isinstance(metric, (Counter, Histogram)) and metric.kind != "gauge"
+        }
+
+    def render(self, remote: Sequence[Dict[str, list]] = ()) -> str:
+        """The text exposition, with exports from other processes added in."""
+        lines = []
+        for metric in self._metrics.values():
+            extra = [value for export in remote for value in export.get(metric.name, ())]
+            try:
+                samples = list(metric.samples(extra))
+            except Exception as e:
+                # One broken callback should not take the whole scrape down
+                lines.append(f"# {metric.name} unavailable: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+def host_kind(host: str) -> str:
+    """'substack' for Substack's own hosts, 'cdn' for everything else."""
+    host = host.lower()
+    return "substack" if host == "substack.com" or host.endswith(".substack.com") else "cdn"
+
+
+def url_kind(url: str) -> str:
+    return host_kind(urlparse(url).netloc)
+
+
+def observe_upstream(url: str, status: int, seconds: float, size: int) -> None:
+    host = url_kind(url)
+    UPSTREAM_REQUESTS.inc(host=host, status=str(status))
+    UPSTREAM_SECONDS.observe(seconds, host=host)
+    UPSTREAM_BYTES.inc(size, host=host)
+
+
+registry = Registry()
+
+UPSTREAM_REQUESTS = registry.counter(
+    "stk_upstream_requests_total",
+    "Upstream HTTP responses by host kind and status code",
+    ("host", "status"),
+)
+UPSTREAM_ERRORS = registry.counter(
+    "stk_upstream_errors_total",
+    "Upstream requests that failed without a response",
+    ("host",),
+)
+UPSTREAM_RETRIES = registry.counter(
+    "stk_upstream_retries_total",
+    "Upstream requests retried after a 429",
+    ("host",),
+)
+UPSTREAM_SECONDS = registry.histogram(
+    "stk_upstream_request_seconds",
+    "Upstream request latency, excluding rate limiter waits",
+    ("host",),
+)
+UPSTREAM_BYTES = registry.counter(
+    "stk_upstream_bytes_total",
+    "Response body bytes downloaded from upstream",
+    ("host",),
+)
+RATE_LIMIT_WAIT = registry.counter(
+    "stk_rate_limit_wait_seconds_total",
+    "Time requests spent waiting on the upstream rate limiter",
+    ("host",),
+)
+STAGE_SECONDS = registry.histogram(
+    "stk_stage_seconds",
+    "Time per post spent in each job stage (per image for image_download and image_process)",
+    ("stage",),
+)
+POSTS = registry.counter(
+    "stk_posts_total",
+    "Posts finished by jobs, by outcome",
+    ("result",),
+)
+JOBS = registry.counter(
+    "stk_jobs_total",
+    "Jobs finished, by final status",
+    ("status",),
+)
+JOB_SECONDS = registry.histogram(
+    "stk_job_seconds",
+    "Wall time of finished jobs",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+IMAGE_POOL_INFLIGHT = registry.gauge(
+    "stk_image_pool_inflight",
+    "Images submitted to the image process pool and not yet returned",
+)
+THREAD_POOL = registry.gauge(
+    "stk_thread_pool",
+    "Default thread pool workers allowed, calls running, and calls waiting for a worker",
+    ("state",),
+)
+
+
+class CountingThreadPool(ThreadPoolExecutor):
+    """
+    Thread pool that reports its own load to stk_thread_pool.
+
+    Install it as the loop's default executor so asyncio.to_thread calls are
+    counted from submit to return; a call cancelled before it starts leaves
+    the queue without ever running.
+    """
+
+    def __init__(self, max_workers: int = 0):
+        # Same default size as the pool asyncio creates on its own
+        max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        super().__init__(max_workers, thread_name_prefix="asyncio")
+        THREAD_POOL.set(max_workers, state="max")
+        THREAD_POOL.inc(0, state="running")
+        THREAD_POOL.inc(0, state="queued")
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        def run():
+            THREAD_POOL.dec(state="queued")
+            THREAD_POOL.inc(state="running")
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                THREAD_POOL.dec(state="running")
+
+        THREAD_POOL.inc(state="queued")
+        try:
+            future = super().submit(run)
+        except BaseException:
+            THREAD_POOL.dec(state="queued")
+            raise
+        future.add_done_callback(_unqueue_cancelled)
+        return future
+
+
+def _unqueue_cancelled(future: Future) -> None:
+    if future.cancelled():
+        THREAD_POOL.dec(state="queued")
@@ -0,0 +1,137 @@
+"""
+Omnibus EPUBs: many posts in one book, optionally one book per year.
+
+Each post becomes one chapter, in the order posts are added. Images are
+stored once per book under their content hash, so a headshot or banner that
+repeats across posts is embedded a single time. They wait on disk until the
+first chapter using them is added, so a post that fails after its images
+arrived leaves nothing in the book. Everything else is written to the zip
+container as it is added, so memory stays flat however many posts the book
+holds.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app.services.epub_builder import EPUB_CSS, ImageDownload, slug_from_title
+from app.services.epub_writer import EpubWriter
+
+UNDATED = "undated"
+
+
+def book_key(date_str: str, split_by_year: bool) -> str:
+    """The book a post belongs to: its year when splitting, else a single book."""
+    if not split_by_year:
+        return "all"
+    year = (date_str or "")[:4]
+    return year if year.isdigit() else UNDATED
+
+
+class Omnibus:
+    """The anthology books of one job. Methods are safe to call from threads."""
+
+    def __init__(
+        self,
+        subdomain: str,
+        output_dir: str,
+        split_by_year: bool = False,
+        modified: Optional[float] = None,
+    ):
+        self.subdomain = subdomain
+        self.output_dir = output_dir
+        self.split_by_year = split_by_year
+        # Every book's dcterms:modified (see EpubWriter)
+        self.modified = modified
+        self._books: Dict[str, EpubWriter] = {}
+        self._chapter_counts: Dict[str, int] = {}
+        # Images not yet in their book: media type by (book key, href)
+        self._staged: Dict[Tuple[str, str], str] = {}
+        self._staging_dir = os.path.join(output_dir, ".omnibus-images")
+        self._lock = threading.Lock()
+        self.images_deduplicated = 0
+
+    def _book(self, key: str, author: str) -> EpubWriter:
+        writer = self._books.get(key)
+        if writer is None:
+            if key == "all":
+                title = f"{self.subdomain} anthology"
+            else:
+                title = f"{self.subdomain} {key}"
+            writer = EpubWriter(
+                path=os.path.join(self.output_dir, f"{slug_from_title(title)}.epub"),
+                identifier=f"substack-{self.subdomain}-omnibus-{key}",
+                title=title,
+                author=author,
+                modified=self.modified,
+            )
+            writer.add_item("style/default.css", EPUB_CSS, "text/css")
+            self._books[key] = writer
+            self._chapter_counts[key] = 0
+        return writer
+
+    def _staged_path(self, key: str, href: str) -> str:
+        return os.path.join(self._staging_dir, key, os.path.basename(href))
+
+    def add_image(self, key: str, author: str, download: ImageDownload) -> Optional[str]:
+        """Stage an image for book `key` once per distinct content; returns its href."""
+        img_data, media_type, ext = download
+        if img_data is None:
+            return None
+        href = f"images/{hashlib.sha256(img_data).hexdigest()[:20]}{ext}"
+        with self._lock:
+            writer = self._books.get(key)
+            if (key, href) in self._staged or (writer is not None and writer.has_item(href)):
+                self.images_deduplicated += 1
+                return href
+            path = self._staged_path(key, href)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(img_data)
+            self._staged[(key, href)] = media_type
+        return href
+
+    def add_chapter(
+        self, key: str, author: str, title: str, body_html: str, images: Sequence[str] = ()
+    ) -> None:
+        """Append a post to the spine and TOC of book `key`, with the staged
+        images (hrefs from add_image) it uses."""
+        with self._lock:
+            writer = self._book(key, author)
+            for href in images:
+                media_type = self._staged.pop((key, href), None)
+                if media_type is None:
+                    # In the book already, with an earlier chapter
+                    continue
+                path = self._staged_path(key, href)
+                with open(path, "rb") as f:
+                    writer.add_item(href, f.read(), media_type)
+                os.remove(path)
+            self._chapter_counts[key] += 1
+            href = f"post_{self._chapter_counts[key]:04d}.xhtml"
+            writer.add_chapter(href, title, body_html, stylesheets=["style/default.css"])
+
+    def close(self) -> List[str]:
+        """Finish every book; returns their paths, sorted by book key."""
+        with self._lock:
+            paths = []
+            for key in sorted(self._books):
+                writer = self._books[key]
+                writer.close()
+                paths.append(writer.path)
+            # Left only by posts that failed
+            shutil.rmtree(self._staging_dir, ignore_errors=True)
+            self._staged.clear()
+            return paths
+
+    def abort(self) -> None:
+        with self._lock:
+            for writer in self._books.values():
+                writer.abort()
+            self._books.clear()
+            shutil.rmtree(self._staging_dir, ignore_errors=True)
+            self._staged.clear()
@@ -0,0 +1,140 @@
+"""
+Persistent post-page cache revalidated with conditional GETs.
+
+Entries are keyed by (subdomain, slug, auth tier) so pages rendered for a
+logged-in subscriber are never served to anonymous jobs, and vice versa.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from app.services.storage import CACHE_ROOT, connect
+
+POST_CACHE_PATH = os.path.join(CACHE_ROOT, "posts.sqlite3")
+POST_CACHE_MAX_ENTRIES = int(os.environ.get("POST_CACHE_MAX_ENTRIES", "5000"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    subdomain TEXT NOT NULL,
+    slug TEXT NOT NULL,
+    tier TEXT NOT NULL,
+    body TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (subdomain, slug, tier)
+);
+CREATE INDEX IF NOT EXISTS posts_last_used ON posts (last_used);
+"""
+
+
+def auth_tier(session_cookie: Optional[str]) -> str:
+    """Cache partition for a session: anonymous, or a digest of the cookie.
+
+    A cookie only says someone is logged in, not whether they pay for this
+    newsletter, so each cookie gets its own partition.
+    """
+    if not session_cookie:
+        return "free"
+    return "session-" + hashlib.sha256(session_cookie.encode()).hexdigest()[:16]
+
+
+@dataclass
+class CachedPost:
+    body: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def conditional_headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class PostCache:
+    def __init__(self, path: str = POST_CACHE_PATH, max_entries: int = POST_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = connect(self.path)
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def get(self, subdomain: str, slug: str, tier: str) -> Optional[CachedPost]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._db().execute(
+                "SELECT body, etag, last_modified FROM posts "
+                "WHERE subdomain = ? AND slug = ? AND tier = ?",
+                (subdomain, slug, tier),
+            ).fetchone()
+        if row is None:
+            return None
+        return CachedPost(body=row[0], etag=row[1], last_modified=row[2])
+
+    def revalidated(self, subdomain: str, slug: str, tier: str) -> None:
+        """Record a 304: the cached body is still current."""
+        self.hits += 1
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    "UPDATE posts SET last_used = ? "
+                    "WHERE subdomain = ? AND slug = ? AND tier = ?",
+                    (time.time(), subdomain, slug, tier),
+                )
+
+    def put(
+        self,
+        subdomain: str,
+        slug: str,
+        tier: str,
+        body: str,
+        etag: Optional[str],
+        last_modified: Optional[str],
+    ) -> None:
+        self.misses += 1
+        # Without a validator the entry could never be revalidated
+        if not self.enabled or not (etag or last_modified):
+            return
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO posts "
+                    "(subdomain, slug, tier, body, etag, last_modified, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (subdomain, slug, tier, body, etag, last_modified, time.time()),
+                )
+                db.execute(
+                    "DELETE FROM posts WHERE rowid IN ("
+                    "SELECT rowid FROM posts ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# Singleton
+post_cache = PostCache()
@@ -0,0 +1,179 @@
+"""
+Process-wide token-bucket rate limiter for upstream requests.
+
+One bucket per upstream host, shared by every client, job and request in
+the process. Each bucket adapts to what the host tolerates: the rate creeps
+up while requests succeed, halves on a 429, and the host is paused for the
+Retry-After period (or an exponential backoff when none is given).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+from app.services.metrics import RATE_LIMIT_WAIT, host_kind
+
+# Requests per second to Substack's own hosts (*.substack.com)
+UPSTREAM_RATE = float(os.environ.get("UPSTREAM_RATE", "2"))
+UPSTREAM_MAX_RATE = float(os.environ.get("UPSTREAM_MAX_RATE", "10"))
+# Requests per second to anything else, i.e. image CDNs
+CDN_RATE = float(os.environ.get("CDN_RATE", "50"))
+UPSTREAM_BURST = float(os.environ.get("UPSTREAM_BURST", "4"))
+
+MIN_RATE = 0.1
+RATE_INCREASE = 0.05  # per successful request
+MAX_BACKOFF = 120.0
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def host_key(url: str) -> str:
+    return urlparse(url).netloc.lower()
+
+
+@dataclass
+class _Bucket:
+    rate: float
+    max_rate: float
+    capacity: float
+    tokens: float
+    updated: float
+    blocked_until: float = 0.0
+    consecutive_throttles: int = 0
+    requests: int = 0
+    throttled: int = 0
+    total_wait: float = 0.0
+
+    def refill(self, now: float):
+        # Tokens do not accrue while the host has told us to back off
+        start = max(self.updated, self.blocked_until)
+        if now > start:
+            self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+        self.updated = now
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        upstream_rate: float = UPSTREAM_RATE,
+        upstream_max_rate: float = UPSTREAM_MAX_RATE,
+        cdn_rate: float = CDN_RATE,
+        burst: float = UPSTREAM_BURST,
+    ):
+        self.upstream_rate = upstream_rate
+        self.upstream_max_rate = upstream_max_rate
+        self.cdn_rate = cdn_rate
+        self.burst = burst
+        self._buckets: Dict[str, _Bucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key: str, now: float) -> _Bucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if key == "substack.com" or key.endswith(".substack.com"):
+                rate, max_rate = self.upstream_rate, self.upstream_max_rate
+            else:
+                rate, max_rate = self.cdn_rate, self.cdn_rate
+            bucket = _Bucket(
+                rate=rate,
+                max_rate=max_rate,
+                capacity=max(1.0, self.burst),
+                tokens=max(1.0, self.burst),
+                updated=now,
+            )
+            self._buckets[key] = bucket
+        return bucket
+
+    def reserve(self, url: str) -> float:
+        """Take a token for url's host. Returns how long to wait before sending."""
+        now = time.monotonic()
+        key = host_key(url)
+        with self._lock:
+            bucket = self._bucket(key, now)
+            bucket.refill(now)
+            bucket.tokens -= 1
+            wait = max(0.0, bucket.blocked_until - now)
+            if bucket.tokens < 0:
+                wait += -bucket.tokens / bucket.rate
+            bucket.requests += 1
+            bucket.total_wait += wait
+        if wait > 0:
+            RATE_LIMIT_WAIT.inc(wait, host=host_kind(key))
+        return wait
+
+    def acquire(self, url: str) -> None:
+        wait = self.reserve(url)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, url: str) -> None:
+        wait = self.reserve(url)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def record(self, url: str, status_code: int, retry_after: Optional[str] = None) -> None:
+        """Adapt the host's rate to a response."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket(host_key(url), now)
+            delay = parse_retry_after(retry_after)
+            if status_code == 429:
+                bucket.throttled += 1
+                bucket.consecutive_throttles += 1
+                if delay is None:
+                    delay = 2.0 ** bucket.consecutive_throttles  # 2s, 4s, 8s...
+                bucket.rate = max(MIN_RATE, bucket.rate / 2)
+                bucket.tokens = min(bucket.tokens, 0.0)
+            else:
+                bucket.consecutive_throttles = 0
+                if status_code < 400:
+                    bucket.rate = min(bucket.max_rate, bucket.rate + RATE_INCREASE)
+                if status_code != 503:
+                    delay = None
+            if delay:
+                bucket.blocked_until = max(
+                    bucket.blocked_until, now + min(delay, MAX_BACKOFF)
+                )
+
+    def stats(self) -> Dict[str, dict]:
+        now = time.monotonic()
+        with self._lock:
+            result = {}
+            for key, bucket in sorted(self._buckets.items()):
+                bucket.refill(now)
+                result[key] = {
+                    "rate": round(bucket.rate, 3),
+                    "tokens": round(bucket.tokens, 2),
+                    "blocked_for": round(max(0.0, bucket.blocked_until - now), 2),
+                    "requests": bucket.requests,
+                    "throttled": bucket.throttled,
+                    "total_wait": round(bucket.total_wait, 2),
+                    "avg_wait": round(bucket.total_wait / bucket.requests, 3)
+                    if bucket.requests
+                    else 0.0,
+                }
+            return result
+
+
+# Singleton
+rate_limiter = RateLimiter()
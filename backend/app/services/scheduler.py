@@ -0,0 +1,75 @@
+"""
+Job admission order: concurrency caps and fair queuing.
+
+Picking the next job is a pure function of the waiting and running jobs, so
+the in-process JobManager and queue workers claiming from the job store make
+the same choices.
+
+Fairness comes from the sort key. Clients with fewer running jobs go first,
+and within that, jobs are ordered by arrival time plus a per-post penalty.
+Small jobs overtake big ones, but only by a bounded amount, so a big job
+still runs eventually. Jobs above LARGE_JOB_POSTS also may not take the last
+free slot, which keeps one slot open for small jobs.
+"""
+
+from __future__ import annotations
+
+import os
+from collections import Counter
+from dataclasses import dataclass
+from typing import List, Optional
+
+# Jobs running at once, across the whole deployment
+JOB_MAX_RUNNING = int(os.environ.get("JOB_MAX_RUNNING", "4"))
+# Jobs running at once against one newsletter
+JOB_MAX_PER_SUBDOMAIN = int(os.environ.get("JOB_MAX_PER_SUBDOMAIN", "2"))
+# Jobs running at once for one client (IP address)
+JOB_MAX_PER_CLIENT = int(os.environ.get("JOB_MAX_PER_CLIENT", "2"))
+# Jobs with more posts than this never take the last free slot
+LARGE_JOB_POSTS = int(os.environ.get("LARGE_JOB_POSTS", "200"))
+# Seconds of queueing delay charged per post when ordering waiting jobs
+JOB_SIZE_PENALTY = float(os.environ.get("JOB_SIZE_PENALTY", "0.1"))
+
+
+@dataclass
+class Candidate:
+    job_id: str
+    subdomain: str
+    client_id: str
+    posts: int
+    created_at: float
+
+
+def _order(waiting: List[Candidate], running: List[Candidate]) -> List[Candidate]:
+    per_client = Counter(c.client_id for c in running)
+    return sorted(
+        waiting,
+        key=lambda c: (
+            per_client[c.client_id],
+            c.created_at + JOB_SIZE_PENALTY * c.posts,
+            c.job_id,
+        ),
+    )
+
+
+def pick_next(waiting: List[Candidate], running: List[Candidate]) -> Optional[Candidate]:
+    """The waiting job to start now, or None if caps allow none of them."""
+    free = JOB_MAX_RUNNING - len(running)
+    if free <= 0:
+        return None
+    per_subdomain = Counter(c.subdomain for c in running)
+    per_client = Counter(c.client_id for c in running)
+    for candidate in _order(waiting, running):
+        if per_subdomain[candidate.subdomain] >= JOB_MAX_PER_SUBDOMAIN:
+            continue
+        if per_client[candidate.client_id] >= JOB_MAX_PER_CLIENT:
+            continue
+        if candidate.posts > LARGE_JOB_POSTS and free == 1 and JOB_MAX_RUNNING > 1:
+            continue
+        return candidate
+    return None
+
+
+def queue_positions(waiting: List[Candidate], running: List[Candidate]) -> dict:
+    """1-based position of each waiting job in the order jobs would start."""
+    return {c.job_id: n for n, c in enumerate(_order(waiting, running), start=1)}
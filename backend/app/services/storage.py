@@ -0,0 +1,22 @@
+"""
+Shared on-disk locations and SQLite helpers for the backend's persistent caches.
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import tempfile
+
+CACHE_ROOT = os.environ.get(
+    "STK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "stk_cache")
+)
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open a SQLite database that can be shared between threads and processes."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
@@ -4,16 +4,27 @@ Substack API client — parameterized version of the proven logic from fetch_all
 
 from __future__ import annotations
 
+import os
 import re
 import time
+from dataclasses import dataclass
 from typing import Optional, Tuple, List
 
 import requests
 from bs4 import BeautifulSoup
+from bs4.element import Tag
+
+from app.services import metrics
+from app.services.cdn_images import image_candidates
+from app.services.html_parser import make_soup
+from app.services.image_cache import image_cache
+from app.services.post_cache import auth_tier, post_cache
+from app.services.rate_limiter import rate_limiter
 
 BATCH_SIZE = 50
-DELAY_BETWEEN_REQUESTS = 1.5
 MAX_RETRIES = 3
+# Where a newsletter is served from; benchmarks point this at a local stub
+SUBSTACK_URL = os.environ.get("SUBSTACK_URL", "https://{subdomain}.substack.com")
 
 HEADERS = {
     "User-Agent": (
@@ -23,6 +34,28 @@ HEADERS = {
     ),
 }
 
+IMAGE_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/svg+xml": ".svg",
+}
+
+# Post pages embed their preload state as escaped JSON, e.g. \"audience\":\"only_paid\"
+AUDIENCE_RE = re.compile(r'\\?"audience\\?"\s*:\s*\\?"(\w+)')
+
+
+@dataclass
+class ParsedPost:
+    body: Optional[Tag]
+    title: Optional[str]
+    subtitle: Optional[str]
+    author: str
+    date: str
+    audience: Optional[str] = None
+    paywalled: bool = False
+
 
 class SubstackClient:
     @staticmethod
@@ -31,7 +64,8 @@ class SubstackClient:
 
     def __init__(self, subdomain: str, session_cookie: Optional[str] = None):
         self.subdomain = subdomain
-        self.base_url = f"https://{subdomain}.substack.com"
+        self.base_url = SUBSTACK_URL.format(subdomain=subdomain)
+        self.auth_tier = auth_tier(session_cookie)
         self.session = requests.Session()
         self.session.headers.update(HEADERS)
         if session_cookie:
@@ -45,20 +79,32 @@ class SubstackClient:
             all_posts.extend(batch)
         return all_posts
 
-    def _get_with_retry(self, url: str, timeout: int = 30) -> requests.Response:
-        """GET with exponential backoff on 429 rate limits."""
-        for attempt in range(MAX_RETRIES):
-            resp = self.session.get(url, timeout=timeout)
-            if resp.status_code == 429:
-                wait = 2 ** (attempt + 1)  # 2s, 4s, 8s
-                time.sleep(wait)
+    def _get_with_retry(
+        self, url: str, timeout: int = 30, headers: Optional[dict] = None
+    ) -> requests.Response:
+        """GET paced by the shared rate limiter, retrying 429s.
+
+        The limiter holds the host back for Retry-After (or an exponential
+        backoff) after a 429, so retries simply queue for the next token.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            rate_limiter.acquire(url)
+            start = time.perf_counter()
+            try:
+                resp = self.session.get(url, timeout=timeout, headers=headers)
+            except requests.RequestException:
+                metrics.UPSTREAM_ERRORS.inc(host=metrics.url_kind(url))
+                raise
+            metrics.observe_upstream(
+                url, resp.status_code, time.perf_counter() - start, len(resp.content)
+            )
+            rate_limiter.record(url, resp.status_code, resp.headers.get("Retry-After"))
+            if resp.status_code == 429 and attempt < MAX_RETRIES:
+                metrics.UPSTREAM_RETRIES.inc(host=metrics.url_kind(url))
                 continue
+            # Final attempt — let it raise
             resp.raise_for_status()
             return resp
-        # Final attempt — let it raise
-        resp = self.session.get(url, timeout=timeout)
-        resp.raise_for_status()
-        return resp
 
     def fetch_post_metadata_batches(self):
         """Yield batches of post metadata as they're fetched from the API."""
@@ -74,34 +120,89 @@ class SubstackClient:
                 break
             yield posts
             offset += len(posts)
-            time.sleep(DELAY_BETWEEN_REQUESTS)
 
     def fetch_post_html(self, slug: str) -> str:
         url = f"{self.base_url}/p/{slug}"
-        resp = self._get_with_retry(url)
+        cached = post_cache.get(self.subdomain, slug, self.auth_tier)
+        headers = cached.conditional_headers() if cached else None
+        resp = self._get_with_retry(url, headers=headers)
+        if resp.status_code == 304 and cached is not None:
+            post_cache.revalidated(self.subdomain, slug, self.auth_tier)
+            return cached.body
+        post_cache.put(
+            self.subdomain,
+            slug,
+            self.auth_tier,
+            resp.text,
+            resp.headers.get("ETag"),
+            resp.headers.get("Last-Modified"),
+        )
         return resp.text
 
     def download_image(self, img_url: str) -> Tuple[Optional[bytes], Optional[str], Optional[str]]:
-        try:
-            resp = self._get_with_retry(img_url, timeout=15)
-            content_type = (
-                resp.headers.get("Content-Type", "image/jpeg").split(";")[0].strip()
-            )
-            ext_map = {
-                "image/jpeg": ".jpg",
-                "image/png": ".png",
-                "image/gif": ".gif",
-                "image/webp": ".webp",
-                "image/svg+xml": ".svg",
-            }
-            ext = ext_map.get(content_type, ".jpg")
-            return resp.content, content_type, ext
-        except Exception:
-            return None, None, None
+        # A pre-sized CDN variant first, the original if the CDN fails
+        for url in image_candidates(img_url):
+            cached = image_cache.get(url)
+            if cached is not None:
+                return cached
+            try:
+                resp = self._get_with_retry(url, timeout=15)
+                content_type = (
+                    resp.headers.get("Content-Type", "image/jpeg").split(";")[0].strip()
+                )
+                if not content_type.startswith("image/"):
+                    continue
+                ext = IMAGE_EXTENSIONS.get(content_type, ".jpg")
+                image_cache.put(url, resp.content, content_type, ext)
+                return resp.content, content_type, ext
+            except Exception:
+                continue
+        return None, None, None
+
+    @staticmethod
+    def parse_post(html: str) -> ParsedPost:
+        """Parse a post page once and extract its body and metadata."""
+        soup = make_soup(html)
+
+        # Metadata first: cleaning the body decomposes tags in place
+        title_tag = soup.find("h1", class_=lambda c: c and "post-title" in c)
+        title = title_tag.get_text(strip=True) if title_tag else None
+
+        author_meta = soup.find("meta", {"name": "author"})
+        author = (
+            author_meta["content"]
+            if author_meta and author_meta.get("content")
+            else "Unknown"
+        )
+
+        time_tag = soup.find("time")
+        date_str = ""
+        if time_tag and time_tag.get("datetime"):
+            date_str = time_tag["datetime"][:10]
+
+        audience_match = AUDIENCE_RE.search(html)
+        paywalled = soup.find(class_="paywall") is not None
+
+        return ParsedPost(
+            body=SubstackClient._extract_body(soup),
+            title=title,
+            subtitle=SubstackClient._find_subtitle(soup),
+            author=author,
+            date=date_str,
+            audience=audience_match.group(1) if audience_match else None,
+            paywalled=paywalled,
+        )
 
     @staticmethod
     def extract_article_content(html: str) -> Optional[BeautifulSoup]:
-        soup = BeautifulSoup(html, "html.parser")
+        return SubstackClient._extract_body(make_soup(html))
+
+    @staticmethod
+    def extract_subtitle(html: str) -> Optional[str]:
+        return SubstackClient._find_subtitle(make_soup(html))
+
+    @staticmethod
+    def _extract_body(soup: BeautifulSoup) -> Optional[Tag]:
         body = soup.find("div", class_="body")
         if not body:
             body = soup.find("div", class_="available-content")
@@ -149,8 +250,7 @@ class SubstackClient:
         return body
 
     @staticmethod
-    def extract_subtitle(html: str) -> Optional[str]:
-        soup = BeautifulSoup(html, "html.parser")
+    def _find_subtitle(soup: BeautifulSoup) -> Optional[str]:
         subtitle = soup.find("h3", class_=re.compile(r"subtitle"))
         if subtitle:
             return subtitle.get_text(strip=True)
@@ -0,0 +1,186 @@
+"""
+Asyncio Substack client — same surface as SubstackClient, without threads.
+
+Every client shares one pooled HTTP/2 transport with keep-alive, so hundreds
+of upstream requests can be in flight on the event loop at once. Each client
+keeps its own cookie jar, so one job's session cookie never leaks into
+another's requests.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import AsyncIterator, List, Optional, Tuple
+
+import httpx
+
+from app.services.cdn_images import image_candidates
+from app.services import metrics, substack
+from app.services.image_cache import image_cache
+from app.services.post_cache import auth_tier, post_cache
+from app.services.rate_limiter import rate_limiter
+from app.services.substack import BATCH_SIZE, HEADERS, IMAGE_EXTENSIONS, MAX_RETRIES
+
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "200"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "50"))
+
+_transport: Optional[httpx.AsyncHTTPTransport] = None
+
+
+class _SharedTransport(httpx.AsyncBaseTransport):
+    """Delegates to the process-wide pool; closing a client leaves the pool open."""
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        pass
+
+
+def _shared_transport() -> _SharedTransport:
+    global _transport
+    if _transport is None:
+        _transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            ),
+        )
+    return _SharedTransport(_transport)
+
+
+async def close_http_transport() -> None:
+    global _transport
+    if _transport is not None:
+        await _transport.aclose()
+        _transport = None
+
+
+def _raise_for_status(resp: httpx.Response) -> None:
+    # 304 answers a conditional GET; it is not an error here
+    if resp.status_code != 304:
+        resp.raise_for_status()
+
+
+class AsyncSubstackClient:
+    def __init__(self, subdomain: str, session_cookie: Optional[str] = None):
+        self.subdomain = subdomain
+        self.base_url = substack.SUBSTACK_URL.format(subdomain=subdomain)
+        self.auth_tier = auth_tier(session_cookie)
+        self.http = httpx.AsyncClient(
+            transport=_shared_transport(),
+            headers=HEADERS,
+            follow_redirects=True,
+        )
+        if session_cookie:
+            self.http.cookies.set(
+                "substack.sid", session_cookie, domain=".substack.com"
+            )
+
+    async def _get_with_retry(
+        self, url: str, timeout: int = 30, headers: Optional[dict] = None
+    ) -> httpx.Response:
+        """GET paced by the shared rate limiter, retrying 429s."""
+        for attempt in range(MAX_RETRIES + 1):
+            await rate_limiter.acquire_async(url)
+            start = time.perf_counter()
+            try:
+                resp = await self.http.get(url, timeout=timeout, headers=headers)
+            except httpx.HTTPError:
+                metrics.UPSTREAM_ERRORS.inc(host=metrics.url_kind(url))
+                raise
+            metrics.observe_upstream(
+                url, resp.status_code, time.perf_counter() - start, len(resp.content)
+            )
+            rate_limiter.record(url, resp.status_code, resp.headers.get("Retry-After"))
+            if resp.status_code == 429 and attempt < MAX_RETRIES:
+                metrics.UPSTREAM_RETRIES.inc(host=metrics.url_kind(url))
+                continue
+            # Final attempt — let it raise
+            _raise_for_status(resp)
+            return resp
+
+    async def fetch_archive_page(self, offset: int = 0, limit: int = BATCH_SIZE) -> List[dict]:
+        url = (
+            f"{self.base_url}/api/v1/archive"
+            f"?sort=new&search=&offset={offset}&limit={limit}"
+        )
+        resp = await self._get_with_retry(url)
+        return resp.json()
+
+    async def fetch_post_metadata_batches(self) -> AsyncIterator[List[dict]]:
+        """Yield batches of post metadata as they're fetched from the API."""
+        offset = 0
+        while True:
+            posts = await self.fetch_archive_page(offset)
+            if not posts:
+                break
+            yield posts
+            offset += len(posts)
+
+    async def fetch_all_post_metadata(self) -> List[dict]:
+        all_posts = []
+        async for batch in self.fetch_post_metadata_batches():
+            all_posts.extend(batch)
+        return all_posts
+
+    async def fetch_post_html(self, slug: str) -> str:
+        url = f"{self.base_url}/p/{slug}"
+        cached = await asyncio.to_thread(
+            post_cache.get, self.subdomain, slug, self.auth_tier
+        )
+        headers = cached.conditional_headers() if cached else None
+        resp = await self._get_with_retry(url, headers=headers)
+        if resp.status_code == 304 and cached is not None:
+            await asyncio.to_thread(
+                post_cache.revalidated, self.subdomain, slug, self.auth_tier
+            )
+            return cached.body
+        await asyncio.to_thread(
+            post_cache.put,
+            self.subdomain,
+            slug,
+            self.auth_tier,
+            resp.text,
+            resp.headers.get("ETag"),
+            resp.headers.get("Last-Modified"),
+        )
+        return resp.text
+
+    async def download_image(
+        self, img_url: str
+    ) -> Tuple[Optional[bytes], Optional[str], Optional[str]]:
+        for url in image_candidates(img_url):
+            cached = await asyncio.to_thread(image_cache.get, url)
+            if cached is not None:
+                return cached
+            try:
+                resp = await self._get_with_retry(url, timeout=15)
+                content_type = (
+                    resp.headers.get("Content-Type", "image/jpeg").split(";")[0].strip()
+                )
+                if not content_type.startswith("image/"):
+                    continue
+                ext = IMAGE_EXTENSIONS.get(content_type, ".jpg")
+                await asyncio.to_thread(
+                    image_cache.put, url, resp.content, content_type, ext
+                )
+                return resp.content, content_type, ext
+            except Exception:
+                continue
+        return None, None, None
+
+    async def aclose(self) -> None:
+        await self.http.aclose()
+
+    async def __aenter__(self) -> "AsyncSubstackClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
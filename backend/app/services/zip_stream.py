@@ -0,0 +1,93 @@
+"""
+ZIP assembly for job output: appended to incrementally, or streamed on the fly.
+
+Members that are already compressed (EPUBs, images) are stored rather than
+deflated a second time.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import shutil
+import time
+import zipfile
+from typing import Iterator, List, Optional
+
+CHUNK_SIZE = 64 * 1024
+
+PRECOMPRESSED_EXTENSIONS = {".epub", ".zip", ".jpg", ".jpeg", ".png", ".gif", ".webp"}
+
+
+def compress_type(name: str) -> int:
+    ext = os.path.splitext(name)[1].lower()
+    return zipfile.ZIP_STORED if ext in PRECOMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def _zip_info(path: str) -> zipfile.ZipInfo:
+    arcname = os.path.basename(path)
+    mtime = time.localtime(os.path.getmtime(path))
+    info = zipfile.ZipInfo(arcname, date_time=mtime[:6])
+    info.compress_type = compress_type(arcname)
+    info.file_size = os.path.getsize(path)
+    return info
+
+
+class IncrementalZip:
+    """A ZIP file that members are appended to as they become available."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.names: List[str] = []
+        self._zf: Optional[zipfile.ZipFile] = None
+
+    def add(self, path: str) -> None:
+        if self._zf is None:
+            self._zf = zipfile.ZipFile(self.path, "w")
+        info = _zip_info(path)
+        with open(path, "rb") as src, self._zf.open(info, "w") as dest:
+            shutil.copyfileobj(src, dest, CHUNK_SIZE)
+        self.names.append(info.filename)
+
+    def close(self) -> None:
+        if self._zf is not None:
+            self._zf.close()
+            self._zf = None
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, unseekable buffer that zipfile streams into."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(paths: List[str]) -> Iterator[bytes]:
+    """Generate a ZIP of paths chunk by chunk, without a temporary file."""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w") as zf:
+        for path in paths:
+            with open(path, "rb") as src, zf.open(_zip_info(path), "w") as dest:
+                while True:
+                    block = src.read(CHUNK_SIZE)
+                    if not block:
+                        break
+                    dest.write(block)
+                    data = sink.drain()
+                    if data:
+                        yield data
+    data = sink.drain()
+    if data:
+        yield data
@@ -0,0 +1,94 @@
+"""
+Job worker for WORKER_MODE=queue.
+
+    cd backend && WORKER_MODE=queue python -m app.worker
+
+Claims queued jobs from the job store and runs them, up to WORKER_JOBS at a
+time. Run as many workers as there are cores to spare; all that they and the
+API share is JOB_DATA_DIR. A job whose worker stops heartbeating is claimed
+again by another worker and resumes from its checkpoints.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+from typing import Set
+
+from app.services.image_processor import shutdown_pool
+from app.services.job_manager import JobManager
+from app.services.job_store import JOB_CLAIM_TIMEOUT, job_store
+from app.services.metrics import registry
+from app.services.scheduler import pick_next
+from app.services.substack_async import close_http_transport
+
+logger = logging.getLogger(__name__)
+
+# Jobs one worker process runs at once
+WORKER_JOBS = int(os.environ.get("WORKER_JOBS", "2"))
+HEARTBEAT_INTERVAL = JOB_CLAIM_TIMEOUT / 4
+POLL_INTERVAL = 1.0
+
+
+async def _export_metrics(worker_id: str):
+    """Leave this worker's metrics in the job store for the API to serve."""
+    await asyncio.to_thread(job_store.put_worker_metrics, worker_id, registry.export())
+
+
+async def _heartbeat(worker_id: str):
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        await asyncio.to_thread(job_store.heartbeat, worker_id)
+        await _export_metrics(worker_id)
+
+
+async def run_worker():
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    manager = JobManager(job_store, queued=False)
+    running: Set[asyncio.Task] = set()
+    stopping = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    heartbeat = asyncio.create_task(_heartbeat(worker_id))
+    logger.info("Worker %s taking up to %d jobs", worker_id, WORKER_JOBS)
+    try:
+        while not stopping.is_set():
+            if len(running) < WORKER_JOBS:
+                # Scheduler caps apply across all workers, not per process
+                claimed = await asyncio.to_thread(job_store.claim, worker_id, pick_next)
+                if claimed is not None:
+                    record, cookie = claimed
+                    logger.info("Worker %s claimed job %s", worker_id, record.id)
+                    task = asyncio.create_task(manager.run_claimed(record, cookie))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+                    continue
+            try:
+                await asyncio.wait_for(stopping.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # Unfinished jobs keep their claim until it times out, then another
+        # worker resumes them from their checkpoints
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        heartbeat.cancel()
+        await _export_metrics(worker_id)
+        await close_http_transport()
+        shutdown_pool()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    asyncio.run(run_worker())
+
+
+if __name__ == "__main__":
+    main()
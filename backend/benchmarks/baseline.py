@@ -0,0 +1,119 @@
+"""
+Baseline files shared by the benchmarks: record a run, compare a later one.
+
+A baseline is JSON holding the machine it was recorded on, the settings of
+the run and its results, keyed by case and then by figure. A later run
+regresses when a figure is worse than the baseline's by more than that
+figure's tolerance (a fraction) and, where a floor is given, by more than
+the floor in absolute terms, so that tiny figures do not fail on noise.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import platform
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+Results = Dict[str, Dict[str, float]]
+
+
+def machine() -> dict:
+    return {
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+    }
+
+
+def report(settings: dict, results: Results) -> dict:
+    return {"machine": machine(), "settings": settings, "results": results}
+
+
+def save(path: str, settings: dict, results: Results) -> None:
+    with open(path, "w") as f:
+        json.dump(report(settings, results), f, indent=2)
+        f.write("\n")
+    print(f"Baseline saved to {path}")
+
+
+def _compare(
+    results: Results,
+    baseline: dict,
+    tolerances: Dict[str, float],
+    floors: Optional[Dict[str, float]] = None,
+    higher_is_better: Iterable[str] = (),
+) -> Iterator[Tuple[str, str]]:
+    """(case, message) for each figure of results worse than the baseline's."""
+    floors = floors or {}
+    higher_is_better = set(higher_is_better)
+    for name, result in results.items():
+        if "error" in result:
+            yield name, f"{name}: {result['error']}"
+            continue
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        for key, tolerance in tolerances.items():
+            old, new = before.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if key in higher_is_better else change
+            if abs(new - old) < floors.get(key, 0):
+                continue
+            if worse > tolerance:
+                yield name, (
+                    f"{name}: {key} {old} -> {new} ({change:+.0%}, tolerance {tolerance:.0%})"
+                )
+
+
+def regressions(
+    results: Results,
+    baseline: dict,
+    tolerances: Dict[str, float],
+    floors: Optional[Dict[str, float]] = None,
+    higher_is_better: Iterable[str] = (),
+) -> List[str]:
+    """Figures of results worse than the baseline's, as messages."""
+    return [m for _, m in _compare(results, baseline, tolerances, floors, higher_is_better)]
+
+
+def regressed_cases(
+    results: Results,
+    baseline: dict,
+    tolerances: Dict[str, float],
+    floors: Optional[Dict[str, float]] = None,
+    higher_is_better: Iterable[str] = (),
+) -> Set[str]:
+    """Cases with any figure worse than the baseline's, e.g. to measure again."""
+    return {n for n, _ in _compare(results, baseline, tolerances, floors, higher_is_better)}
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def check(
+    path: str,
+    settings: dict,
+    results: Results,
+    tolerances: Dict[str, float],
+    floors: Optional[Dict[str, float]] = None,
+    higher_is_better: Iterable[str] = (),
+) -> int:
+    """Print how results compare with the baseline at path; 1 on regression."""
+    baseline = load(path)
+    if baseline["machine"] != machine():
+        print("Warning: baseline recorded on a different machine", file=sys.stderr)
+    if baseline["settings"] != settings:
+        print("Warning: baseline recorded with different settings", file=sys.stderr)
+    found = regressions(results, baseline, tolerances, floors, higher_is_better)
+    for message in found:
+        print(f"REGRESSION {message}")
+    if not found:
+        print("No regressions against the baseline")
+    return 1 if found else 0
@@ -0,0 +1,104 @@
+"""
+Compare per-post CPU time of the old three-parse extraction with parse_post.
+
+Usage (from backend/):
+    python -m benchmarks.bench_extraction [page.html ...]
+
+Without arguments a synthetic Substack post page is used.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import re
+import time
+from typing import Callable, List, Optional
+
+from bs4 import BeautifulSoup
+
+from app.services.substack import SubstackClient
+
+
+def synthetic_post(paragraphs: int = 150, footnotes: int = 20, images: int = 10) -> str:
+    """A post page shaped like Substack's: heavy head, preload JSON, article body."""
+    preload = json.dumps({"post": {"audience": "everyone", "body_html": "x" * 20000}})
+    body = []
+    for i in range(paragraphs):
+        anchor = ""
+        if i < footnotes:
+            anchor = (
+                f'<a class="footnote-anchor" data-component-name="FootnoteAnchorToDOM" '
+                f'id="footnote-anchor-{i + 1}-1" href="https://x.substack.com/p/y#footnote-{i + 1}-1" '
+                f'target="_self">{i + 1}</a>'
+            )
+        body.append(f"<p>Paragraph {i} <em>with</em> some <a href='#'>links</a> and text.{anchor}</p>")
+        if i % max(1, paragraphs // max(1, images)) == 0:
+            body.append(
+                f'<figure><picture><source type="image/webp" srcset="https://substackcdn.com/{i}.webp"/>'
+                f'<img src="https://substackcdn.com/{i}.jpeg" width="1456" height="816"/></picture>'
+                f"<figcaption>Caption {i}</figcaption></figure>"
+            )
+    for i in range(footnotes):
+        body.append(
+            f'<div class="footnote" data-component-name="FootnoteToDOM">'
+            f'<a id="footnote-{i + 1}-1" href="#footnote-anchor-{i + 1}-1" class="footnote-number" '
+            f'contenteditable="false" target="_self">{i + 1}</a>'
+            f'<div class="footnote-content"><p>Footnote {i + 1}.</p></div></div>'
+        )
+    head = "".join(f'<link rel="preload" href="/static/{i}.js"/>' for i in range(60))
+    return (
+        f'<html><head><meta name="author" content="Author"/>{head}'
+        f"<script>window._preloads = JSON.parse({json.dumps(preload)})</script></head><body>"
+        f'<nav>{"<a href=#>nav</a>" * 80}</nav><article>'
+        f'<h1 class="post-title published">Title</h1><h3 class="subtitle">Subtitle</h3>'
+        f'<time datetime="2024-01-02T00:00:00Z">Jan 2</time>'
+        f'<div class="available-content"><div class="body markup">{"".join(body)}</div></div>'
+        f'<div class="subscribe-widget">Subscribe</div></article>'
+        f'<footer>{"<p>footer</p>" * 40}</footer></body></html>'
+    )
+
+
+def three_parses(html: str):
+    """What run_job did before parse_post: one parse per lookup."""
+    content = SubstackClient.extract_article_content(html)
+    subtitle = SubstackClient.extract_subtitle(html)
+    soup = BeautifulSoup(html, "html.parser")
+    title_tag = soup.find("h1", class_=lambda c: c and "post-title" in c)
+    author_meta = soup.find("meta", {"name": "author"})
+    time_tag = soup.find("time")
+    return content, subtitle, title_tag, author_meta, time_tag
+
+
+def cpu_per_call(fn: Callable[[str], object], html: str, repeat: int) -> float:
+    fn(html)  # warm up
+    start = time.process_time()
+    for _ in range(repeat):
+        fn(html)
+    return (time.process_time() - start) / repeat
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("pages", nargs="*", help="post HTML files")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    pages = [(path, open(path, encoding="utf-8").read()) for path in args.pages]
+    if not pages:
+        pages = [("synthetic", synthetic_post())]
+
+    print(f"{'page':<40} {'KB':>6} {'3 parses ms':>12} {'parse_post ms':>14} {'saved':>7}")
+    for name, html in pages:
+        old = cpu_per_call(three_parses, html, args.repeat)
+        new = cpu_per_call(SubstackClient.parse_post, html, args.repeat)
+        saved = 1 - new / old if old else 0.0
+        label = re.sub(r".*/", "", name)[:40]
+        print(
+            f"{label:<40} {len(html) / 1024:>6.0f} {old * 1000:>12.1f} "
+            f"{new * 1000:>14.1f} {saved:>6.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
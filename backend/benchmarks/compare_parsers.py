@@ -0,0 +1,99 @@
+"""
+Check that every HTML parser backend produces identical EPUBs, and time them.
+
+Usage (from backend/):
+    python -m benchmarks.compare_parsers [page.html ...]
+
+Defaults to the fixture corpus in benchmarks/corpus. Image downloads are
+stubbed. Exits non-zero if any EPUB member differs from the html.parser
+build.
+"""
+
+from __future__ import annotations
+
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from typing import Dict, List, Optional, Tuple
+
+from app.services import html_parser
+from app.services.epub_builder import build_epub
+from app.services.substack import SubstackClient
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+
+class StubClient:
+    """Stands in for SubstackClient: images are derived from their URL."""
+
+    subdomain = "bench"
+
+    def download_image(self, img_url: str) -> Tuple[bytes, str, str]:
+        return img_url.encode(), "image/jpeg", ".jpg"
+
+
+def corpus_pages(paths: List[str]) -> List[str]:
+    return paths or sorted(glob.glob(os.path.join(CORPUS_DIR, "*.html")))
+
+
+def build_with(
+    backend: str, html: str, slug: str, repeat: int
+) -> Tuple[Dict[str, bytes], float]:
+    """Build one EPUB with the given backend.
+
+    Returns (members, best parse_post CPU seconds over `repeat` runs).
+    """
+    html_parser.PARSER_BACKEND = backend
+    parse_seconds = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        post = SubstackClient.parse_post(html)
+        parse_seconds = min(parse_seconds, time.process_time() - start)
+    if post.body is None:
+        return {}, parse_seconds
+    with tempfile.TemporaryDirectory() as out:
+        result = build_epub(
+            StubClient(),
+            post.title or slug,
+            post.author,
+            post.date,
+            post.body,
+            out,
+            post.subtitle,
+            slug,
+            # A fixed time, so builds of undated posts compare equal too
+            modified=0.0,
+        )
+        with zipfile.ZipFile(result.path) as zf:
+            members = {name: zf.read(name) for name in zf.namelist()}
+    return members, parse_seconds
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("pages", nargs="*", help="post HTML files")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    backends = [b for b in html_parser.PARSER_BACKENDS if b != "lxml" or html_parser.HAS_LXML]
+    failures = 0
+    print(f"{'page':<28}" + "".join(f"{b + ' ms':>16}" for b in backends) + "  identical")
+    for path in corpus_pages(args.pages):
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+        slug = os.path.splitext(os.path.basename(path))[0]
+        builds = {b: build_with(b, html, slug, args.repeat) for b in backends}
+        reference, _ = builds["html.parser"]
+        identical = all(members == reference for members, _ in builds.values())
+        failures += not identical
+        timings = "".join(f"{seconds * 1000:>16.1f}" for _, seconds in builds.values())
+        print(f"{slug[:28]:<28}{timings}  {'yes' if identical else 'NO'}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,422 @@
+"""
+End-to-end benchmarks: whole jobs, endpoints and CLI scripts against a local Substack stub.
+
+Usage (from backend/):
+    python -m benchmarks.e2e                      # every scenario
+    python -m benchmarks.e2e job-cold cli-fetch-all
+    python -m benchmarks.e2e --save-baseline      # record benchmarks/e2e_baseline.json
+    python -m benchmarks.e2e --check              # exit 1 if slower than the baseline
+
+Each scenario runs in its own process, with a fresh STK_CACHE_DIR and
+SUBSTACK_URL pointed at benchmarks.stub_server, so peak RSS and caches are
+per scenario. The stub is served by this process and counts the requests
+and bytes each scenario causes.
+
+Reported per scenario: posts per second, p50/p99 latency, peak RSS and
+traffic. For jobs, a post's latency runs from the first request for its page
+to its checkpoint; for the CLI scripts it is the time between consecutive
+posts; for the newsletter endpoints it is per request, and "posts" counts the
+posts listed.
+
+The stub is reached over 127.0.0.1, so the rate limiter paces it as a CDN
+host; CDN_RATE is raised so that pacing does not dominate the numbers.
+Timings vary from run to run on a busy machine; --repeat runs each scenario
+several times and reports the median of each figure. Baselines only compare
+on the machine they were recorded on: re-record one with --save-baseline
+after changing machines.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import importlib
+import io
+import json
+import math
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from benchmarks import baseline
+from benchmarks.stub_server import StubConfig, StubServer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_ROOT = os.path.dirname(BACKEND_DIR)
+BASELINE_PATH = os.path.join(BACKEND_DIR, "benchmarks", "e2e_baseline.json")
+
+# Worst change from the baseline tolerated before --check fails, as a fraction
+# (throughput may drop, the others may grow)
+TOLERANCES = {
+    "posts_per_sec": 0.20,
+    "p99_ms": 0.30,
+    "peak_rss_mb": 0.25,
+    "bytes": 0.10,
+    "requests": 0.10,
+}
+# Changes smaller than these are noise, whatever the fraction
+FLOORS = {"p99_ms": 50}
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    # StubConfig fields overriding the command line settings
+    stub: Dict[str, object] = field(default_factory=dict)
+    # Environment for the scenario's process
+    env: Dict[str, str] = field(default_factory=dict)
+
+
+SCENARIOS = [
+    Scenario("job-cold", "One job over every post, empty caches"),
+    Scenario("job-warm", "The same job again, on the caches the first run left"),
+    Scenario(
+        "job-throttled",
+        "One job with 5% of requests answered 429",
+        stub={"throttle_rate": 0.05, "retry_after": "1"},
+    ),
+    Scenario("jobs-concurrent", "Six jobs over three newsletters through the scheduler"),
+    Scenario("newsletter-endpoints", "Post list endpoints, cold then warm"),
+    Scenario("cli-fetch-all", "fetch_all.py over every post"),
+    Scenario("cli-fetch-substack", "fetch_substack.py over every post"),
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile; 0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+# --- Scenario bodies, run in the child process ------------------------------
+
+
+class _Stub:
+    """The parent's stub, seen from a scenario process."""
+
+    def __init__(self, base: str):
+        self.base = base
+
+    def _get(self, path: str) -> dict:
+        with urllib.request.urlopen(self.base + path) as resp:
+            return json.load(resp)
+
+    def reset(self) -> None:
+        self._get("/_stub/reset")
+
+    def stats(self) -> dict:
+        return self._get("/_stub/stats")
+
+    def url(self, subdomain: str) -> str:
+        return f"{self.base}/{subdomain}"
+
+
+def _slugs(posts: int, start: int = 0) -> List[str]:
+    from benchmarks.stub_server import archive_entry
+
+    return [archive_entry(i, posts)["slug"] for i in range(start, posts)]
+
+
+def _job_latencies(jobs, done: Dict[tuple, float], first_seen: Dict[str, float], start: float):
+    latencies = []
+    for job in jobs:
+        for i, slug in enumerate(job.slugs):
+            finished = done.get((job.id, i))
+            if finished is not None:
+                began = first_seen.get(f"/{job.subdomain}/p/{slug}", start)
+                latencies.append(finished - began)
+    return latencies
+
+
+def _timed_store():
+    from app.services.job_store import JobStore
+
+    class TimedStore(JobStore):
+        """Records when each post is checkpointed."""
+
+        def __init__(self):
+            super().__init__()
+            self.done: Dict[tuple, float] = {}
+
+        def checkpoint(self, job_id: str, idx: int, *args, **kwargs) -> None:
+            self.done[(job_id, idx)] = time.time()
+            super().checkpoint(job_id, idx, *args, **kwargs)
+
+    return TimedStore()
+
+
+async def _run_jobs(stub: _Stub, posts: int, concurrent: bool, warm: bool) -> dict:
+    from app.services.job_manager import JobManager, JobStatus
+
+    store = _timed_store()
+    manager = JobManager(store=store, queued=False)
+    if warm:
+        await manager.run_job(manager.create_job("bench", _slugs(posts)))
+
+    if concurrent:
+        # Two disjoint halves of three newsletters: two run per newsletter
+        # and the scheduler interleaves them
+        half = posts // 2
+        specs = [(f"bench-{n}", _slugs(half), _slugs(posts, half)) for n in "abc"]
+        jobs = [manager.create_job(sub, slugs) for sub, *parts in specs for slugs in parts]
+    else:
+        jobs = [manager.create_job("bench", _slugs(posts))]
+
+    stub.reset()
+    store.done.clear()
+    start = time.time()
+    if concurrent:
+        for job in jobs:
+            manager.submit(job)
+        while any(j.status not in (JobStatus.COMPLETED, JobStatus.FAILED) for j in jobs):
+            await asyncio.sleep(0.05)
+    else:
+        await manager.run_job(jobs[0])
+    elapsed = time.time() - start
+    stats = stub.stats()
+
+    failed = [j for j in jobs if j.status != JobStatus.COMPLETED or j.failed]
+    if failed:
+        raise RuntimeError(f"job {failed[0].id}: {failed[0].status.value} {failed[0].error}")
+    return {
+        "posts": sum(j.total for j in jobs),
+        "seconds": elapsed,
+        "latencies": _job_latencies(jobs, store.done, stats["first_seen"], start),
+        "stats": stats,
+    }
+
+
+async def _run_endpoints(stub: _Stub, posts: int, calls: int = 20) -> dict:
+    import httpx
+
+    from app.main import app
+
+    stub.reset()
+    latencies = []
+    listed = 0
+    start = time.time()
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=300
+    ) as client:
+        # The streaming list on one newsletter, then the plain list on
+        # another, cold; then both warm
+        paths = ["/api/newsletter/bench-s/posts/stream", "/api/newsletter/bench/posts"]
+        paths += ["/api/newsletter/bench-s/posts", "/api/newsletter/bench/posts"] * (calls // 2)
+        for path in paths:
+            began = time.perf_counter()
+            resp = await client.get(path)
+            resp.raise_for_status()
+            latencies.append(time.perf_counter() - began)
+            if path.endswith("/stream"):
+                listed += resp.text.count('"slug"')
+            else:
+                listed += resp.json()["total"]
+    elapsed = time.time() - start
+    return {"posts": listed, "seconds": elapsed, "latencies": latencies, "stats": stub.stats()}
+
+
+def _run_cli(stub: _Stub, module_name: str) -> dict:
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    module = importlib.import_module(module_name)
+    module.SUBSTACK_BASE = stub.url("bench")
+    module.OUTPUT_DIR = tempfile.mkdtemp(prefix="stk-bench-")
+    module.DELAY_BETWEEN_REQUESTS = 0
+
+    stub.reset()
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.main()
+    elapsed = time.time() - start
+    stats = stub.stats()
+    shutil.rmtree(module.OUTPUT_DIR, ignore_errors=True)
+
+    # Posts run one after another: each lasts until the next page is asked for
+    marks = sorted(stats["first_seen"].values()) + [start + elapsed]
+    latencies = [b - a for a, b in zip(marks, marks[1:])]
+    return {"posts": len(latencies), "seconds": elapsed, "latencies": latencies, "stats": stats}
+
+
+def run_child(name: str, stub_base: str, posts: int) -> dict:
+    stub = _Stub(stub_base)
+    bodies: Dict[str, Callable[[], dict]] = {
+        "job-cold": lambda: asyncio.run(_run_jobs(stub, posts, False, False)),
+        "job-warm": lambda: asyncio.run(_run_jobs(stub, posts, False, True)),
+        "job-throttled": lambda: asyncio.run(_run_jobs(stub, posts, False, False)),
+        "jobs-concurrent": lambda: asyncio.run(_run_jobs(stub, posts, True, False)),
+        "newsletter-endpoints": lambda: asyncio.run(_run_endpoints(stub, posts)),
+        "cli-fetch-all": lambda: _run_cli(stub, "fetch_all"),
+        "cli-fetch-substack": lambda: _run_cli(stub, "fetch_substack"),
+    }
+    run = bodies[name]()
+    # ru_maxrss is in KiB on Linux and bytes on macOS; image pool workers
+    # count through RUSAGE_CHILDREN
+    scale = 1 if sys.platform == "darwin" else 1024
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    ) * scale
+    latencies = run["latencies"]
+    return {
+        "posts": run["posts"],
+        "seconds": round(run["seconds"], 3),
+        "posts_per_sec": round(run["posts"] / run["seconds"], 2) if run["seconds"] else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "peak_rss_mb": round(peak / 2**20, 1),
+        "bytes": run["stats"]["bytes_sent"],
+        "requests": run["stats"]["requests"],
+        "throttled": run["stats"]["throttled"],
+    }
+
+
+# --- Parent: stub, scenario processes, report, baseline --------------------
+
+
+def run_scenario(scenario: Scenario, stub: StubServer, args: argparse.Namespace) -> dict:
+    config = StubConfig(
+        posts=args.posts, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms
+    )
+    for key, value in scenario.stub.items():
+        setattr(config, key, value)
+    stub.reset(config)
+
+    cache_dir = tempfile.mkdtemp(prefix="stk-bench-cache-")
+    env = {
+        **os.environ,
+        "PYTHONPATH": BACKEND_DIR,
+        "STK_CACHE_DIR": cache_dir,
+        "SUBSTACK_URL": stub.substack_url,
+        "CDN_RATE": "1000",
+        **scenario.env,
+    }
+    for name in ("JOB_DATA_DIR", "WORKER_MODE"):
+        env.pop(name, None)
+    try:
+        proc = subprocess.run(
+            [
+                sys.executable, "-m", "benchmarks.e2e",
+                "--child", scenario.name, "--stub", stub.base, "--posts", str(args.posts),
+            ],
+            cwd=BACKEND_DIR,
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=args.timeout,
+        )
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "failed")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def median_result(runs: List[dict]) -> dict:
+    """Median of each figure over repeated runs of a scenario."""
+    result = {}
+    for key in runs[0]:
+        value = statistics.median(run[key] for run in runs)
+        result[key] = int(value) if isinstance(runs[0][key], int) else round(value, 2)
+    return result
+
+
+def settings(args: argparse.Namespace) -> dict:
+    return {"posts": args.posts, "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms}
+
+
+def print_table(results: Dict[str, dict]) -> None:
+    columns = [
+        ("posts/s", "posts_per_sec"),
+        ("p50 ms", "p50_ms"),
+        ("p99 ms", "p99_ms"),
+        ("RSS MB", "peak_rss_mb"),
+        ("KB", "bytes"),
+        ("reqs", "requests"),
+        ("429s", "throttled"),
+    ]
+    print(f"{'scenario':<22}" + "".join(f"{title:>10}" for title, _ in columns))
+    for name, result in results.items():
+        if "error" in result:
+            print(f"{name:<22}  error: {result['error']}")
+            continue
+        cells = [
+            result[key] // 1024 if key == "bytes" else result[key] for _, key in columns
+        ]
+        print(f"{name:<22}" + "".join(f"{cell:>10}" for cell in cells))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    names = [s.name for s in SCENARIOS]
+    parser.add_argument("scenarios", nargs="*", help=f"default: all of {', '.join(names)}")
+    parser.add_argument("--posts", type=int, default=30, help="posts per newsletter")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="stub latency")
+    parser.add_argument("--jitter-ms", type=float, default=10.0, help="stub latency jitter")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario (median)")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds per scenario")
+    parser.add_argument("--json", metavar="PATH", help="also write the results here")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="exit 1 on regression")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--stub", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args.stub, args.posts)))
+        return 0
+
+    unknown = set(args.scenarios) - set(names)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    selected = [s for s in SCENARIOS if not args.scenarios or s.name in args.scenarios]
+    stub = StubServer(StubConfig(posts=args.posts)).start()
+    results: Dict[str, dict] = {}
+    try:
+        for scenario in selected:
+            print(f"{scenario.name}: {scenario.description}...", file=sys.stderr)
+            try:
+                runs = [run_scenario(scenario, stub, args) for _ in range(args.repeat)]
+                results[scenario.name] = median_result(runs)
+            except (RuntimeError, subprocess.TimeoutExpired) as e:
+                results[scenario.name] = {"error": str(e)}
+    finally:
+        stub.stop()
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(baseline.report(settings(args), results), f, indent=2)
+
+    status = 1 if any("error" in r for r in results.values()) else 0
+    if args.save_baseline:
+        if status:
+            print("Not saving a baseline with failed scenarios", file=sys.stderr)
+        else:
+            baseline.save(args.baseline, settings(args), results)
+    if args.check:
+        status |= baseline.check(
+            args.baseline,
+            settings(args),
+            results,
+            TOLERANCES,
+            FLOORS,
+            higher_is_better=("posts_per_sec",),
+        )
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+"""
+Time and allocations per call of extraction and EPUB building, with regression gates.
+
+Usage (from backend/):
+    python -m benchmarks.microbench [page.html ...]
+    python -m benchmarks.microbench --save-baseline   # record benchmarks/microbench_baseline.json
+    python -m benchmarks.microbench --check           # exit 1 on regression
+
+Defaults to the corpus in benchmarks/corpus: a long essay, a footnote-heavy
+post, an image gallery, a paywalled preview and a short note. Each page is
+run through SubstackClient.extract_article_content, extract_subtitle and
+parse_post and through build_epub with downloads stubbed; slug_from_title
+is timed over a batch of archive-style titles per call.
+
+Time is the best CPU time over --repeat calls. The calls are made in rounds
+that visit every case once, so a slow spell on a shared machine slows one
+round of every case rather than all calls of some. Allocation is the peak
+memory traced by tracemalloc during one further call, above what was
+allocated before it; it is far steadier than time, so its tolerance is
+tighter. With --check, cases that look slower than the baseline are timed
+again before they count as regressions, so one slow spell does not fail the
+run; record baselines with a higher --repeat on a quiet machine.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+from benchmarks import baseline
+from benchmarks.compare_parsers import StubClient, corpus_pages
+from app.services.epub_builder import build_epub, slug_from_title
+from app.services.substack import SubstackClient
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "microbench_baseline.json")
+
+TOLERANCES = {"ms": 0.25, "alloc_kb": 0.10}
+# Changes smaller than these are noise, whatever the fraction
+FLOORS = {"ms": 0.05, "alloc_kb": 4}
+# Extra timing passes for cases slower than the baseline before --check fails
+CONFIRM_PASSES = 2
+
+# Titles as they come from archives: plain, punctuated, non-ASCII, over-long
+TITLES = [
+    "Notes",
+    "The Year in Review: 2023's Best (and Worst) Ideas!",
+    "Über die Zukunft — écrire, penser, vivre",
+    "Why everything you know about “productivity” is wrong… and what to do instead",
+    "A very long title " * 12,
+    "   leading and trailing whitespace   ",
+    "Q&A #42: you asked, I answered",
+    "日本語のタイトル",
+]
+
+# (setup, call): setup prepares fresh arguments outside the measurement
+Case = Tuple[Callable[[], tuple], Callable[..., object]]
+
+
+def _build(tmp: str, slug: str, post) -> object:
+    return build_epub(
+        StubClient(), post.title or slug, post.author, post.date, post.body, tmp, post.subtitle, slug
+    )
+
+
+def cases(pages: List[str], tmp: str) -> Dict[str, Case]:
+    found: Dict[str, Case] = {}
+    for path in pages:
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+        page = re.sub(r"\.html?$", "", os.path.basename(path))
+        found[f"{page}/extract_article_content"] = (
+            lambda html=html: (html,),
+            SubstackClient.extract_article_content,
+        )
+        found[f"{page}/extract_subtitle"] = (lambda html=html: (html,), SubstackClient.extract_subtitle)
+        found[f"{page}/parse_post"] = (lambda html=html: (html,), SubstackClient.parse_post)
+        if SubstackClient.parse_post(html).body is not None:
+            # build_epub rewrites the body it is given, so each call gets a
+            # fresh parse
+            found[f"{page}/build_epub"] = (
+                lambda html=html, page=page: (tmp, page, SubstackClient.parse_post(html)),
+                _build,
+            )
+    found["titles/slug_from_title"] = (
+        lambda: (),
+        lambda: [slug_from_title(title) for title in TITLES * 50],
+    )
+    return found
+
+
+def time_call(case: Case) -> float:
+    setup, call = case
+    args = setup()
+    start = time.process_time()
+    call(*args)
+    return time.process_time() - start
+
+
+def traced_alloc(case: Case) -> float:
+    """Peak bytes allocated during one call."""
+    setup, call = case
+    args = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        call(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak - before
+
+
+def measure(selected: Dict[str, Case], repeat: int) -> Dict[str, Dict[str, float]]:
+    for case in selected.values():
+        time_call(case)  # warm up
+    best = {name: float("inf") for name in selected}
+    for _ in range(repeat):
+        for name, case in selected.items():
+            best[name] = min(best[name], time_call(case))
+    return {
+        name: {
+            "ms": round(best[name] * 1000, 3),
+            "alloc_kb": round(traced_alloc(case) / 1024, 1),
+        }
+        for name, case in selected.items()
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("pages", nargs="*", help="post HTML files")
+    parser.add_argument("--repeat", type=int, default=10, help="calls timed per case")
+    parser.add_argument("--filter", default="", help="only cases whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="exit 1 on regression")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        selected = {
+            name: case
+            for name, case in cases(corpus_pages(args.pages), tmp).items()
+            if args.filter in name
+        }
+        results = measure(selected, args.repeat)
+        if args.check:
+            stored = baseline.load(args.baseline)
+            for _ in range(CONFIRM_PASSES):
+                slower = baseline.regressed_cases(results, stored, {"ms": TOLERANCES["ms"]}, FLOORS)
+                if not slower:
+                    break
+                again = measure({name: selected[name] for name in slower}, args.repeat * 2)
+                for name, result in again.items():
+                    results[name]["ms"] = min(results[name]["ms"], result["ms"])
+    print(f"{'case':<46} {'ms':>9} {'alloc KB':>10}")
+    for name, result in results.items():
+        print(f"{name:<46} {result['ms']:>9.3f} {result['alloc_kb']:>10.1f}")
+
+    # Custom pages make a baseline meaningless unless it was taken on them
+    settings = {"pages": sorted(os.path.basename(p) for p in corpus_pages(args.pages))}
+    status = 0
+    if args.save_baseline:
+        baseline.save(args.baseline, settings, results)
+    if args.check:
+        status = baseline.check(args.baseline, settings, results, TOLERANCES, FLOORS)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
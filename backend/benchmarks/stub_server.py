@@ -0,0 +1,313 @@
+"""
+A local stand-in for Substack: archive API, post pages and images.
+
+Serves any number of newsletters under http://127.0.0.1:<port>/<subdomain>,
+which is what SUBSTACK_URL="http://127.0.0.1:<port>/{subdomain}" makes the
+clients request. Archives are generated; post pages are the recorded pages
+in benchmarks/corpus with their image URLs pointed back at the stub; images
+are deterministic JPEGs sized like the originals (with Pillow; otherwise
+opaque bytes of a similar size).
+
+Latency and 429 responses are injected per request, drawn from the seed,
+the path and how often that path was requested before, so a run is
+repeatable however concurrent requests interleave. Post pages carry an ETag and answer If-None-Match with
+304, like Substack. Requests under /_stub/ are not counted: /_stub/stats
+returns the traffic served so far and /_stub/reset starts the count again.
+
+Usage (from backend/), to poke at it by hand:
+    python -m benchmarks.stub_server --posts 200 --latency-ms 50
+"""
+
+from __future__ import annotations
+
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+try:
+    from PIL import Image
+
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+IMG_SRC_RE = re.compile(r'(src|srcset)="(https?://[^"\s]+)')
+SIZE_RE = re.compile(r"(\d{2,4})x(\d{2,4})")
+ARCHIVE_START = datetime(2020, 1, 1)
+
+
+@dataclass
+class StubConfig:
+    posts: int = 100
+    # Fixed latency plus uniform jitter added to every response
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    # Share of requests answered 429, and the Retry-After sent with them
+    throttle_rate: float = 0.0
+    retry_after: Optional[str] = "0"
+    seed: int = 1
+
+
+@dataclass
+class StubStats:
+    requests: int = 0
+    throttled: int = 0
+    not_modified: int = 0
+    bytes_sent: int = 0
+    # Wall-clock time of the first request for each post page, by path
+    first_seen: Dict[str, float] = field(default_factory=dict)
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "not_modified": self.not_modified,
+            "bytes_sent": self.bytes_sent,
+        }
+
+
+def _noise_jpeg(width: int, height: int, seed: int) -> bytes:
+    """A photo-like JPEG: smooth colour blotches from an upscaled noise tile."""
+    rng = random.Random(seed)
+    tile = Image.frombytes("RGB", (24, 16), rng.randbytes(24 * 16 * 3))
+    out = io.BytesIO()
+    tile.resize((width, height), Image.BICUBIC).save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+class Corpus:
+    """The pages and images the stub serves, built once."""
+
+    def __init__(self, corpus_dir: str = CORPUS_DIR):
+        self.pages: List[str] = []
+        for path in sorted(glob.glob(os.path.join(corpus_dir, "*.html"))):
+            with open(path, encoding="utf-8") as f:
+                self.pages.append(f.read())
+        if not self.pages:
+            raise RuntimeError(f"no corpus pages in {corpus_dir}")
+        # Image name -> original URL, filled as pages are rendered
+        self._images: Dict[str, bytes] = {}
+        self._image_urls: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def page(self, index: int, base: str) -> bytes:
+        html = self.pages[index % len(self.pages)]
+
+        def local(match: re.Match) -> str:
+            url = match.group(2)
+            name = hashlib.sha1(url.encode()).hexdigest()[:16] + ".jpg"
+            with self._lock:
+                self._image_urls.setdefault(name, url)
+            return f'{match.group(1)}="{base}/img/{name}'
+
+        return IMG_SRC_RE.sub(local, html).encode("utf-8")
+
+    def prepare(self, base: str) -> None:
+        """Render every page and image now rather than on first request."""
+        for index in range(len(self.pages)):
+            self.page(index, base)
+        with self._lock:
+            names = list(self._image_urls)
+        for name in names:
+            self.image(name)
+
+    def image(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._images.get(name)
+            url = self._image_urls.get(name)
+        if data is not None or url is None:
+            return data
+        match = SIZE_RE.search(url)
+        width, height = (int(match.group(1)), int(match.group(2))) if match else (800, 600)
+        seed = int(name[:8], 16)
+        if HAS_PIL:
+            data = _noise_jpeg(width, height, seed)
+        else:
+            data = random.Random(seed).randbytes(width * height // 8)
+        with self._lock:
+            self._images[name] = data
+        return data
+
+
+def archive_entry(index: int, total: int) -> dict:
+    """Post `index` of an archive, newest (index 0) first."""
+    date = ARCHIVE_START + timedelta(days=total - index)
+    return {
+        "id": 100000 + index,
+        "slug": f"post-{index:05d}",
+        "title": f"Post {index}",
+        "subtitle": f"Subtitle of post {index}",
+        "post_date": date.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        "audience": "everyone",
+        "wordcount": 800 + (index * 37) % 4000,
+        "publishedBylines": [{"name": "Bench Author"}],
+    }
+
+
+class StubServer:
+    def __init__(self, config: StubConfig, corpus: Optional[Corpus] = None):
+        self.config = config
+        self.corpus = corpus or Corpus()
+        self.stats = StubStats()
+        # Requests so far per path, for the per-request draws
+        self._seen: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    @property
+    def substack_url(self) -> str:
+        """Value for SUBSTACK_URL that points the clients at this stub."""
+        return self.base + "/{subdomain}"
+
+    def start(self) -> "StubServer":
+        self.corpus.prepare(self.base)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self, config: Optional[StubConfig] = None) -> None:
+        with self._lock:
+            if config is not None:
+                self.config = config
+            self._seen = {}
+            self.stats = StubStats()
+
+    def _decide(self, path: str) -> Tuple[float, bool]:
+        """(delay seconds, throttle?) for the next request for path."""
+        config = self.config
+        with self._lock:
+            attempt = self._seen.get(path, 0)
+            self._seen[path] = attempt + 1
+            rng = random.Random(f"{config.seed}:{path}:{attempt}")
+            delay = config.latency_ms + rng.random() * config.jitter_ms
+            throttle = rng.random() < config.throttle_rate
+            self.stats.requests += 1
+            if throttle:
+                self.stats.throttled += 1
+        return delay / 1000, throttle
+
+    def _route(self, path: str, query: dict, headers) -> Tuple[int, dict, bytes]:
+        parts = path.strip("/").split("/")
+        if parts[:1] == ["img"] and len(parts) == 2:
+            data = self.corpus.image(parts[1])
+            if data is None:
+                return 404, {}, b""
+            return 200, {"Content-Type": "image/jpeg"}, data
+        if len(parts) >= 2 and parts[1:4] == ["api", "v1", "archive"]:
+            total = self.config.posts
+            offset = int(query.get("offset", ["0"])[0])
+            limit = int(query.get("limit", ["50"])[0])
+            batch = [archive_entry(i, total) for i in range(offset, min(total, offset + limit))]
+            return 200, {"Content-Type": "application/json"}, json.dumps(batch).encode()
+        if len(parts) == 3 and parts[1] == "p":
+            match = re.fullmatch(r"post-(\d+)", parts[2])
+            index = int(match.group(1)) if match else len(parts[2])
+            etag = f'"{parts[0]}-{parts[2]}-v1"'
+            if headers.get("If-None-Match") == etag:
+                with self._lock:
+                    self.stats.not_modified += 1
+                return 304, {"ETag": etag}, b""
+            body = self.corpus.page(index, self.base)
+            return 200, {"Content-Type": "text/html; charset=utf-8", "ETag": etag}, body
+        return 404, {}, b""
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.startswith("/_stub/"):
+                    return self._control(url.path)
+                if "/p/" in url.path:
+                    with stub._lock:
+                        stub.stats.first_seen.setdefault(url.path, time.time())
+                delay, throttle = stub._decide(url.path)
+                if delay:
+                    time.sleep(delay)
+                if throttle:
+                    status, headers, body = 429, {}, b""
+                    if stub.config.retry_after is not None:
+                        headers["Retry-After"] = stub.config.retry_after
+                else:
+                    status, headers, body = stub._route(
+                        url.path, parse_qs(url.query), self.headers
+                    )
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with stub._lock:
+                    stub.stats.bytes_sent += len(body)
+
+            def _control(self, path: str):
+                """/_stub/reset zeroes the stats, /_stub/stats returns them."""
+                if path == "/_stub/reset":
+                    stub.reset()
+                with stub._lock:
+                    stats = {**stub.stats.as_dict(), "first_seen": dict(stub.stats.first_seen)}
+                body = json.dumps(stats).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--posts", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+    stub = StubServer(
+        StubConfig(
+            posts=args.posts,
+            latency_ms=args.latency_ms,
+            jitter_ms=args.jitter_ms,
+            throttle_rate=args.throttle_rate,
+        )
+    ).start()
+    print(f"Serving; set SUBSTACK_URL={stub.substack_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Admission control: the 413, 429 and 503 rejections with their Retry-After,
+and which X-Forwarded-For address a request is counted against.
+
+Run from backend/ with: python -m pytest -q
+"""
+
+import ipaddress
+import os
+import tempfile
+from types import SimpleNamespace
+
+os.environ.setdefault("STK_CACHE_DIR", tempfile.mkdtemp(prefix="stk_test_"))
+
+import pytest
+
+from app.services import admission
+from app.services.admission import AdmissionController, AdmissionRejected, client_address
+from app.services.scheduler import Candidate
+
+# With the default estimates a post costs 1 + 0.25 * 3 images = 1.75 units of
+# 0.5 s each
+SECONDS_PER_POST = 0.875
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    # Fixed limits, whatever the environment sets
+    monkeypatch.setattr(admission, "JOB_MAX_RUNNING", 2)
+    monkeypatch.setattr(admission, "ADMISSION_MAX_QUEUED", 3)
+    monkeypatch.setattr(admission, "ADMISSION_MAX_WAIT", 100.0)
+    monkeypatch.setattr(admission, "MIN_FREE_DISK_BYTES", 0)
+    monkeypatch.setattr(admission, "CLIENT_MAX_JOBS", 2)
+    monkeypatch.setattr(admission, "CLIENT_MAX_POSTS", 100)
+    monkeypatch.setattr(admission, "CLIENT_JOBS_PER_HOUR", 3)
+    monkeypatch.setattr(admission, "TRUSTED_PROXIES", [])
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(admission, "time", SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+@pytest.fixture
+def controller(tmp_path):
+    return AdmissionController(str(tmp_path))
+
+
+def job(job_id, client="other", posts=10, subdomain="news"):
+    return Candidate(job_id, subdomain, client, posts, 0.0)
+
+
+def rejection(controller, posts=10, client="me", waiting=(), running=()):
+    with pytest.raises(AdmissionRejected) as info:
+        controller.admit("news", posts, client, list(waiting), list(running))
+    return info.value
+
+
+def test_accepts_a_job_on_an_idle_server(controller, clock):
+    estimate = controller.admit("news", 10, "me", [], [])
+    assert estimate.seconds == pytest.approx(10 * SECONDS_PER_POST)
+
+
+def test_413_for_a_job_over_the_post_limit(controller, clock):
+    error = rejection(controller, posts=101)
+    assert error.status_code == 413
+    assert error.headers is None
+
+
+def test_429_for_too_many_jobs_per_hour(controller, clock):
+    for _ in range(3):
+        controller.admit("news", 1, "me", [], [])
+        clock.value += 100
+    error = rejection(controller, posts=1)
+    assert error.status_code == 429
+    # Until the first of the three leaves the hour
+    assert error.headers == {"Retry-After": str(3600 - 300)}
+    # Other clients have their own quota
+    controller.admit("news", 1, "you", [], [])
+
+
+def test_hourly_quota_frees_up_as_submissions_age(controller, clock):
+    for _ in range(3):
+        controller.admit("news", 1, "me", [], [])
+    clock.value += 3600
+    controller.admit("news", 1, "me", [], [])
+
+
+def test_rejected_jobs_do_not_use_up_the_hourly_quota(controller, clock):
+    for _ in range(5):
+        rejection(controller, posts=101)
+    for _ in range(3):
+        controller.admit("news", 1, "me", [], [])
+
+
+def test_429_for_too_many_outstanding_jobs(controller, clock):
+    mine = [job("a", "me", posts=40), job("b", "me", posts=8)]
+    error = rejection(controller, waiting=mine[:1], running=mine[1:])
+    assert error.status_code == 429
+    # Until the smaller of the client's jobs could be done: 8 posts
+    assert error.headers == {"Retry-After": str(7)}
+
+
+def test_429_for_too_many_outstanding_posts(controller, clock):
+    error = rejection(controller, posts=30, running=[job("a", "me", posts=80)])
+    assert error.status_code == 429
+    assert error.headers == {"Retry-After": str(70)}
+    # The same job fits once it is small enough
+    controller.admit("news", 20, "me", [], [job("a", "me", posts=80)])
+
+
+def test_503_when_too_many_jobs_wait(controller, clock):
+    waiting = [job(f"w{i}", f"client{i}", posts=4) for i in range(4)]
+    error = rejection(controller, posts=1, waiting=waiting)
+    assert error.status_code == 503
+    # 16 posts over 2 slots is 7 s of backlog, 1.75 s per waiting job; two
+    # of them must start before the queue is short enough
+    assert error.headers == {"Retry-After": str(4)}
+
+
+def test_503_when_queued_work_exceeds_the_wait_budget(controller, clock):
+    # 200 posts over 2 slots: 87.5 s queued, plus 17.5 s for this job
+    waiting = [job("w", "other", posts=200)]
+    error = rejection(controller, posts=20, waiting=waiting)
+    assert error.status_code == 503
+    assert error.headers == {"Retry-After": str(5)}
+    controller.admit("news", 10, "me", waiting, [])
+
+
+def test_an_idle_queue_takes_a_job_over_the_wait_budget(controller, clock):
+    controller.admit("news", 100, "me", [], [job("r", posts=200)])
+
+
+def test_503_when_disk_is_low(controller, clock, monkeypatch):
+    monkeypatch.setattr(controller, "_free_disk", lambda: 1024)
+    error = rejection(controller)
+    assert error.status_code == 503
+    assert error.headers == {"Retry-After": str(admission.DISK_RETRY_AFTER)}
+
+
+def test_retry_after_is_clamped():
+    assert AdmissionRejected(503, "", 0.2).headers == {"Retry-After": "1"}
+    assert AdmissionRejected(503, "", 10**6).headers == {
+        "Retry-After": str(admission.MAX_RETRY_AFTER)
+    }
+
+
+def trust(monkeypatch, *networks):
+    monkeypatch.setattr(
+        admission, "TRUSTED_PROXIES", [ipaddress.ip_network(n) for n in networks]
+    )
+
+
+def test_forwarded_for_is_ignored_from_an_untrusted_peer(monkeypatch):
+    trust(monkeypatch, "10.0.0.0/8")
+    assert client_address("203.0.113.5", "198.51.100.7") == "203.0.113.5"
+
+
+def test_trusted_proxy_without_forwarded_for_is_the_client(monkeypatch):
+    trust(monkeypatch, "10.0.0.0/8")
+    assert client_address("10.0.0.1") == "10.0.0.1"
+
+
+def test_forwarded_for_from_a_trusted_proxy(monkeypatch):
+    trust(monkeypatch, "10.0.0.0/8")
+    assert client_address("10.0.0.1", "198.51.100.7") == "198.51.100.7"
+
+
+def test_spoofed_left_most_hop_is_not_believed(monkeypatch):
+    # The client sent "X-Forwarded-For: 1.2.3.4"; the proxy appended the
+    # address it really came from
+    trust(monkeypatch, "10.0.0.0/8")
+    assert client_address("10.0.0.1", "1.2.3.4, 198.51.100.7") == "198.51.100.7"
+
+
+def test_chain_of_trusted_proxies_is_skipped(monkeypatch):
+    trust(monkeypatch, "10.0.0.0/8", "2001:db8::/32")
+    forwarded = "1.2.3.4, 198.51.100.7, 2001:db8::2, 10.0.0.3"
+    assert client_address("10.0.0.1", forwarded) == "198.51.100.7"
+
+
+def test_all_hops_trusted_gives_the_left_most(monkeypatch):
+    trust(monkeypatch, "10.0.0.0/8")
+    assert client_address("10.0.0.1", "10.0.0.9, 10.0.0.3") == "10.0.0.9"
+
+
+def test_no_trusted_proxies_means_the_peer(monkeypatch):
+    assert client_address("10.0.0.1", "198.51.100.7") == "10.0.0.1"
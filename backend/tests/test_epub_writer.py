@@ -0,0 +1,164 @@
+"""
+Structure of the EPUBs written: the OCF container, well-formed package
+document, NCX and nav, a manifest that matches the zip, and identical bytes
+for identical input.
+
+Run from backend/ with: python -m pytest -q
+"""
+
+import os
+import tempfile
+import zipfile
+
+os.environ.setdefault("STK_CACHE_DIR", tempfile.mkdtemp(prefix="stk_test_"))
+
+from lxml import etree
+
+from app.services.epub_builder import open_epub
+from app.services.epub_writer import EpubWriter, published_at
+from app.services.omnibus import Omnibus
+
+NS = {
+    "container": "urn:oasis:names:tc:opendocument:xmlns:container",
+    "opf": "http://www.idpf.org/2007/opf",
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "ncx": "http://www.daisy.org/z3986/2005/ncx/",
+    "xhtml": "http://www.w3.org/1999/xhtml",
+}
+# 2024-03-05T12:00:00Z
+MODIFIED = 1709640000.0
+PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 32
+# HTML that is not XML as it stands
+BODY = "<p>One<br>two &nbsp;&amp; <b>three</p><p>Café <img src='images/a.png'></p>"
+
+
+def write_book(path, modified=MODIFIED):
+    writer = EpubWriter(
+        path=path,
+        identifier="substack-news-post",
+        title="Fish & Chips",
+        author="Ann <Author>",
+        date="2024-03-01",
+        modified=modified,
+    )
+    writer.add_item("style/default.css", b"body {}", "text/css")
+    writer.add_item("images/a.png", PNG, "image/png")
+    writer.add_chapter("one.xhtml", "Part <1>", BODY, stylesheets=["style/default.css"])
+    writer.add_chapter("two.xhtml", "Part 2", "<p>End</p>")
+    writer.close()
+    return path
+
+
+def parse(zf, name):
+    return etree.fromstring(zf.read(name))
+
+
+def check_structure(path):
+    """Assert the EPUB at path is a well-formed EPUB 3; returns its OPF root."""
+    with zipfile.ZipFile(path) as zf:
+        first = zf.infolist()[0]
+        assert first.filename == "mimetype"
+        assert first.compress_type == zipfile.ZIP_STORED
+        assert first.extra == b""
+        assert zf.read("mimetype") == b"application/epub+zip"
+        with open(path, "rb") as f:
+            # Readers sniff the type at a fixed offset
+            assert f.read(58)[30:] == b"mimetypeapplication/epub+zip"
+
+        container = parse(zf, "META-INF/container.xml")
+        opf_path = container.find(".//container:rootfile", NS).get("full-path")
+        assert opf_path == "EPUB/content.opf"
+        opf = parse(zf, opf_path)
+
+        items = {
+            item.get("id"): item for item in opf.findall("opf:manifest/opf:item", NS)
+        }
+        members = {
+            name
+            for name in zf.namelist()
+            if name.startswith("EPUB/") and name != opf_path
+        }
+        assert {"EPUB/" + item.get("href") for item in items.values()} == members
+        for idref in opf.findall("opf:spine/opf:itemref", NS):
+            assert idref.get("idref") in items
+        for item in items.values():
+            if item.get("media-type") in ("application/xhtml+xml", "application/x-dtbncx+xml"):
+                parse(zf, "EPUB/" + item.get("href"))
+
+        # The NCX and nav list the spine's chapters in order
+        chapters = [
+            items[ref.get("idref")].get("href")
+            for ref in opf.findall("opf:spine/opf:itemref", NS)
+            if ref.get("idref") != "nav"
+        ]
+        ncx = parse(zf, "EPUB/toc.ncx")
+        assert [c.get("src") for c in ncx.findall(".//ncx:content", NS)] == chapters
+        nav = parse(zf, "EPUB/nav.xhtml")
+        assert [a.get("href") for a in nav.findall(".//xhtml:nav//xhtml:a", NS)] == chapters
+    return opf
+
+
+def test_book_structure(tmp_path):
+    opf = check_structure(write_book(str(tmp_path / "book.epub")))
+    assert opf.find("opf:metadata/dc:title", NS).text == "Fish & Chips"
+    assert opf.find("opf:metadata/dc:creator", NS).text == "Ann <Author>"
+    assert opf.find("opf:metadata/dc:date", NS).text == "2024-03-01"
+    modified = opf.find("opf:metadata/opf:meta[@property='dcterms:modified']", NS)
+    assert modified.text == "2024-03-05T12:00:00Z"
+
+
+def test_chapters_are_xhtml(tmp_path):
+    with zipfile.ZipFile(write_book(str(tmp_path / "book.epub"))) as zf:
+        chapter = parse(zf, "EPUB/one.xhtml")
+    assert chapter.find("xhtml:head/xhtml:title", NS).text == "Part <1>"
+    assert chapter.find(".//xhtml:img", NS).get("src") == "images/a.png"
+    assert "Café" in "".join(chapter.itertext())
+
+
+def test_identical_input_gives_identical_bytes(tmp_path):
+    first = write_book(str(tmp_path / "first.epub"))
+    second = write_book(str(tmp_path / "second.epub"))
+    with open(first, "rb") as a, open(second, "rb") as b:
+        assert a.read() == b.read()
+    with zipfile.ZipFile(first) as zf:
+        assert {info.date_time for info in zf.infolist()[1:]} == {(2024, 3, 5, 12, 0, 0)}
+
+
+def test_single_post_books_are_dated_by_the_post(tmp_path):
+    def build(name):
+        writer = open_epub("news", "Title", "Ann", "2024-03-01", str(tmp_path), filename=name)
+        writer.add_chapter("content.xhtml", "Title", BODY, ["style/default.css"])
+        writer.close()
+        return writer.path
+
+    first, second = build("a.epub"), build("b.epub")
+    opf = check_structure(first)
+    modified = opf.find("opf:metadata/opf:meta[@property='dcterms:modified']", NS)
+    assert modified.text == "2024-03-01T00:00:00Z"
+    with open(first, "rb") as a, open(second, "rb") as b:
+        assert a.read() == b.read()
+
+
+def test_omnibus_books_are_reproducible(tmp_path):
+    def build(name):
+        book = Omnibus("news", str(tmp_path / name), split_by_year=True, modified=MODIFIED)
+        os.makedirs(book.output_dir)
+        href = book.add_image("2023", "Ann", (PNG, "image/png", ".png"))
+        book.add_chapter("2023", "Ann", "Old", f'<p><img src="{href}"></p>', [href])
+        book.add_chapter("2024", "Ann", "New", BODY)
+        return book.close()
+
+    first, second = build("a"), build("b")
+    assert [os.path.basename(p) for p in first] == [os.path.basename(p) for p in second]
+    for a, b in zip(first, second):
+        check_structure(a)
+        with open(a, "rb") as fa, open(b, "rb") as fb:
+            assert fa.read() == fb.read()
+
+
+def test_published_at():
+    assert published_at("2024-03-01") == 1709251200.0
+    assert published_at("2024") == published_at("2024-01-01")
+    assert published_at("2024-02-30") is None
+    assert published_at("March 2024") is None
+    assert published_at(None) is None
@@ -0,0 +1,190 @@
+"""
+Job event logs: replay after a reconnect, the resync snapshot for a cursor
+whose events were evicted, and coalescing of progress events.
+
+Run from backend/ with: python -m pytest -q
+"""
+
+import asyncio
+import os
+import tempfile
+
+os.environ.setdefault("STK_CACHE_DIR", tempfile.mkdtemp(prefix="stk_test_"))
+
+from app.services.event_log import EventLog, coalesce, resync
+from app.services.job_manager import Job, JobManager, JobStatus
+from app.services.job_store import JobStore
+
+
+def progress(n):
+    return {"progress": n}
+
+
+def test_sequence_ids_count_every_event():
+    log = EventLog()
+    assert [log.append("warning", {}) for _ in range(3)] == [1, 2, 3]
+    assert log.after(0) == ([(1, "warning", {}), (2, "warning", {}), (3, "warning", {})], False)
+
+
+def test_consecutive_progress_events_replace_each_other():
+    log = EventLog()
+    log.append("status", {"status": "running"})
+    for n in range(1, 4):
+        log.append("progress", progress(n))
+    log.append("warning", {"slug": "a"})
+    log.append("progress", progress(4))
+    events, missed = log.after(0)
+    assert events == [
+        (1, "status", {"status": "running"}),
+        (4, "progress", progress(3)),
+        (5, "warning", {"slug": "a"}),
+        (6, "progress", progress(4)),
+    ]
+    # Replaced, not evicted: a cursor on a replaced progress misses nothing
+    assert not missed
+    assert log.after(2) == (events[1:], False)
+
+
+def test_reconnect_with_an_id_still_in_the_log():
+    log = EventLog(size=3)
+    for n in range(4):
+        log.append("warning", {"n": n})
+    # Events 2-4 are kept; a client that saw 2 misses nothing
+    events, missed = log.after(2)
+    assert [e[0] for e in events] == [3, 4]
+    assert not missed
+
+
+def test_reconnect_with_an_evicted_id_is_reported_missed():
+    log = EventLog(size=3)
+    for n in range(5):
+        log.append("warning", {"n": n})
+    assert log.evicted == 2
+    events, missed = log.after(1)
+    assert [e[0] for e in events] == [3, 4, 5]
+    assert missed
+
+
+def test_coalesce_keeps_the_last_progress_before_each_later_event():
+    events = [
+        (1, "progress", progress(1)),
+        (2, "progress", progress(2)),
+        (3, "warning", {}),
+        (4, "progress", progress(3)),
+        (5, "post_complete", {}),
+    ]
+    assert coalesce(events) == [
+        (3, "warning", {}),
+        (4, "progress", progress(3)),
+        (5, "post_complete", {}),
+    ]
+
+
+def test_coalesce_drops_progress_before_a_status():
+    events = [(1, "progress", progress(1)), (2, "status", {}), (3, "done", {})]
+    assert coalesce(events) == [(2, "status", {}), (3, "done", {})]
+    # A status before the progress does not supersede it
+    assert coalesce([(1, "status", {}), (2, "progress", progress(1))]) == [
+        (1, "status", {}),
+        (2, "progress", progress(1)),
+    ]
+
+
+def test_resync_puts_a_snapshot_after_the_retained_events():
+    snapshot = {"status": "running", "progress": 7}
+    events = [
+        (5, "status", {"status": "running", "progress": 2}),
+        (6, "progress", progress(6)),
+        (7, "warning", {}),
+    ]
+    assert resync(events, 1, snapshot) == [
+        (5, "status", {"status": "running", "progress": 2}),
+        (7, "warning", {}),
+        (7, "status", snapshot),
+    ]
+
+
+def test_resync_keeps_done_last():
+    snapshot = {"status": "completed"}
+    events = [(5, "progress", progress(9)), (6, "post_complete", {}), (7, "done", {})]
+    assert resync(events, 1, snapshot) == [
+        (6, "post_complete", {}),
+        (6, "status", snapshot),
+        (7, "done", {}),
+    ]
+
+
+def test_resync_without_retained_events_is_just_the_snapshot():
+    assert resync([], 4, {"status": "running"}) == [(4, "status", {"status": "running"})]
+
+
+def test_resync_after_a_status_needs_no_snapshot():
+    events = [(5, "warning", {}), (6, "status", {"status": "failed"}), (7, "done", {})]
+    assert resync(events, 1, {"status": "failed"}) == events
+
+
+def _replay(tmp_path, job, last_event_id, until="done"):
+    """The events a client reconnecting with last_event_id gets, up to the
+    first `until` event."""
+    manager = JobManager(JobStore(str(tmp_path / "jobs.sqlite3")), queued=False)
+
+    async def main():
+        events = []
+        async for item in manager.stream(job, last_event_id):
+            events.append(item)
+            if item[1] == until:
+                return events
+
+    return asyncio.run(asyncio.wait_for(main(), 5))
+
+
+def _job(size, finished=True):
+    job = Job(id="job", subdomain="news", slugs=["a", "b", "c"], total=3)
+    job.events = EventLog(size=size)
+    job.status = JobStatus.RUNNING
+    job.push_event("status", job.status_dict())
+    # 1 status, then progress and post_complete for each post: 2-7
+    for slug in job.slugs:
+        job.progress += 1
+        job.push_event("progress", job.status_dict())
+        job.push_event("post_complete", {"slug": slug})
+    if finished:
+        job.status = JobStatus.COMPLETED
+        job.push_event("status", job.status_dict())
+        job.push_event("done", {})
+    return job
+
+
+def test_stream_replays_after_a_last_event_id_in_the_log(tmp_path):
+    job = _job(size=16)
+    events = _replay(tmp_path, job, 3)
+    assert [(seq, event) for seq, event, _ in events] == [
+        (5, "post_complete"),
+        (7, "post_complete"),
+        (8, "status"),
+        (9, "done"),
+    ]
+
+
+def test_stream_resyncs_a_last_event_id_already_evicted(tmp_path):
+    # Still running, with events 4-7 kept
+    job = _job(size=4, finished=False)
+    events = _replay(tmp_path, job, 1, until="status")
+    assert [(seq, event) for seq, event, _ in events] == [
+        (5, "post_complete"),
+        (7, "post_complete"),
+        (7, "status"),
+    ]
+    assert events[-1][2] == job.status_dict()
+
+
+def test_stream_after_eviction_ends_on_the_retained_final_status(tmp_path):
+    # Events 6-9 kept: the final status is as current as a snapshot
+    job = _job(size=4)
+    events = _replay(tmp_path, job, 1)
+    assert [(seq, event) for seq, event, _ in events] == [
+        (7, "post_complete"),
+        (8, "status"),
+        (9, "done"),
+    ]
+    assert events[1][2]["status"] == "completed"
@@ -0,0 +1,213 @@
+"""
+The job store as a work queue (claims, heartbeats, expiry, schema upgrades)
+and resuming interrupted jobs from their checkpoints after a restart.
+
+Run from backend/ with: python -m pytest -q
+"""
+
+import asyncio
+import os
+import sqlite3
+import tempfile
+from types import SimpleNamespace
+
+os.environ.setdefault("STK_CACHE_DIR", tempfile.mkdtemp(prefix="stk_test_"))
+
+import httpx
+import pytest
+
+from app.services import job_store as job_store_module
+from app.services import substack_async
+from app.services.job_manager import JobManager, JobStatus
+from app.services.job_store import POST_DONE, POST_FAILED, JobStore
+from app.services.scheduler import pick_next
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(job_store_module, "time", SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def create(store, job_id, slugs=("a", "b"), status="pending", created_at=0.0, **kwargs):
+    store.create(
+        job_id,
+        "news",
+        list(slugs),
+        {"omnibus": False, "split_by_year": False},
+        bool(kwargs.get("session_cookie")),
+        status,
+        os.path.join(os.path.dirname(store.path), job_id),
+        created_at,
+        **kwargs,
+    )
+
+
+def test_claim_hands_each_job_to_one_worker(store, clock):
+    create(store, "first", created_at=1)
+    create(store, "second", created_at=2)
+
+    record, cookie = store.claim("w1", pick_next)
+    assert (record.id, cookie) == ("first", None)
+    record, _ = store.claim("w2", pick_next)
+    assert record.id == "second"
+    # Both are held by live workers
+    assert store.claim("w3", pick_next) is None
+    waiting, running = store.candidates()
+    assert waiting == [] and {c.job_id for c in running} == {"first", "second"}
+
+
+def test_claim_hands_over_the_session_cookie_once(store, clock):
+    create(store, "job", session_cookie="sid")
+    _, cookie = store.claim("w1", pick_next)
+    assert cookie == "sid"
+    clock.value += 1000
+    _, cookie = store.claim("w2", pick_next)
+    assert cookie is None
+
+
+def test_missed_heartbeats_let_another_worker_reclaim(store, clock):
+    create(store, "job")
+    store.claim("w1", pick_next, stale_after=60)
+
+    clock.value += 50
+    store.heartbeat("w1")
+    clock.value += 50
+    # Last heard from 50 s ago: still w1's
+    assert store.claim("w2", pick_next, stale_after=60) is None
+
+    clock.value += 20
+    record, _ = store.claim("w2", pick_next, stale_after=60)
+    assert record.id == "job"
+    # w1's late heartbeat does not keep the job alive for w2
+    clock.value += 50
+    store.heartbeat("w1")
+    clock.value += 20
+    record, _ = store.claim("w3", pick_next, stale_after=60)
+    assert record.id == "job"
+
+
+def test_heartbeat_leaves_finished_jobs_alone(store, clock):
+    create(store, "job")
+    store.claim("w1", pick_next)
+    store.update("job", status="completed", finished_at=clock.value)
+    store.heartbeat("w1")
+    assert store.candidates() == ([], [])
+
+
+def test_expired_counts_from_when_a_job_finished(store):
+    create(store, "done", status="completed", created_at=0)
+    store.update("done", finished_at=100)
+    create(store, "failed", status="failed", created_at=0)
+    store.update("failed", finished_at=200)
+    # Unfinished jobs never expire, however old
+    create(store, "queued", status="pending", created_at=0)
+    create(store, "running", status="running", created_at=0)
+    assert [row[0] for row in store.expired(150)] == ["done"]
+    assert sorted(row[0] for row in store.expired(250)) == ["done", "failed"]
+
+
+def test_opening_an_old_database_adds_the_new_columns(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    # The jobs table as first shipped, before JOB_COLUMNS
+    old = sqlite3.connect(path)
+    old.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, subdomain TEXT NOT NULL, "
+        "slugs TEXT NOT NULL, options TEXT NOT NULL, had_cookie INTEGER NOT NULL, "
+        "status TEXT NOT NULL, error TEXT, output_dir TEXT NOT NULL, zip_path TEXT, "
+        "image_bytes_saved INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL)"
+    )
+    for job_id, status in (("old-done", "completed"), ("old-pending", "pending")):
+        old.execute(
+            "INSERT INTO jobs (id, subdomain, slugs, options, had_cookie, status, "
+            "output_dir, created_at) VALUES (?, 'news', '[\"a\"]', '{}', 0, ?, '/x', 50)",
+            (job_id, status),
+        )
+    old.commit()
+    old.close()
+
+    store = JobStore(path)
+    done = store.load("old-done")
+    assert (done.progress, done.epub_paths, done.client_id) == (0, [], "")
+    # Jobs that finished before finished_at existed expire by creation time
+    assert done.finished_at == 50
+    assert store.load("old-pending").finished_at is None
+    assert store.expired(60) == [("old-done", "/x")]
+    columns = {row[1] for row in sqlite3.connect(path).execute("PRAGMA table_info(jobs)")}
+    assert set(job_store_module.JOB_COLUMNS) <= columns
+
+
+class PostPages:
+    """Substack post pages, recording which slugs were fetched."""
+
+    def __init__(self):
+        self.fetched = []
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        slug = request.url.path.rsplit("/", 1)[-1]
+        self.fetched.append(slug)
+        return httpx.Response(
+            200,
+            text=(
+                f'<html><head><meta name="author" content="Ann"></head><body>'
+                f'<h1 class="post-title">Post {slug}</h1>'
+                f'<time datetime="2024-01-02T00:00:00Z"></time>'
+                f'<div class="available-content"><div class="body markup">'
+                f"<p>Text of {slug}.</p></div></div></body></html>"
+            ),
+        )
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    pages = PostPages()
+    monkeypatch.setattr(substack_async, "_transport", httpx.MockTransport(pages))
+    return pages
+
+
+def test_restart_resumes_from_the_saved_posts(store, upstream):
+    # Interrupted with post 0 built and post 1 failed; post 2 never started
+    create(store, "job", slugs=("p0", "p1", "p2"), status="running")
+    output_dir = os.path.join(os.path.dirname(store.path), "job")
+    os.makedirs(output_dir)
+    built = os.path.join(output_dir, "p0.epub")
+    with open(built, "wb") as f:
+        f.write(b"built before the restart")
+    store.checkpoint("job", 0, POST_DONE, built)
+    store.checkpoint("job", 1, POST_FAILED)
+    create(store, "finished", status="completed")
+    create(store, "with-cookie", status="running", session_cookie="sid")
+
+    async def main():
+        manager = JobManager(store, queued=False)
+        await manager.restore()
+        await asyncio.wait_for(asyncio.gather(*manager._tasks), 10)
+        await manager._write(lambda: None)
+        return manager
+
+    manager = asyncio.run(main())
+
+    job = manager.jobs["job"]
+    assert job.status == JobStatus.COMPLETED
+    # Only the posts without a finished checkpoint were fetched again
+    assert sorted(upstream.fetched) == ["p1", "p2"]
+    assert job.epub_paths[0] == built
+    assert len(job.epub_paths) == 3
+    record = store.load("job")
+    assert record.status == "completed"
+    assert {idx: post.state for idx, post in record.posts.items()} == {
+        0: POST_DONE,
+        1: POST_DONE,
+        2: POST_DONE,
+    }
+
+    assert manager.jobs["finished"].status == JobStatus.COMPLETED
+    # A job's cookie is not stored, so it cannot resume
+    assert manager.jobs["with-cookie"].status == JobStatus.FAILED
+    assert store.load("with-cookie").status == "failed"
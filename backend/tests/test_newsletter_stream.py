@@ -0,0 +1,149 @@
+"""
+The archive SSE stream must not hold up other requests, and a client that
+disconnects must stop the producer behind it.
+
+Upstream is a slow httpx.MockTransport under the shared client transport, so
+the real stream_archive, walk_archive and fetch_archive_page code runs.
+
+Run from backend/ with: python -m pytest -q
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+os.environ.setdefault("STK_CACHE_DIR", tempfile.mkdtemp(prefix="stk_test_"))
+
+import httpx
+import pytest
+
+from app.main import app
+from app.services import archive_store, substack_async
+
+PAGES = 4
+PAGE_SIZE = 3
+PAGE_DELAY = 0.2
+# Seconds between /api/health requests while the stream is open
+POLL_INTERVAL = 0.02
+
+
+class SlowArchive:
+    """Substack's archive API: PAGES pages, each answered after PAGE_DELAY."""
+
+    def __init__(self):
+        self.requests = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        assert request.url.path == "/api/v1/archive"
+        self.requests += 1
+        offset = int(request.url.params["offset"])
+        await asyncio.sleep(PAGE_DELAY)
+        posts = [
+            {
+                "id": n,
+                "title": f"Post {n}",
+                "slug": f"post-{n}",
+                "post_date": f"2024-01-{28 - n:02d}T00:00:00Z",
+            }
+            for n in range(offset, min(offset + PAGE_SIZE, PAGES * PAGE_SIZE))
+        ]
+        return httpx.Response(200, json=posts)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    archive = SlowArchive()
+    monkeypatch.setattr(substack_async, "_transport", httpx.MockTransport(archive))
+    return archive
+
+
+def _events(body: str):
+    return [line[len("event: "):] for line in body.splitlines() if line.startswith("event: ")]
+
+
+def _producers():
+    return [
+        task
+        for task in asyncio.all_tasks()
+        if task.get_coro().__qualname__.endswith("stream_posts.<locals>.produce")
+    ]
+
+
+def test_health_is_served_while_an_archive_streams(upstream):
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            # ASGITransport returns the response once the app finishes, so the
+            # stream runs in its own task while /api/health is polled
+            stream = asyncio.create_task(client.get("/api/newsletter/health/posts/stream"))
+            # Each poll is timed from before its pause, so a loop blocked
+            # between polls shows up too
+            latencies = []
+            while not stream.done():
+                start = time.perf_counter()
+                await asyncio.sleep(POLL_INTERVAL)
+                health = await client.get("/api/health")
+                latencies.append(time.perf_counter() - start - POLL_INTERVAL)
+                assert health.json() == {"status": "ok"}
+            response = await stream
+
+        # Answered throughout the walk, never behind a page fetch
+        assert len(latencies) >= PAGES
+        assert max(latencies) < PAGE_DELAY / 2
+        assert upstream.requests == PAGES + 1
+        assert response.status_code == 200
+        assert _events(response.text) == ["batch"] * PAGES + ["done"]
+        done = json.loads(response.text.strip().splitlines()[-1][len("data: "):])
+        assert done == {"total": PAGES * PAGE_SIZE}
+
+    asyncio.run(main())
+
+
+def test_disconnect_cancels_the_producer(upstream):
+    async def main():
+        disconnected = asyncio.Event()
+        sent = []
+
+        # Driven by hand, because ASGITransport cannot disconnect mid-response
+        async def receive():
+            if not sent:
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+            if b"event: batch" in message.get("body", b""):
+                disconnected.set()
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/api/newsletter/gone/posts/stream",
+            "raw_path": b"/api/newsletter/gone/posts/stream",
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"host", b"test")],
+            "client": ("127.0.0.1", 12345),
+            "server": ("test", 80),
+        }
+        start = time.perf_counter()
+        await asyncio.wait_for(app(scope, receive, send), 5)
+        # The response ends at the first batch, not when the walk does
+        assert time.perf_counter() - start < PAGES * PAGE_DELAY
+        await asyncio.sleep(0)
+        assert _producers() == []
+
+        # The walk itself runs on, and the archive is stored for next time
+        walk = archive_store._walks.get("gone")
+        if walk is not None:
+            await asyncio.wait_for(walk.task, 5)
+        state = await asyncio.to_thread(archive_store.archive_store.state, "gone")
+        assert state is not None and state.complete
+
+    asyncio.run(main())
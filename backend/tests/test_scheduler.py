@@ -0,0 +1,111 @@
+"""
+Concurrency caps and fair ordering of the job scheduler.
+
+Run from backend/ with: python -m pytest -q
+"""
+
+import pytest
+
+from app.services import scheduler
+from app.services.scheduler import Candidate, pick_next, queue_positions
+
+
+@pytest.fixture(autouse=True)
+def caps(monkeypatch):
+    # Fixed caps, whatever the environment sets
+    monkeypatch.setattr(scheduler, "JOB_MAX_RUNNING", 4)
+    monkeypatch.setattr(scheduler, "JOB_MAX_PER_SUBDOMAIN", 2)
+    monkeypatch.setattr(scheduler, "JOB_MAX_PER_CLIENT", 2)
+    monkeypatch.setattr(scheduler, "LARGE_JOB_POSTS", 200)
+    monkeypatch.setattr(scheduler, "JOB_SIZE_PENALTY", 0.1)
+
+
+def job(job_id, subdomain="news", client="10.0.0.1", posts=10, created_at=0.0):
+    return Candidate(job_id, subdomain, client, posts, created_at)
+
+
+def running(n):
+    """n running jobs, each for its own newsletter and client."""
+    return [job(f"r{i}", f"sub{i}", f"10.1.0.{i}") for i in range(n)]
+
+
+def test_picks_nothing_when_nothing_waits():
+    assert pick_next([], []) is None
+
+
+def test_global_cap():
+    waiting = [job("a")]
+    assert pick_next(waiting, running(3)) == waiting[0]
+    assert pick_next(waiting, running(4)) is None
+
+
+def test_per_subdomain_cap():
+    busy = [job("r1", "news", "10.1.0.1"), job("r2", "news", "10.1.0.2")]
+    same = job("a", "news", "10.0.0.9", created_at=0)
+    other = job("b", "other", "10.0.0.8", created_at=50)
+    assert pick_next([same, other], busy) == other
+    assert pick_next([same], busy) is None
+    assert pick_next([same], busy[:1]) == same
+
+
+def test_per_client_cap():
+    busy = [job("r1", "one", "10.0.0.1"), job("r2", "two", "10.0.0.1")]
+    mine = job("a", "three", "10.0.0.1", created_at=0)
+    theirs = job("b", "four", "10.0.0.2", created_at=50)
+    assert pick_next([mine, theirs], busy) == theirs
+    assert pick_next([mine], busy) is None
+    assert pick_next([mine], busy[:1]) == mine
+
+
+def test_large_job_may_not_take_the_last_slot():
+    large = job("big", posts=201)
+    assert pick_next([large], running(2)) == large
+    assert pick_next([large], running(3)) is None
+    # A job of exactly LARGE_JOB_POSTS is not large
+    assert pick_next([job("edge", posts=200)], running(3)) is not None
+
+
+def test_large_job_left_waiting_lets_a_small_one_through():
+    large = job("big", client="10.0.0.1", posts=500, created_at=0)
+    small = job("small", client="10.0.0.2", posts=5, created_at=100)
+    assert pick_next([large, small], running(3)) == small
+
+
+def test_large_job_runs_alone_when_only_one_slot_exists(monkeypatch):
+    monkeypatch.setattr(scheduler, "JOB_MAX_RUNNING", 1)
+    large = job("big", posts=500)
+    assert pick_next([large], []) == large
+
+
+def test_size_penalty_orders_by_arrival_plus_posts():
+    # 0.1 s per post: 100 posts weigh like arriving 10 s later
+    early_big = job("early-big", client="a", posts=100, created_at=0)
+    late_small = job("late-small", client="b", posts=1, created_at=5)
+    later_small = job("later-small", client="c", posts=1, created_at=20)
+    waiting = [early_big, late_small, later_small]
+    assert pick_next(waiting, []) == late_small
+    assert queue_positions(waiting, []) == {
+        "late-small": 1,
+        "early-big": 2,
+        "later-small": 3,
+    }
+
+
+def test_penalty_is_bounded_so_big_jobs_still_run():
+    big = job("big", client="a", posts=100, created_at=0)
+    # Arrived after the big job's 10 s penalty ran out
+    small = job("small", client="b", posts=1, created_at=11)
+    assert pick_next([big, small], []) == big
+
+
+def test_clients_with_fewer_running_jobs_go_first():
+    busy = [job("r1", "one", "heavy")]
+    heavy = job("a", client="heavy", posts=1, created_at=0)
+    light = job("b", client="light", posts=50, created_at=30)
+    assert pick_next([heavy, light], busy) == light
+    assert queue_positions([heavy, light], busy) == {"b": 1, "a": 2}
+
+
+def test_ties_break_on_job_id():
+    waiting = [job("b", client="x"), job("a", client="y")]
+    assert queue_positions(waiting, []) == {"a": 1, "b": 2}
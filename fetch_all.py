@@ -6,16 +6,21 @@ with embedded images. Requires session cookie for paid posts.
 
 import os
 import re
+import sys
 import time
 import hashlib
 import mimetypes
 import requests
 from urllib.parse import urljoin, urlparse
-from bs4 import BeautifulSoup
 from ebooklib import epub
 
-SUBSTACK_BASE = "https://samkriss.substack.com"
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "backend"))
+
+from app.services.image_cache import image_cache  # noqa: E402
+from app.services.substack import SubstackClient  # noqa: E402
+
+SUBSTACK_BASE = "https://samkriss.substack.com"
 OUTPUT_DIR = os.path.join(SCRIPT_DIR, "epubs_v4")
 BATCH_SIZE = 50
 DELAY_BETWEEN_REQUESTS = 1
@@ -63,6 +68,9 @@ def fetch_post_html(session, slug):
 
 def download_image(session, img_url):
     """Download an image and return (content_bytes, media_type, extension)."""
+    cached = image_cache.get(img_url)
+    if cached is not None:
+        return cached
     try:
         resp = session.get(img_url, timeout=15)
         resp.raise_for_status()
@@ -75,73 +83,12 @@ def download_image(session, img_url):
             "image/svg+xml": ".svg",
         }
         ext = ext_map.get(content_type, ".jpg")
+        image_cache.put(img_url, resp.content, content_type, ext)
         return resp.content, content_type, ext
     except Exception:
         return None, None, None
 
 
-def extract_article_content(html):
-    soup = BeautifulSoup(html, "html.parser")
-    body = soup.find("div", class_="body")
-    if not body:
-        body = soup.find("div", class_="available-content")
-    if not body:
-        body = soup.find("article")
-    if not body:
-        body = soup.find("div", {"class": re.compile(r"post-content|entry-content")})
-    if not body:
-        return None
-
-    for tag in body.find_all(["div", "section"], class_=re.compile(
-        r"subscribe|share|footer|comment|sidebar|button-wrapper|paywall"
-    )):
-        tag.decompose()
-    for tag in body.find_all(["script", "style", "iframe"]):
-        tag.decompose()
-
-    # Convert Substack footnotes to local EPUB anchors
-    # 1. Fix footnote anchors in body text (e.g. superscript "1" linking to footnote)
-    for a in body.find_all("a", class_="footnote-anchor"):
-        old_id = a.get("id", "")  # e.g. "footnote-anchor-1-184563652"
-        # Extract footnote number
-        num = a.get_text(strip=True)
-        # Point href to the local footnote ID
-        a["href"] = f"#footnote-{num}"
-        a["id"] = f"footnote-anchor-{num}"
-        # Remove external URL attributes
-        for attr in ["data-component-name", "rel", "target"]:
-            if a.has_attr(attr):
-                del a[attr]
-        # Make it superscript
-        sup = body.find("sup") # just to check if already wrapped
-        if a.parent and a.parent.name != "sup":
-            # Wrap in superscript for proper footnote styling
-            pass  # We'll handle via CSS
-
-    # 2. Fix footnote sections at the bottom
-    for div in body.find_all("div", class_="footnote"):
-        # Find the footnote number link
-        num_link = div.find("a", class_="footnote-number")
-        if num_link:
-            num = num_link.get_text(strip=True)
-            # Point back to the anchor in the text
-            num_link["href"] = f"#footnote-anchor-{num}"
-            num_link["id"] = f"footnote-{num}"
-            for attr in ["data-component-name", "rel", "target", "contenteditable"]:
-                if num_link.has_attr(attr):
-                    del num_link[attr]
-
-    return body
-
-
-def extract_subtitle(html):
-    soup = BeautifulSoup(html, "html.parser")
-    subtitle = soup.find("h3", class_=re.compile(r"subtitle"))
-    if subtitle:
-        return subtitle.get_text(strip=True)
-    return None
-
-
 def slug_from_title(title):
     """Create a filesystem-safe slug from a title."""
     s = title.lower().strip()
@@ -299,8 +246,7 @@ def main():
     if SESSION_COOKIE:
         print("Testing authentication...")
         test_html = fetch_post_html(session, "prophecies-for-2026")
-        soup = BeautifulSoup(test_html, "html.parser")
-        body = soup.find("div", class_="body")
+        body = SubstackClient.parse_post(test_html).body
         if body and len(body.get_text()) > 1000:
             print("Authentication working!\n")
         else:
@@ -332,8 +278,9 @@ def main():
 
         try:
             html = fetch_post_html(session, slug)
-            content = extract_article_content(html)
-            subtitle = extract_subtitle(html)
+            parsed = SubstackClient.parse_post(html)
+            content = parsed.body
+            subtitle = parsed.subtitle
 
             if content is None:
                 print(f"  WARNING: Could not extract content")
@@ -357,6 +304,8 @@ def main():
     print("DONE!")
     print(f"  Succeeded: {succeeded}")
     print(f"  Total images embedded: {total_images}")
+    cache_stats = image_cache.stats()
+    print(f"  Image cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
     print(f"  Failed: {len(failed)}")
     if failed:
         print("\nFailed posts:")
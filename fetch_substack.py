@@ -10,11 +10,15 @@ import sys
 import json
 import time
 import requests
-from bs4 import BeautifulSoup
 from ebooklib import epub
 
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "backend"))
+
+from app.services.html_parser import make_soup  # noqa: E402
+
 SUBSTACK_BASE = "https://samkriss.substack.com"
-OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "epubs")
+OUTPUT_DIR = os.path.join(SCRIPT_DIR, "epubs")
 BATCH_SIZE = 50
 DELAY_BETWEEN_REQUESTS = 1  # seconds, be polite
 
@@ -55,7 +59,7 @@ def fetch_post_html(slug):
 
 def extract_article_content(html):
     """Extract the article body content from a Substack post page."""
-    soup = BeautifulSoup(html, "html.parser")
+    soup = make_soup(html)
 
     # Substack puts article content in a div with class "body markup"
     # or in the <article> tag, or in a div with data attribute
@@ -86,7 +90,7 @@ def extract_article_content(html):
 
 def extract_subtitle(html):
     """Extract subtitle if present."""
-    soup = BeautifulSoup(html, "html.parser")
+    soup = make_soup(html)
     subtitle = soup.find("h3", class_=re.compile(r"subtitle"))
     if subtitle:
         return subtitle.get_text(strip=True)
@@ -78,7 +78,11 @@ export default function NewsletterPage() {
       try {
         const data = JSON.parse((e as MessageEvent).data);
         const newPosts: PostMetadata[] = data.posts;
-        accumulated.push(...newPosts);
+        if (data.prepend) {
+          accumulated.unshift(...newPosts);
+        } else {
+          accumulated.push(...newPosts);
+        }
         setPosts([...accumulated]);
         setLoadingTotal(data.total_so_far);
         setLoadingBatch(data.batch);
@@ -221,6 +225,7 @@ export default function NewsletterPage() {
               jobProgress={job.progress}
               jobTotal={job.total}
               jobCurrentPost={job.currentPost}
+              jobQueuePosition={job.queuePosition}
               jobError={job.error}
               jobCompletedPosts={job.completedPosts}
               onStartOver={handleStartOver}
@@ -269,6 +274,7 @@ export default function NewsletterPage() {
               progress={job.progress}
               total={job.total}
               currentPost={job.currentPost}
+              queuePosition={job.queuePosition}
               error={job.error}
               completedPosts={job.completedPosts}
             />
@@ -34,6 +34,7 @@ interface CheckoutSidebarProps {
   jobProgress: number;
   jobTotal: number;
   jobCurrentPost: string | null;
+  jobQueuePosition?: number | null;
   jobError: string | null;
   jobCompletedPosts: CompletedPost[];
   onStartOver: () => void;
@@ -58,6 +59,7 @@ export default function CheckoutSidebar({
   jobProgress,
   jobTotal,
   jobCurrentPost,
+  jobQueuePosition,
   jobError,
   jobCompletedPosts,
   onStartOver,
@@ -133,6 +135,7 @@ export default function CheckoutSidebar({
                 progress={jobProgress}
                 total={jobTotal}
                 currentPost={jobCurrentPost}
+                queuePosition={jobQueuePosition}
                 error={jobError}
                 completedPosts={jobCompletedPosts}
               />
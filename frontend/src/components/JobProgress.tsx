@@ -15,6 +15,7 @@ interface JobProgressProps {
   progress: number;
   total: number;
   currentPost: string | null;
+  queuePosition?: number | null;
   error: string | null;
   completedPosts: CompletedPost[];
 }
@@ -24,6 +25,7 @@ export default function JobProgress({
   progress,
   total,
   currentPost,
+  queuePosition,
   error,
   completedPosts,
 }: JobProgressProps) {
@@ -42,6 +44,8 @@ export default function JobProgress({
               ? "Failed"
               : currentPost
               ? `Processing: ${currentPost}`
+              : status === "pending" && queuePosition
+              ? `Queued: #${queuePosition} in line`
               : "Starting..."}
           </span>
           <span>
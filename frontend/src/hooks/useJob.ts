@@ -15,6 +15,7 @@ interface UseJobReturn {
   progress: number;
   total: number;
   currentPost: string | null;
+  queuePosition: number | null;
   error: string | null;
   completedPosts: CompletedPost[];
   start: (jobId: string) => void;
@@ -25,6 +26,7 @@ export function useJob(): UseJobReturn {
   const [progress, setProgress] = useState(0);
   const [total, setTotal] = useState(0);
   const [currentPost, setCurrentPost] = useState<string | null>(null);
+  const [queuePosition, setQueuePosition] = useState<number | null>(null);
   const [error, setError] = useState<string | null>(null);
   const [completedPosts, setCompletedPosts] = useState<CompletedPost[]>([]);
   const eventSourceRef = useRef<EventSource | null>(null);
@@ -50,6 +52,7 @@ export function useJob(): UseJobReturn {
           setProgress(data.progress);
           setTotal(data.total);
           setCurrentPost(data.current_post);
+          setQueuePosition(data.queue_position ?? null);
           if (data.error) setError(data.error);
           if (data.status === "completed" || data.status === "failed") {
             cleanup();
@@ -67,6 +70,7 @@ export function useJob(): UseJobReturn {
       cleanup();
       setStatus("pending");
       setProgress(0);
+      setQueuePosition(null);
       setError(null);
       setCompletedPosts([]);
 
@@ -74,7 +78,12 @@ export function useJob(): UseJobReturn {
       const es = new EventSource(url);
       eventSourceRef.current = es;
 
+      // The browser reconnects on its own, resuming after the last event id
+      // it saw; give up on SSE only if that keeps failing
+      let failures = 0;
+
       const handleEvent = (eventType: string, data: string) => {
+        failures = 0;
         try {
           const parsed = JSON.parse(data);
 
@@ -84,8 +93,12 @@ export function useJob(): UseJobReturn {
               setProgress(parsed.progress);
               setTotal(parsed.total);
               setCurrentPost(parsed.current_post);
+              setQueuePosition(parsed.queue_position ?? null);
               if (parsed.error) setError(parsed.error);
               break;
+            case "queued":
+              setQueuePosition(parsed.queue_position ?? null);
+              break;
             case "progress":
               setProgress(parsed.progress);
               setTotal(parsed.total);
@@ -116,6 +129,7 @@ export function useJob(): UseJobReturn {
       // Listen for named events
       for (const eventType of [
         "status",
+        "queued",
         "progress",
         "post_complete",
         "warning",
@@ -128,6 +142,8 @@ export function useJob(): UseJobReturn {
       }
 
       es.onerror = () => {
+        failures += 1;
+        if (es.readyState !== EventSource.CLOSED && failures < 3) return;
         es.close();
         eventSourceRef.current = null;
         // Fall back to polling
@@ -139,5 +155,5 @@ export function useJob(): UseJobReturn {
 
   useEffect(() => cleanup, [cleanup]);
 
-  return { status, progress, total, currentPost, error, completedPosts, start };
+  return { status, progress, total, currentPost, queuePosition, error, completedPosts, start };
 }
@@ -38,7 +38,12 @@ export async function createJob(
   });
   if (!res.ok) {
     const body = await res.json().catch(() => ({}));
-    throw new Error(body.detail || `Failed to create job (${res.status})`);
+    const message = body.detail || `Failed to create job (${res.status})`;
+    // Set when the server is busy (503) or a quota is used up (429)
+    const retryAfter = res.headers.get("Retry-After");
+    throw new Error(
+      retryAfter ? `${message}. Try again in ${retryAfter} seconds.` : message
+    );
   }
   const data = await res.json();
   return data.job_id;
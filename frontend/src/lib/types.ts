@@ -22,6 +22,9 @@ export interface JobStatusResponse {
   total: number;
   current_post: string | null;
   error: string | null;
+  queue_position?: number | null;
+  stage_seconds?: Record<string, number> | null;
+  artifacts?: string[];
 }
 
 export interface DeliveryRecord {
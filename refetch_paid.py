@@ -5,13 +5,17 @@ Re-fetch paid Substack posts using a session cookie, replacing truncated EPUBs.
 
 import os
 import re
+import sys
 import time
 import requests
-from bs4 import BeautifulSoup
 from ebooklib import epub
 
-SUBSTACK_BASE = "https://samkriss.substack.com"
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "backend"))
+
+from app.services.substack import SubstackClient  # noqa: E402
+
+SUBSTACK_BASE = "https://samkriss.substack.com"
 OUTPUT_DIR = os.path.join(SCRIPT_DIR, "epubs")
 BATCH_SIZE = 50
 DELAY_BETWEEN_REQUESTS = 1
@@ -55,42 +59,11 @@ def fetch_post_html(session, slug):
     return resp.text
 
 
-def extract_article_content(html):
-    soup = BeautifulSoup(html, "html.parser")
-    body = soup.find("div", class_="body")
-    if not body:
-        body = soup.find("div", class_="available-content")
-    if not body:
-        body = soup.find("article")
-    if not body:
-        body = soup.find("div", {"class": re.compile(r"post-content|entry-content")})
-    if not body:
-        return None
-
-    for tag in body.find_all(["div", "section"], class_=re.compile(
-        r"subscribe|share|footer|comment|sidebar|button-wrapper|paywall"
-    )):
-        tag.decompose()
-    for tag in body.find_all(["script", "style", "iframe"]):
-        tag.decompose()
-    return body
-
-
-def extract_subtitle(html):
-    soup = BeautifulSoup(html, "html.parser")
-    subtitle = soup.find("h3", class_=re.compile(r"subtitle"))
-    if subtitle:
-        return subtitle.get_text(strip=True)
-    return None
-
-
-def check_content_length(html):
-    """Check the article body length to verify we got full content."""
-    soup = BeautifulSoup(html, "html.parser")
-    body = soup.find("div", class_="body")
-    if not body:
+def content_length(parsed):
+    """Article body length, to verify we got full content."""
+    if parsed.body is None:
         return 0
-    return len(body.get_text())
+    return len(parsed.body.get_text())
 
 
 def create_epub(title, author, date_str, content_html, subtitle=None, slug="post"):
@@ -174,7 +147,7 @@ def main():
     # Test auth with a known paid post first
     print("Testing authentication with a paid post...")
     test_html = fetch_post_html(session, "prophecies-for-2026")
-    content_len = check_content_length(test_html)
+    content_len = content_length(SubstackClient.parse_post(test_html))
     print(f"  Test post content length: {content_len} chars")
     if content_len < 1000:
         print("ERROR: Session cookie doesn't seem to work — got very little content.")
@@ -212,14 +185,15 @@ def main():
 
         try:
             html = fetch_post_html(session, slug)
+            parsed = SubstackClient.parse_post(html)
 
-            clen = check_content_length(html)
+            clen = content_length(parsed)
             if clen < 500:
                 print(f"  WARNING: Very short content ({clen} chars) — may still be truncated")
                 still_paywalled.append(title)
 
-            content = extract_article_content(html)
-            subtitle = extract_subtitle(html)
+            content = parsed.body
+            subtitle = parsed.subtitle
 
             if content is None:
                 print(f"  WARNING: Could not extract content")